@@ -0,0 +1,265 @@
+"""
+Vectorized (NumPy) version of the time weighted average spread
+computation in time_weight.py, for backfilling historical files
+in one pass rather than record by record.
+
+Produces the same per-second output as time_weight.compute_twa,
+with two documented simplifications:
+
+    1) quotes that never get paired at their timestamp are
+        dropped (the streaming QuotePair rejects everything
+        after such a quote instead)
+    2) timestamps must be non-decreasing
+
+python time_weight.py -1 --batch -f data.csv
+"""
+
+import logging
+import sys
+
+import numpy as np
+
+import tick_format
+import time_weight
+
+
+def load_columns(data, delimiter=","):
+    """ Split a block of ts,side,price records into columns.
+    Inputs:
+        data: (str) newline separated records, no header
+        delimiter: field delimiter
+    Returns:
+        ts: (float64 array) timestamps in seconds
+        is_ask: (bool array) True for ':a' quotes
+        price: (float64 array) prices
+    """
+    data = data.strip()
+    if not data:
+        empty = np.empty(0)
+        return empty, empty.astype(bool), empty
+
+    fields = data.replace("\n", delimiter).split(delimiter)
+    if len(fields) % 3:
+        raise time_weight.InputError("batch input is not made of "
+            "ts,side,price records")
+
+    ts = np.array(fields[0::3], dtype=np.float64)
+    ts = time_weight.microsec_to_sec(ts)
+    side = np.array([s.strip() for s in fields[1::3]])
+    price = np.array(fields[2::3], dtype=np.float64)
+
+    is_ask = side == ":a"
+    bad = ~is_ask & (side != ":b")
+    if bad.any():
+        raise time_weight.InputError("QuotePair side must be :a or :b, "
+            "not %s" % side[bad][0])
+
+    return ts * time_weight.float_multiplier, is_ask, \
+        price * time_weight.float_multiplier
+
+
+def pair_quotes(ts, is_ask, price):
+    """ Vectorized QuotePair:  records with the same timestamp
+    form a run, and each run with at least one ask and one bid
+    gives a spread (first ask - first bid).  Extra records in a
+    run are dropped, as are runs missing a side.
+    Inputs:
+        ts, is_ask, price: columns from load_columns
+    Returns:
+        event_ts: (float64 array) timestamp of each paired quote
+        spread: (float64 array) spread at that timestamp
+        n_dropped: (int) number of records not used
+    """
+    if not len(ts):
+        return ts, price, 0
+
+    run_start = np.r_[True, ts[1:] != ts[:-1]]
+    run_id = np.cumsum(run_start) - 1
+    n_runs = run_id[-1] + 1
+    index = np.arange(len(ts))
+
+    first_ask = np.full(n_runs, -1)
+    runs, first = np.unique(run_id[is_ask], return_index=True)
+    first_ask[runs] = index[is_ask][first]
+
+    first_bid = np.full(n_runs, -1)
+    runs, first = np.unique(run_id[~is_ask], return_index=True)
+    first_bid[runs] = index[~is_ask][first]
+
+    paired = (first_ask >= 0) & (first_bid >= 0)
+    ask_i = first_ask[paired]
+    bid_i = first_bid[paired]
+
+    spread = price[ask_i] - price[bid_i]
+    return ts[ask_i], spread, len(ts) - 2 * len(ask_i)
+
+
+def second_keys(ts):
+    """ Assign each paired quote to the whole second it is
+    averaged into, following TimeCache.add:  a quote stays in
+    the open second unless it is more than 1.0 past its start,
+    so a quote exactly on the next whole second still belongs
+    to the open one.
+    Inputs:
+        ts: (float64 array) non-decreasing event timestamps
+    Returns:
+        (float64 array) whole-second key of each event
+    """
+    keys = np.floor(ts)
+    for i in np.flatnonzero(ts == keys):
+        if i and ts[i] - keys[i - 1] <= 1.0:
+            keys[i] = keys[i - 1]
+    return keys
+
+
+def weight_seconds(ts, spread):
+    """ Time weighted average spread for every closed second.
+    Segments are summed in the same order as TimeCache does it,
+    one position at a time across all seconds, so the floating
+    point results match the streaming engine exactly.
+    Inputs:
+        ts: (float64 array) non-decreasing event timestamps
+        spread: (float64 array) spread at each timestamp
+    Returns:
+        keys: (float64 array) start of each closed second, plus
+            the start of the still-open last second
+        twas: (list) unrounded average for each closed second
+        n_open: (int) number of events in the open second
+    """
+    if not len(ts):
+        return ts, [], 0
+
+    keys = second_keys(ts)
+    group_start = np.r_[True, keys[1:] != keys[:-1]]
+    starts = np.flatnonzero(group_start)
+    group = np.cumsum(group_start) - 1
+    n_closed = len(starts) - 1
+
+    # every event after the first brings in the previous spread,
+    # weighted from the previous event (or from the start of its
+    # second, for the first event in a second) up to itself
+    prev_ts = np.where(group_start, keys, np.r_[0., ts[:-1]])
+    in_spread = np.r_[0., spread[:-1]]
+    in_weight = ts - prev_ts
+    in_pos = np.arange(len(ts)) - starts[group]
+
+    # the last event in each closed second carries its spread to
+    # the end of that second
+    last = starts[1:] - 1
+    tail_weight = keys[last] + time_weight.float_multiplier - ts[last]
+    tail_pos = last - starts[:-1] + 1
+
+    in_mask = (group < n_closed) & (np.arange(len(ts)) > 0)
+    seg_group = np.r_[group[in_mask], np.arange(n_closed)]
+    seg_pos = np.r_[in_pos[in_mask], tail_pos]
+    seg_spread = np.r_[in_spread[in_mask], spread[last]]
+    seg_weight = np.r_[in_weight[in_mask], tail_weight]
+
+    order = np.lexsort((seg_pos, seg_group))
+    seg_spread = seg_spread[order]
+    seg_weight = seg_weight[order]
+
+    lengths = np.bincount(seg_group, minlength=n_closed)
+    offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+
+    # longest seconds first, so the seconds still accumulating
+    # at step k are always a prefix
+    by_length = np.argsort(-lengths, kind="mergesort")
+    sorted_lengths = lengths[by_length]
+    sorted_offsets = offsets[by_length]
+
+    twa = np.zeros(n_closed)
+    time_sum = np.zeros(n_closed)
+    k = 0
+    while n_closed and k < sorted_lengths[0]:
+        m = np.searchsorted(-sorted_lengths, -k, side="left")
+        active = by_length[:m]
+        idx = sorted_offsets[:m] + k
+        twa[active] += seg_spread[idx] * seg_weight[idx]
+        time_sum[active] += seg_weight[idx]
+        k += 1
+
+    n_open = len(ts) - starts[-1]
+    return keys[starts], (twa / time_sum).tolist(), n_open
+
+
+def format_seconds(keys, twas):
+    """ Render output lines as TimeCache.log would, including
+    gap seconds (filled with the previous second's average).
+    Inputs:
+        keys: second keys from weight_seconds
+        twas: averages from weight_seconds
+    Returns:
+        (list) output lines
+    """
+    fmt = time_weight.OUTPUT_FORMAT
+    to_microsec = time_weight.sec_to_microsec
+    out = []
+    prev = None
+    for j, twa in enumerate(twas):
+        this_ts = keys[j + 1]
+        twa = round(twa, 8)
+        if prev is not None:
+            gap_ts = keys[j] + 1
+            while gap_ts < this_ts:
+                out.append(fmt % (int(to_microsec(gap_ts)), prev))
+                gap_ts += 1
+        out.append(fmt % (int(to_microsec(this_ts)), twa))
+        prev = twa
+    return out
+
+
+def compute_twa_batch(f, delimiter=","):
+    """ Read all records from f, and log outputs in one go.
+    Inputs:
+        f: readable file, positioned after any header
+        delimiter: field delimiter
+    Returns:
+        (stdout) one line for each whole second in input, with
+            time-weighted prices per whole second.
+    """
+    ts, is_ask, price = load_columns(f.read(), delimiter)
+    _compute_twa_columns(ts, is_ask, price)
+
+
+def compute_twa_batch_ticks(f, fname=None):
+    """ compute_twa_batch for binary tick files (see tick_format.py),
+    with no text parsing.  Files given by name are memory-mapped.
+    Inputs:
+        f: readable stream, positioned at the magic header
+        fname: path of the tick file, if it is one
+    Returns:
+        (stdout) as compute_twa_batch
+    """
+    if fname:
+        records = tick_format.records_array(fname)
+    else:
+        data = f.read()[len(tick_format.MAGIC):]
+        records = np.frombuffer(data, tick_format.records_array_dtype())
+
+    ts = time_weight.microsec_to_sec(records["ts"].astype(np.float64))
+    is_ask = records["side"] == "a"
+    price = records["price"].astype(np.float64)
+    _compute_twa_columns(ts * time_weight.float_multiplier, is_ask,
+        price * time_weight.float_multiplier)
+
+
+def _compute_twa_columns(ts, is_ask, price):
+    """ Shared tail of the batch entry points."""
+    event_ts, spread, n_dropped = pair_quotes(ts, is_ask, price)
+    if n_dropped:
+        logging.warning("input error: dropped %i unpaired or "
+            "duplicate quote records" % n_dropped)
+
+    if np.any(np.diff(event_ts) < 0):
+        raise time_weight.InputError("batch mode needs non-decreasing "
+            "timestamps")
+
+    keys, twas, n_open = weight_seconds(event_ts, spread)
+    sys.stdout.write("".join(format_seconds(keys, twas)))
+
+    if n_open:
+        logging.info("dropped %i records for incomplete "
+            "full-second at the end of the stream between "
+            "timestamps %.2f and %.2f." % (n_open,
+            event_ts[-n_open], event_ts[-1]))
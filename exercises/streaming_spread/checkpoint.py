@@ -0,0 +1,147 @@
+"""
+Checkpoints of the streaming engine's state, so a restarted
+time_weight.py picks up where the last one stopped:  per instrument,
+the open QuotePair and the TimeCache's open second (running sums),
+last spread and archive tail, plus the input offset when reading a
+file.
+
+Snapshots are taken every so often on the wall clock, between
+records and after the output has been flushed, so the output up to a
+snapshot followed by the output of a run resumed from it is the same
+as the output of a run that never stopped.
+
+python time_weight.py -1f data.csv --checkpoint twa.ckpt
+"""
+
+import json
+import logging
+import os
+import time
+
+import stream_data
+import time_weight
+
+
+# snapshot format version
+VERSION = 1
+
+# default seconds between snapshots
+INTERVAL = 5.0
+
+
+class CheckpointError(Exception):
+    """ For snapshots that don't match the run resuming from them."""
+    pass
+
+
+def save(path, snapshot):
+    """ Write a snapshot atomically (a crash leaves the old one)."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def load(path):
+    """ Return the snapshot at path, or None if there isn't one."""
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return None
+    with f:
+        snapshot = json.load(f)
+    if snapshot.get("version") != VERSION:
+        raise CheckpointError("unknown checkpoint version in %s" % path)
+    return snapshot
+
+
+def snapshot(instruments, offset):
+    """ Snapshot of an Instruments registry.
+    Inputs:
+        instruments: time_weight.Instruments
+        offset: (int) byte offset of the next input line, or None
+    Returns:
+        (dict) json-ready snapshot
+    """
+    return {
+        "version": VERSION,
+        "integer": instruments.integer,
+        "offset": offset,
+        "instruments": [
+            [symbol, pair_cache.get_state(), time_cache.get_state()]
+            for symbol, (pair_cache, time_cache) in instruments],
+        }
+
+
+def restore(snapshot, instruments):
+    """ Load a snapshot's state into a fresh Instruments registry."""
+    if snapshot["integer"] != instruments.integer:
+        raise CheckpointError("checkpoint was taken in %s mode"
+            % ("integer" if snapshot["integer"] else "float"))
+    for symbol, pair_state, cache_state in snapshot["instruments"]:
+        if symbol is not None:
+            symbol = str(symbol)
+        pair_cache, time_cache = instruments.get(symbol)
+        pair_cache.set_state(pair_state)
+        time_cache.set_state(cache_state)
+
+
+def compute_twa_checkpointed(f, path, delimiter=",", header=False,
+        symbol_field=None, integer=False, out=None, interval=INTERVAL,
+        chunk_size=stream_data.CHUNK_SIZE):
+    """ compute_twa, resuming from the snapshot at path if there is
+    one, and saving snapshots there as it goes (and at the end).
+    Inputs:
+        f: readable stream; if it is seekable, snapshots hold the
+            input offset and resuming seeks to it, otherwise the
+            stream is taken to carry on where the last run stopped
+        path: snapshot file
+        delimiter: field delimiter
+        header: (bool) first line is a header
+        symbol_field: (int) index of an instrument name field, if any
+        integer: (bool) integer mode, as for compute_twa
+        out: sinks.Sink for the output, otherwise stdout
+        interval: (float) seconds between snapshots
+        chunk_size: (int) bytes per read from f
+    Returns:
+        (stdout) as compute_twa, for the input after the snapshot
+    """
+    out = out or time_weight.sinks.STDOUT
+    seekable = f.seekable()
+    instruments = time_weight.Instruments(integer, out=out)
+
+    previous = load(path)
+    if previous is not None:
+        restore(previous, instruments)
+        if seekable and previous["offset"] is not None:
+            f.seek(previous["offset"])
+        logging.info("resumed from checkpoint %s" % path)
+    elif header:
+        f.readline()
+
+    # blocks come as the input arrives, so a live feed is processed
+    # (and snapshots taken) as it goes
+    offset = f.tell() if seekable else 0
+    last_save = time.time()
+    for lines in stream_data.line_blocks(f, chunk_size):
+        if symbol_field is None:
+            time_weight.twa_blocks([lines], delimiter,
+                instruments.get(None))
+        else:
+            time_weight.twa_by_symbol(lines, delimiter, symbol_field,
+                instruments)
+        offset += sum(len(line) + 1 for line in lines)
+
+        if time.time() - last_save >= interval:
+            out.flush()
+            save(path, snapshot(instruments,
+                offset if seekable else None))
+            last_save = time.time()
+
+    out.flush()
+    save(path, snapshot(instruments, offset if seekable else None))
+
+    for symbol, (_, time_cache) in instruments:
+        time_weight.log_dropped(time_cache)
@@ -2,8 +2,14 @@
 
 python generate_inf_data.py | python time_weight.py
 
+or through a shared memory ring rather than a pipe (see shm_ring.py):
+
+python time_weight.py --ring /dev/shm/twa.ring &
+python generate_inf_data.py --ring /dev/shm/twa.ring
+
 """
 
+import optparse
 import random
 import sys
 import time
@@ -14,8 +20,25 @@ SEED = None
 
 MIN_SPREAD = 0.0001
 MAX_SPREAD = 0.0100
-def start():
-    """ Generates records in ts,side,price\n format."""
+
+
+def getopt(argv):
+
+    parser = optparse.OptionParser()
+
+    parser.add_option(
+        "--ring",
+        default=None, dest="ring",
+        help="write tick records to the shared memory ring at this "
+            "path, rather than text to stdout (x86 only)")
+
+    options, _ = parser.parse_args()
+    return options
+
+
+def start(ring=None):
+    """ Generates records in ts,side,price\n format, or writes them
+    to a shared memory ring (shm_ring.RingWriter) if given."""
     
     if SEED:
         random.seed(SEED)
@@ -34,6 +57,13 @@ def start():
         bid_p = 1 + random.random()
         ask_p = bid_p + random.uniform(MIN_SPREAD, MAX_SPREAD)
         
+        if ring is not None:
+            # as the text would read back
+            t = int(round(t))
+            ring.write([(t, ":a", round(ask_p, 5)),
+                (t, ":b", round(bid_p, 5))])
+            continue
+
         ask_str = "%0.f,%s,%.5f\n" % (t, ":a", ask_p)
         bid_str = "%0.f,%s,%.5f\n" % (t, ":b", bid_p)
         
@@ -42,4 +72,14 @@ def start():
 
 
 if __name__ == "__main__":
-    start()
+
+    opts = getopt(sys.argv)
+    if opts.ring:
+        import shm_ring
+        ring = shm_ring.RingWriter(opts.ring)
+        try:
+            start(ring)
+        finally:
+            ring.close()
+    else:
+        start()
@@ -0,0 +1,459 @@
+"""
+Multi-process versions of time_weight.compute_twa.
+
+Partitioned by symbol:  the parent reads the input once, in blocks
+of whole lines, and hands every block to every worker process as
+one string, so it never splits or parses a line itself.  Each worker
+keeps the records of the symbols that hash to it, with their own
+per-symbol QuotePair / TimeCache state, and sends back the lines it
+logged for each block along with a watermark:  the earliest
+timestamp it could still log.  The parent holds the lines back until
+every worker's watermark is past them, and writes them in timestamp
+order.  Watermarks take the input to be in time order across
+symbols; a symbol that goes quiet holds the output back (in memory)
+until its next record fills in its gap, or the input ends.
+
+Sharded by time:  a single-instrument file is split into byte
+ranges that start on a new whole second, and each range is replayed
+in a process pool.  Every shard first replays the couple of seconds
+before its range with output suppressed, which rebuilds the state
+carried across the edge (QuotePair, TimeCache.last_spread and the
+average used for gap filling in TimeCache.log), so the stitched
+output is byte-identical to a serial run.
+
+python time_weight.py -s 0 -j 8 < multi_symbol.csv
+python time_weight.py -1 -j 8 -f data.csv
+"""
+
+import bisect
+import cStringIO
+import logging
+import mmap
+import multiprocessing as mp
+import operator
+import os
+import sys
+import traceback
+from math import floor
+
+import time_weight
+
+
+# lines per block sent to the workers, for input that comes as
+# lines; larger blocks mean less queue overhead per record
+BATCH_SIZE = 4096
+
+# blocks that may be queued up ahead of the merge
+MAX_IN_FLIGHT = 4
+
+# seq of a worker's last reply
+END = "end"
+
+# time shards per worker process, for load balancing
+SHARDS_PER_JOB = 4
+
+# new seconds replayed before each shard:  the first one is
+# started cold, the next two rebuild last_spread and the gap fill
+# average for the first second the shard logs
+WARMUP_SECONDS = 3
+
+
+class WorkerError(Exception):
+    """ Raised in the parent when a worker process failed, with
+    the worker's traceback as the message.
+    """
+    pass
+
+
+def _line_ts(line):
+    """ Sort key for symbol,ts,twa output lines."""
+    return int(line.split(",", 2)[1])
+
+
+def _input_clock(lines, delimiter, symbol_field):
+    """ Timestamp (microseconds) of the last record in a block, or
+    None if no line can be read:  with the input in time order, no
+    later record is older.
+    """
+    for line in reversed(lines):
+        fields = line.strip().split(delimiter)
+        if len(fields) != 4:
+            continue
+        fields.pop(symbol_field)
+        try:
+            return int(float(fields[0]))
+        except ValueError:
+            continue
+    return None
+
+
+def _partition_worker(in_q, out_q, index, jobs, delimiter, symbol_field,
+        integer):
+    """ Worker loop:  run the records of this worker's symbols in
+    each block of text through its instruments, replying with
+    (seq, logged lines, watermark) per block.  A None block means
+    end of stream, answered with (END, reports of the open seconds
+    dropped, None).
+    """
+    instruments = time_weight.Instruments(integer)
+    stdout = sys.stdout
+    clock = None
+    try:
+        while True:
+            item = in_q.get()
+            if item is None:
+                break
+            seq, text = item
+            lines = text.splitlines()
+            mine = [line for line in lines if hash(
+                line.strip().split(delimiter)[symbol_field]) % jobs == index]
+
+            # TimeCache.log writes to stdout, collect it instead
+            sys.stdout = cStringIO.StringIO()
+            try:
+                time_weight.twa_by_symbol(
+                    mine, delimiter, symbol_field, instruments)
+                out = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+
+            # the earliest line any symbol of this worker could log
+            # next:  new symbols only log after the input clock
+            clock = _input_clock(lines, delimiter, symbol_field) or clock
+            bounds = [time_cache.next_log_ts()
+                for _, (_, time_cache) in instruments] + [clock]
+            bounds = [bound for bound in bounds if bound is not None]
+            out_q.put((seq, out, min(bounds) if bounds else None))
+
+        reports = [time_weight.dropped_report(time_cache)
+            for _, (_, time_cache) in instruments]
+        out_q.put((END, [r for r in reports if r], None))
+
+    except Exception:
+        out_q.put((None, traceback.format_exc(), None))
+
+
+def _batches(stream, size):
+    """ Group an iterator of lines into lists of up to size."""
+    batch = []
+    for line in stream:
+        batch.append(line)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _text_blocks(f, chunk_size):
+    """ Blocks of whole lines read from f, as strings."""
+    read = time_weight.stream_data.block_reader(f, chunk_size)
+    tail = ""
+    while True:
+        block = read()
+        if not block:
+            if tail:
+                yield tail
+            return
+        cut = block.rfind("\n") + 1
+        if not cut:
+            tail += block
+            continue
+        yield tail + block[:cut]
+        tail = block[cut:]
+
+
+class _Merger(object):
+    """ Collects worker replies per block, and writes out the lines
+    older than every worker's watermark, in timestamp order.
+    """
+
+    def __init__(self, out_q, n_workers):
+        self.out_q = out_q
+        self.n_workers = n_workers
+        self.replies = {}
+        self.next_seq = 0
+        self.held = []
+        self.watermarks = [None] * n_workers
+        self.reports = []
+
+
+    def receive(self):
+        """ Block for one reply from any worker."""
+        seq, out, watermark = self.out_q.get()
+        if seq is None:
+            raise WorkerError(out)
+        if seq == END:
+            self.reports.extend(out)
+        self.replies.setdefault(seq, []).append((out, watermark))
+
+
+    def flush(self):
+        """ Take in every block that's complete, in order, and write
+        the lines every worker is past.
+        """
+        while len(self.replies.get(self.next_seq, ())) == self.n_workers:
+            replies = self.replies.pop(self.next_seq)
+            for out, _ in replies:
+                self.held.extend((_line_ts(line), line)
+                    for line in out.splitlines(True))
+            self.watermarks = [watermark for _, watermark in replies]
+            self.next_seq += 1
+
+        if None in self.watermarks:
+            return
+        # each worker's lines are already in time order per
+        # symbol; a stable sort keeps that while merging
+        self.held.sort(key=operator.itemgetter(0))
+        cut = bisect.bisect_left(self.held, (min(self.watermarks),))
+        self._write(cut)
+
+
+    def _write(self, n):
+        """ Write out the first n lines held."""
+        sys.stdout.write("".join(line for _, line in self.held[:n]))
+        del self.held[:n]
+
+
+    def close(self):
+        """ End of stream:  write everything held, then the workers'
+        reports.
+        """
+        self.held.sort(key=operator.itemgetter(0))
+        self._write(len(self.held))
+        for report in self.reports:
+            logging.info(report)
+
+
+def compute_twa_partitioned(f, delimiter=",", symbol_field=0, jobs=2,
+        chunk_size=time_weight.stream_data.CHUNK_SIZE,
+        batch_size=BATCH_SIZE, integer=False):
+    """ compute_twa for interleaved instruments, spread over
+    several processes by symbol hash.
+    Inputs:
+        f: readable stream or iterator of lines, as for compute_twa
+        delimiter: field delimiter
+        symbol_field: (int) index of the instrument name field
+        jobs: (int) number of worker processes
+        chunk_size: (int) bytes per read from f, and per block
+        batch_size: (int) lines per block, for an iterator of lines
+        integer: (bool) integer mode, as for compute_twa
+    Returns:
+        (stdout) symbol,ts,twa lines, in timestamp order (for input
+            in timestamp order)
+    """
+    if hasattr(f, "read") or hasattr(f, "recv"):
+        blocks = _text_blocks(f, chunk_size)
+    else:
+        blocks = ("\n".join(batch) for batch in _batches(f, batch_size))
+
+    out_q = mp.Queue()
+    in_qs = [mp.Queue(MAX_IN_FLIGHT) for _ in range(jobs)]
+    workers = [
+        mp.Process(target=_partition_worker,
+            args=(in_q, out_q, index, jobs, delimiter, symbol_field,
+                integer))
+        for index, in_q in enumerate(in_qs)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    merger = _Merger(out_q, jobs)
+    sent = 0
+    try:
+        for seq, text in enumerate(blocks):
+            for in_q in in_qs:
+                in_q.put((seq, text))
+            sent += 1
+
+            # keep a bounded number of blocks in flight
+            while sent - merger.next_seq > MAX_IN_FLIGHT:
+                merger.receive()
+                merger.flush()
+
+        for in_q in in_qs:
+            in_q.put(None)
+        while merger.next_seq < sent or len(
+                merger.replies.get(END, ())) < jobs:
+            merger.receive()
+            merger.flush()
+
+    except:
+        for worker in workers:
+            worker.terminate()
+        raise
+
+    for worker in workers:
+        worker.join()
+    merger.close()
+
+
+
+def _second_of(line, delimiter):
+    """ Whole second of a record line, and whether its timestamp
+    falls exactly on it.
+    """
+    ts = time_weight.microsec_to_sec(float(line.split(delimiter, 1)[0]))
+    ts *= time_weight.float_multiplier
+    second = floor(ts)
+    return second, ts == second
+
+
+def _line_at(mm, pos, data_start):
+    """ Return (start, end) of the line containing offset pos."""
+    start = mm.rfind("\n", data_start, pos) + 1 or data_start
+    end = mm.find("\n", pos)
+    return start, len(mm) if end < 0 else end
+
+
+def _next_second_start(mm, pos, data_start, delimiter):
+    """ Offset of the first line after pos that begins a new
+    whole second, or None if there isn't one.  Lines exactly on a
+    whole second are skipped, since TimeCache may keep those in
+    the previous second.
+    """
+    start, end = _line_at(mm, pos, data_start)
+    second, _ = _second_of(mm[start:end], delimiter)
+    while end < len(mm):
+        start = end + 1
+        end = mm.find("\n", start)
+        if end < 0:
+            end = len(mm)
+        line = mm[start:end]
+        if not line.strip():
+            continue
+        line_second, exact = _second_of(line, delimiter)
+        if line_second != second and not exact:
+            return start
+        second = line_second
+    return None
+
+
+def _warmup_start(mm, pos, data_start, delimiter):
+    """ Offset WARMUP_SECONDS new-second lines before pos (the
+    start of a shard), or the start of the data.
+    """
+    start, end = _line_at(mm, pos - 1, data_start)
+    second, exact = _second_of(mm[start:end], delimiter)
+    found = 0
+    while start > data_start:
+        prev_start, prev_end = _line_at(mm, start - 1, data_start)
+        prev_second, prev_exact = _second_of(mm[prev_start:prev_end],
+            delimiter)
+        if prev_second != second and not exact:
+            found += 1
+            if found == WARMUP_SECONDS:
+                return start
+        start, second, exact = prev_start, prev_second, prev_exact
+    return data_start
+
+
+def shard_offsets(mm, n_shards, delimiter=",", header=False):
+    """ Split a mapped file into byte ranges, each starting on a
+    line that begins a new whole second.
+    Inputs:
+        mm: mmap of the whole file
+        n_shards: (int) number of ranges wanted (fewer may come back
+            for short files)
+        delimiter: field delimiter
+        header: (bool) first line is a header
+    Returns:
+        (list) tasks of (warmup start, shard start, shard end)
+    """
+    data_start = mm.find("\n") + 1 if header else 0
+    size = len(mm)
+    if data_start <= 0 and header:
+        return []
+
+    starts = [data_start]
+    for k in range(1, n_shards):
+        pos = data_start + (size - data_start) * k // n_shards
+        if pos <= starts[-1]:
+            continue
+        start = _next_second_start(mm, pos, data_start, delimiter)
+        if start is None:
+            break
+        if start > starts[-1]:
+            starts.append(start)
+
+    ends = starts[1:] + [size]
+    return [
+        (_warmup_start(mm, start, data_start, delimiter)
+            if start > data_start else start, start, end)
+        for start, end in zip(starts, ends)]
+
+
+def _shard_worker(args):
+    """ Pool task:  replay one time shard, returning its output.
+    Inputs:
+        args: (fname, delimiter, warmup start, shard start,
+            shard end, is last shard, integer mode)
+    """
+    fname, delimiter, warmup, start, end, is_last, integer = args
+    stdout = sys.stdout
+    try:
+        # rebuild state from just before the shard, output and
+        # input warnings there belong to the previous shard
+        sys.stdout = cStringIO.StringIO()
+        logging.disable(logging.WARNING)
+        try:
+            caches = time_weight.twa_single(
+                time_weight.stream_data.mmap_stream(fname,
+                    start=warmup, end=start),
+                delimiter, time_weight.new_caches(None, integer))
+        finally:
+            logging.disable(logging.NOTSET)
+
+        sys.stdout = out = cStringIO.StringIO()
+        _, time_cache = time_weight.twa_single(
+            time_weight.stream_data.mmap_stream(fname,
+                start=start, end=end),
+            delimiter, caches)
+        if is_last:
+            time_weight.log_dropped(time_cache)
+        return out.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+def compute_twa_sharded(fname, delimiter=",", header=False, jobs=2,
+        n_shards=None, integer=False):
+    """ compute_twa for one large single-instrument file, split
+    into time shards replayed in parallel.
+    Inputs:
+        fname: path of a regular file
+        delimiter: field delimiter
+        header: (bool) first line is a header
+        jobs: (int) number of worker processes
+        n_shards: (int) number of shards, defaults to
+            SHARDS_PER_JOB per worker
+        integer: (bool) integer mode, as for compute_twa
+    Returns:
+        (stdout) identical to compute_twa over the whole file
+    """
+    if n_shards is None:
+        n_shards = jobs * SHARDS_PER_JOB
+
+    with open(fname, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        shards = shard_offsets(mm, n_shards, delimiter, header)
+    finally:
+        mm.close()
+
+    tasks = [(fname, delimiter, warmup, start, end, i == len(shards) - 1,
+            integer)
+        for i, (warmup, start, end) in enumerate(shards)]
+
+    pool = mp.Pool(jobs)
+    try:
+        for out in pool.imap(_shard_worker, tasks):
+            sys.stdout.write(out)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,332 @@
+"""
+Sidecar index of a csv tick file:  the byte offset of the first
+record of each second (or minute, ...) with data.  With it, the
+output for a time range is computed from just that slice of the
+file rather than the whole of it:
+
+python second_index.py -1 -f data.csv --build
+python second_index.py -1 -f data.csv \
+    --start "2016-07-25 00:05:00" --end "2016-07-25 00:06:00"
+
+Like a time shard in parallel_weight, the slice is preceded by a
+replay of the few seconds with data before it (output suppressed),
+which carries in the spread in effect and the rest of the state at
+the start of the range, so the lines printed are the ones a run over
+the whole file prints for those seconds.
+
+Index files are named after the data file (data.csv.idx), and hold
+an 8 byte magic header, the resolution and the size of the data file
+when it was built, then (window start, offset) pairs as little endian
+int64 (window starts in microseconds).
+"""
+
+import bisect
+import calendar
+import cStringIO
+import datetime
+import logging
+import mmap
+import optparse
+import os
+import struct
+import sys
+
+import parallel_weight
+import sinks
+import stream_data
+import time_weight
+
+
+MAGIC = "TWAIDX\x01\x00"
+HEADER = struct.Struct("<qq")
+
+# default index resolution, seconds
+RESOLUTION = 1
+
+# entries replayed before the start of a range:  each has at least
+# one second with data, and one more than the time shards use covers
+# records exactly on a whole second
+WARMUP_ENTRIES = parallel_weight.WARMUP_SECONDS + 1
+
+
+class SecondIndexError(Exception):
+    """ For index files that can't be used with a data file."""
+    pass
+
+
+def getopt(argv):
+
+    parser = optparse.OptionParser()
+
+    parser.add_option(
+        "-f", "--path",
+        default=None, dest="fname",
+        help="csv file to index or query")
+    parser.add_option(
+        "-d", "--delimiter",
+        default=",", dest="delimiter",
+        help="field delimiter for input stream")
+    parser.add_option(
+        "-1", "--header",
+        default=False, dest="header",
+        action="store_true",
+        help="source has header line - discard")
+    parser.add_option(
+        "--build",
+        default=False, dest="build",
+        action="store_true",
+        help="(re)build the index file, then exit")
+    parser.add_option(
+        "-r", "--resolution",
+        default=RESOLUTION, dest="resolution",
+        type="int",
+        help="seconds per index entry [default: %default]")
+    parser.add_option(
+        "--start",
+        default=None, dest="start",
+        help="start of the range:  UTC 'YYYY-MM-DD HH:MM:SS', or "
+            "seconds since the epoch")
+    parser.add_option(
+        "--end",
+        default=None, dest="end",
+        help="end of the range (not included), as --start")
+    parser.add_option(
+        "-i", "--integer",
+        default=False, dest="integer",
+        action="store_true",
+        help="integer microsecond timestamps and fixed point prices")
+
+    options, _ = parser.parse_args()
+    return options
+
+
+def index_path(fname):
+    """ Sidecar index file for a data file."""
+    return fname + ".idx"
+
+
+def parse_time(value):
+    """ UTC 'YYYY-MM-DD HH:MM:SS' (or seconds since the epoch) as
+    whole seconds since the epoch.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        moment = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        raise time_weight.InputError("can't read time %s" % value)
+    return calendar.timegm(moment.timetuple())
+
+
+def _data_start(mm, header):
+    """ Offset of the first record."""
+    if not header:
+        return 0
+    return mm.find("\n") + 1 or len(mm)
+
+
+def scan(mm, resolution=RESOLUTION, delimiter=",", header=False):
+    """ Index entries for a mapped csv file.
+    Inputs:
+        mm: mmap of the whole file
+        resolution: (int) seconds per entry
+        delimiter: field delimiter
+        header: (bool) first line is a header
+    Returns:
+        (list) (window start microseconds, offset) of the first record
+            of each window with data
+    """
+    window = resolution * time_weight.MICROSEC
+    entries = []
+    last_key = None
+    for ts, pos, _ in _lines(mm, _data_start(mm, header), delimiter):
+        key = ts - ts % window
+        if key != last_key:
+            if last_key is not None and key < last_key:
+                raise SecondIndexError("records are not in time order "
+                    "at offset %i" % pos)
+            entries.append((key, pos))
+            last_key = key
+    return entries
+
+
+def build_index(fname, resolution=RESOLUTION, delimiter=",", header=False):
+    """ Scan a csv file and write its index file.
+    Returns:
+        (list) entries, as from scan
+    """
+    with open(fname, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                entries = scan(mm, resolution, delimiter, header)
+            finally:
+                mm.close()
+        else:
+            entries = []
+
+    tmp = index_path(fname) + ".tmp"
+    with open(tmp, "wb") as out:
+        out.write(MAGIC)
+        out.write(HEADER.pack(resolution, size))
+        flat = [value for entry in entries for value in entry]
+        out.write(struct.pack("<%iq" % len(flat), *flat))
+    os.rename(tmp, index_path(fname))
+    return entries
+
+
+def read_index(fname):
+    """ Load the index file for a data file.
+    Returns:
+        resolution: (int) seconds per entry
+        keys: (list) window starts, microseconds
+        offsets: (list) offset of the first record in each window
+    """
+    with open(index_path(fname), "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise SecondIndexError("%s is not an index file" % index_path(fname))
+    resolution, size = HEADER.unpack_from(data, len(MAGIC))
+    if size != os.path.getsize(fname):
+        raise SecondIndexError("index is out of date for %s" % fname)
+
+    body = data[len(MAGIC) + HEADER.size:]
+    flat = struct.unpack("<%iq" % (len(body) // 8), body)
+    return resolution, list(flat[0::2]), list(flat[1::2])
+
+
+def load_index(fname, delimiter=",", header=False):
+    """ read_index, (re)building the index first if it is missing
+    or out of date.
+    """
+    try:
+        return read_index(fname)
+    except (IOError, SecondIndexError) as e:
+        logging.info("building index for %s (%s)" % (fname, e))
+    build_index(fname, RESOLUTION, delimiter, header)
+    return read_index(fname)
+
+
+def _lines(mm, pos, delimiter):
+    """ (timestamp, start, end) of each record line from pos on, end
+    including the newline.
+    """
+    size = len(mm)
+    while pos < size:
+        stop = mm.find("\n", pos)
+        if stop < 0:
+            stop = size
+        cut = mm.find(delimiter, pos, stop)
+        if cut > pos:
+            yield int(mm[pos:cut]), pos, stop + 1
+        pos = stop + 1
+
+
+def _first_after(mm, pos, limit, delimiter, inclusive=False):
+    """ Find the first record from pos on with a timestamp past limit
+    (microseconds), or at it if inclusive.
+    Returns:
+        (start, end) offsets of the lines with that timestamp (both
+        the size of the file if there are none)
+    """
+    found = None
+    for ts, start, end in _lines(mm, pos, delimiter):
+        if found is None:
+            if ts > limit or (inclusive and ts == limit):
+                found, first = ts, start
+        elif ts != found:
+            return first, start
+    if found is None:
+        return len(mm), len(mm)
+    return first, len(mm)
+
+
+def query(fname, start, end, delimiter=",", header=False, integer=False,
+        out=None):
+    """ Output for the seconds in [start, end), from a slice of the
+    file found with its index.
+    Inputs:
+        fname: path of a csv file, with records in time order
+        start, end: (int) whole seconds since the epoch
+        delimiter: field delimiter
+        header: (bool) first line is a header
+        integer: (bool) integer mode, as for compute_twa
+        out: writable stream, otherwise stdout
+    Returns:
+        (int) number of lines written (out gets the lines a run over
+        the whole file prints with timestamps in [start, end))
+    """
+    _, keys, offsets = load_index(fname, delimiter, header)
+    if not keys or end <= start:
+        return 0
+    start_us = start * time_weight.MICROSEC
+    end_us = end * time_weight.MICROSEC
+
+    # last window starting at or before the range, and the windows
+    # with data before it to warm up from
+    i = max(bisect.bisect_right(keys, start_us) - 1, 0)
+    warmup = offsets[max(i - WARMUP_ENTRIES, 0)]
+
+    with open(fname, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        # records from start on are replayed with output, through
+        # the first quote pair past the end of the range, which closes
+        # the range's last second
+        begin, _ = _first_after(mm, offsets[i], start_us, delimiter,
+            inclusive=True)
+        j = bisect.bisect_right(keys, end_us) - 1
+        _, stop = _first_after(mm, max(offsets[j], begin), end_us,
+            delimiter)
+    finally:
+        mm.close()
+
+    buf = cStringIO.StringIO()
+    caches = time_weight.new_caches(None, integer, out=sinks.Sink(buf))
+    logging.disable(logging.WARNING)
+    try:
+        time_weight.twa_single(stream_data.mmap_stream(fname,
+            start=warmup, end=begin), delimiter, caches)
+    finally:
+        logging.disable(logging.NOTSET)
+
+    if begin < stop:
+        buf.seek(0)
+        buf.truncate()
+        time_weight.twa_single(stream_data.mmap_stream(fname,
+            start=begin, end=stop), delimiter, caches)
+
+    out = out or sys.stdout
+    n = 0
+    for line in buf.getvalue().splitlines(True):
+        if start_us <= int(line.split(",", 1)[0]) < end_us:
+            out.write(line)
+            n += 1
+    return n
+
+
+def main(options):
+
+    if not options.fname:
+        raise time_weight.InputError("the index needs a file given "
+            "by --path")
+
+    if options.build:
+        build_index(options.fname, options.resolution, options.delimiter,
+            options.header)
+        return
+
+    if options.start is None or options.end is None:
+        raise time_weight.InputError("a query needs --start and --end")
+    query(options.fname, parse_time(options.start), parse_time(options.end),
+        options.delimiter, options.header, options.integer)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    opts = getopt(sys.argv)
+    main(opts)
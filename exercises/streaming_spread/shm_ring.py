@@ -0,0 +1,516 @@
+"""
+Shared memory transport for tick records between two processes on
+one host:  a single producer, single consumer ring of fixed-width
+records (tick_format.RECORD -- int64 timestamp, side byte, float64
+price) in a memory-mapped file under /dev/shm, rather than text
+through a pipe.
+
+python time_weight.py --ring /dev/shm/twa.ring &
+python generate_inf_data.py --ring /dev/shm/twa.ring
+
+The consumer creates the ring (and removes it when done), and the
+producer waits for it to appear.
+
+The producer copies records into free slots, then advances the head
+counter;  the consumer decodes records up to the head, then advances
+the tail counter.  Python has no memory barriers, so this relies on
+x86 not reordering stores with stores or loads with loads (total store
+order), which makes that all the synchronization either side needs.
+On other machines (ARM, POWER) a reader could see the head move before
+the records it covers, so rings refuse to open there (RingError).
+Neither spins when there is nothing to do:  it sets its waiting flag
+and sleeps on a FIFO next to the ring, which the other side writes a
+byte to (clearing the flag) after moving its counter, if the flag is
+set -- so a wait costs one wakeup, however many writes come before
+the sleeper runs.  Sleeps time out after WAIT_TIMEOUT, which bounds
+the cost of a wakeup lost to a race on the flags.
+
+Latency and throughput against a pipe:
+
+python shm_ring.py --bench
+"""
+
+import errno
+import io
+import logging
+import mmap
+import multiprocessing as mp
+import optparse
+import os
+import platform
+import select
+import struct
+import sys
+import time
+
+import stream_data
+import tick_format
+
+
+MAGIC = "TWARING\x01"
+HEADER = struct.Struct("<8sQ")
+COUNTER = struct.Struct("<Q")
+
+# offsets of the control words, a cache line each so the two sides
+# don't write to a shared one:  records written and the producer's
+# end of stream flag (producer), records read (consumer), and the
+# flags each side sets while it waits
+HEAD = 64
+CLOSED = 128
+TAIL = 192
+READER_WAITING = 256
+WRITER_WAITING = 320
+DATA = 384
+
+# machines (platform.machine()) with total store order, which the
+# counters rely on
+TSO_MACHINES = frozenset(["x86_64", "amd64", "i386", "i486", "i586",
+    "i686", "x86"])
+
+# default slots in the ring
+CAPACITY = 1 << 16
+
+# records copied in or out per struct call, at most
+BLOCK_RECORDS = tick_format.BLOCK_RECORDS
+
+# FIFOs next to the ring, to wake the consumer and the producer
+WAKE = ".wake"
+ROOM = ".room"
+
+# longest sleep before looking at the counters again, seconds
+WAIT_TIMEOUT = 0.02
+
+# seconds the producer waits for the consumer to create the ring
+OPEN_TIMEOUT = 10.0
+
+# benchmark
+BENCH_RECORDS = 200000
+BENCH_PINGS = 1000
+BENCH_PING_INTERVAL = 0.002
+# pairs per write, for the throughput runs
+BENCH_BATCHES = (1, 50)
+
+
+class RingError(Exception):
+    """ For rings that can't be set up, or hold something else."""
+    pass
+
+
+# structs for n records, by n:  producers write a few at a time, so
+# a handful of sizes come up over and over
+_STRUCTS = {}
+MAX_STRUCTS = 256
+
+
+def _records_struct(n):
+    """ Struct for n records."""
+    try:
+        return _STRUCTS[n]
+    except KeyError:
+        if len(_STRUCTS) >= MAX_STRUCTS:
+            _STRUCTS.clear()
+        block = _STRUCTS[n] = struct.Struct("<" + "qcd" * n)
+        return block
+
+
+def _check_machine():
+    """ Refuse machines whose memory model the ring isn't safe on."""
+    machine = platform.machine()
+    if machine.lower() not in TSO_MACHINES:
+        raise RingError("shared memory rings need x86 (total store "
+            "order), not %s" % (machine or "an unknown machine"))
+
+
+class _Ring(object):
+    """ What both ends of a ring share. """
+
+    def _map(self, path):
+        with open(path, "r+b") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < DATA:
+                raise RingError("%s is too short for a ring" % path)
+            self.mm = mmap.mmap(f.fileno(), 0)
+        magic, self.capacity = HEADER.unpack_from(self.mm)
+        if (magic != MAGIC
+                or size != DATA + self.capacity * tick_format.RECORD.size):
+            self.mm.close()
+            raise RingError("%s is not a ring" % path)
+        # FIFOs are opened read-write, so neither end ever sees EOF on
+        # them or waits in open for the other
+        self.wake_fd = os.open(path + WAKE, os.O_RDWR | os.O_NONBLOCK)
+        self.room_fd = os.open(path + ROOM, os.O_RDWR | os.O_NONBLOCK)
+
+
+    def _get(self, offset):
+        return COUNTER.unpack_from(self.mm, offset)[0]
+
+
+    def _set(self, offset, value):
+        COUNTER.pack_into(self.mm, offset, value)
+
+
+    def _wait(self, fd):
+        """ Sleep until woken through fd, or WAIT_TIMEOUT."""
+        select.select([fd], [], [], WAIT_TIMEOUT)
+        try:
+            os.read(fd, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+    def _wake(self, flag, fd):
+        """ Wake the side waiting on fd, clearing its waiting flag so
+        that later writes or reads don't wake it again before it runs.
+        """
+        self._set(flag, 0)
+        try:
+            os.write(fd, "w")
+        except OSError as e:
+            # a full FIFO wakes the other side as well as one more byte
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+    def _close(self):
+        if self.mm is not None:
+            self.mm.close()
+            os.close(self.wake_fd)
+            os.close(self.room_fd)
+            self.mm = None
+
+
+class RingReader(_Ring):
+    """ Consumer end of a ring, which it creates. """
+
+    def __init__(self, path, capacity=CAPACITY):
+        """
+        Inputs:
+            path: file of the ring, best under /dev/shm (replaced if
+                there is one already)
+            capacity: (int) records the ring holds
+        """
+        _check_machine()
+        self.path = path
+        self.mm = None
+        for name in (path, path + WAKE, path + ROOM):
+            if os.path.exists(name):
+                os.unlink(name)
+        os.mkfifo(path + WAKE)
+        os.mkfifo(path + ROOM)
+
+        # the ring appears whole, for a producer waiting on it
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.truncate(DATA + capacity * tick_format.RECORD.size)
+            f.write(HEADER.pack(MAGIC, capacity))
+        os.rename(tmp, path)
+        self._map(path)
+        self.tail = 0
+
+
+    def read(self):
+        """ Records in the ring, waiting for some if there are none.
+        Returns:
+            (list) (ts microseconds, side, price) tuples, empty once
+            the producer has closed the ring and all were read
+        """
+        tail = self.tail
+        while True:
+            head = self._get(HEAD)
+            if head > tail:
+                break
+            if self._get(CLOSED):
+                # the head is set before the flag
+                if self._get(HEAD) == tail:
+                    return []
+                continue
+            self._set(READER_WAITING, 1)
+            if self._get(HEAD) == tail and not self._get(CLOSED):
+                self._wait(self.wake_fd)
+            self._set(READER_WAITING, 0)
+
+        pos = tail % self.capacity
+        n = min(head - tail, self.capacity - pos, BLOCK_RECORDS)
+        flat = _records_struct(n).unpack_from(self.mm,
+            DATA + pos * tick_format.RECORD.size)
+        try:
+            records = zip(flat[0::3],
+                [tick_format.SIDES[s] for s in flat[1::3]], flat[2::3])
+        except KeyError as e:
+            raise RingError("bad side byte %r in %s" % (e.args[0], self.path))
+
+        self.tail = tail + n
+        self._set(TAIL, self.tail)
+        if self._get(WRITER_WAITING):
+            self._wake(WRITER_WAITING, self.room_fd)
+        return records
+
+
+    def records(self):
+        """ Record generator, until the producer closes the ring."""
+        while True:
+            records = self.read()
+            if not records:
+                return
+            for record in records:
+                yield record
+
+
+    def close(self):
+        """ Unmap the ring, and remove it."""
+        self._close()
+        for name in (self.path, self.path + WAKE, self.path + ROOM):
+            if os.path.exists(name):
+                os.unlink(name)
+
+
+class RingWriter(_Ring):
+    """ Producer end of a ring a consumer has created. """
+
+    def __init__(self, path, timeout=OPEN_TIMEOUT):
+        """
+        Inputs:
+            path: file of the ring
+            timeout: (float) seconds to wait for the ring to appear
+        """
+        _check_machine()
+        self.path = path
+        self.mm = None
+        deadline = time.time() + timeout
+        while not os.path.exists(path):
+            if time.time() >= deadline:
+                raise RingError("no ring at %s" % path)
+            time.sleep(WAIT_TIMEOUT)
+        self._map(path)
+        if self._get(HEAD) or self._get(CLOSED):
+            self._close()
+            raise RingError("ring %s has had a producer already" % path)
+        self.head = 0
+        # tail as last read from the ring
+        self.tail = 0
+
+
+    def write(self, records):
+        """ Copy records into the ring, waiting for room as need be.
+        Inputs:
+            records: (list) (ts microseconds, side, price) tuples, with
+                sides as in the text format
+        """
+        try:
+            flat = [value for ts, side, price in records
+                for value in (ts, tick_format.SIDE_BYTES[side], price)]
+        except KeyError as e:
+            raise RingError("sides are :a or :b, not %r" % e.args[0])
+
+        n_records = len(records)
+        head = self.head
+        pos = head % self.capacity
+        if (n_records <= BLOCK_RECORDS and pos + n_records <= self.capacity
+                and head + n_records - self.tail <= self.capacity):
+            # the usual case:  all of it in one piece, into room known
+            # to be free
+            mm = self.mm
+            _records_struct(n_records).pack_into(mm,
+                DATA + pos * tick_format.RECORD.size, *flat)
+            self.head = head = head + n_records
+            COUNTER.pack_into(mm, HEAD, head)
+            if COUNTER.unpack_from(mm, READER_WAITING)[0]:
+                self._wake(READER_WAITING, self.wake_fd)
+            return
+
+        i = 0
+        while i < n_records:
+            head = self.head
+            # the tail as last seen is good enough while it leaves room,
+            # and saves a look at the consumer's cache line per write
+            free = self.capacity - (head - self.tail)
+            if not free:
+                self.tail = self._get(TAIL)
+                if self.tail + self.capacity == head:
+                    self._set(WRITER_WAITING, 1)
+                    if self._get(TAIL) + self.capacity == head:
+                        self._wait(self.room_fd)
+                    self._set(WRITER_WAITING, 0)
+                continue
+
+            pos = head % self.capacity
+            n = min(free, n_records - i, self.capacity - pos, BLOCK_RECORDS)
+            _records_struct(n).pack_into(self.mm,
+                DATA + pos * tick_format.RECORD.size, *flat[3 * i:3 * (i + n)])
+            i += n
+            self._publish(head + n)
+
+
+    def _publish(self, head):
+        """ Move the head on, over records written, and wake the
+        consumer if it is waiting.
+        """
+        self.head = head
+        COUNTER.pack_into(self.mm, HEAD, head)
+        if COUNTER.unpack_from(self.mm, READER_WAITING)[0]:
+            self._wake(READER_WAITING, self.wake_fd)
+
+
+    def close(self):
+        """ End the stream:  the consumer stops once it has read
+        what is in the ring.
+        """
+        if self.mm is not None:
+            self._set(CLOSED, 1)
+            self._wake(READER_WAITING, self.wake_fd)
+        self._close()
+
+
+def getopt(argv):
+
+    parser = optparse.OptionParser()
+
+    parser.add_option(
+        "--bench",
+        default=False, dest="bench",
+        action="store_true",
+        help="compare latency and throughput with a pipe")
+    parser.add_option(
+        "--path",
+        default="/dev/shm/twa-bench.ring", dest="path",
+        help="ring file for the benchmark [default: %default]")
+    parser.add_option(
+        "--records",
+        default=BENCH_RECORDS, dest="records",
+        type="int",
+        help="records for the throughput runs [default: %default]")
+    parser.add_option(
+        "--pings",
+        default=BENCH_PINGS, dest="pings",
+        type="int",
+        help="quote pairs for the latency runs [default: %default]")
+
+    options, _ = parser.parse_args()
+    return options
+
+
+def _bench_pairs(n_pairs, interval):
+    """ Quote pairs of the benchmark, stamped as they are made."""
+    for i in xrange(n_pairs):
+        if interval:
+            time.sleep(interval)
+        ts = int(time.time() * 1000000)
+        yield (ts, ":a", 1.1 + i % 7 * 1e-5), (ts, ":b", 1.1)
+
+
+def _bench_batches(n_pairs, interval, batch):
+    """ Lists of the records of batch pairs at a time."""
+    records = []
+    for pair in _bench_pairs(n_pairs, interval):
+        records.extend(pair)
+        if len(records) == 2 * batch:
+            yield records
+            records = []
+    if records:
+        yield records
+
+
+def _produce_ring(path, n_pairs, interval, batch):
+    ring = RingWriter(path)
+    try:
+        for records in _bench_batches(n_pairs, interval, batch):
+            ring.write(records)
+    finally:
+        ring.close()
+
+
+def _produce_pipe(fd, n_pairs, interval, batch):
+    # text, with a flush per write, as generate_inf_data writes it
+    out = os.fdopen(fd, "wb")
+    for records in _bench_batches(n_pairs, interval, batch):
+        out.write("".join(["%i,%s,%.5f\n" % record for record in records]))
+        out.flush()
+    out.close()
+
+
+def _consume(records):
+    """ Records per second, and the delay of each record, in
+    microseconds.
+    """
+    delays = []
+    start = None
+    for ts, side, price in records:
+        now = int(time.time() * 1000000)
+        if start is None:
+            start = now
+        delays.append(now - ts)
+    elapsed = (int(time.time() * 1000000) - start) / 1e6
+    return len(delays) / elapsed if elapsed else 0.0, delays
+
+
+def _pipe_records(f):
+    for line in stream_data.stream(f):
+        ts, side, price = line.strip().split(",")
+        yield int(ts), side, float(price)
+
+
+def bench(path, n_pairs, interval=0.0, batch=1):
+    """ Records per second and delays through a ring, and through a
+    pipe, with a producer process sending n_pairs quote pairs.
+    Inputs:
+        path: file for the ring
+        n_pairs: (int) quote pairs to send
+        interval: (float) seconds between pairs
+        batch: (int) pairs per write
+    Returns:
+        (list) ("ring" or "pipe", records per second, delays)
+    """
+    results = []
+
+    ring = RingReader(path)
+    producer = mp.Process(target=_produce_ring,
+        args=(path, n_pairs, interval, batch))
+    producer.start()
+    try:
+        results.append(("ring",) + _consume(ring.records()))
+    finally:
+        producer.join()
+        ring.close()
+
+    read_fd, write_fd = os.pipe()
+    producer = mp.Process(target=_produce_pipe,
+        args=(write_fd, n_pairs, interval, batch))
+    producer.start()
+    os.close(write_fd)
+    with io.open(read_fd, "rb") as f:
+        results.append(("pipe",) + _consume(_pipe_records(f)))
+    producer.join()
+    return results
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main(options):
+
+    if not options.bench:
+        raise RingError("nothing to do without --bench")
+
+    for batch in BENCH_BATCHES:
+        sys.stdout.write("throughput, %i records, %i pairs per write:\n"
+            % (options.records, batch))
+        for name, rate, _ in bench(options.path, options.records // 2,
+                batch=batch):
+            sys.stdout.write("  %s  %9.0f records/s\n" % (name, rate))
+
+    sys.stdout.write("latency, %i pairs %.0f ms apart:\n"
+        % (options.pings, BENCH_PING_INTERVAL * 1000))
+    for name, _, delays in bench(options.path, options.pings,
+            BENCH_PING_INTERVAL):
+        sys.stdout.write("  %s  median %5i us, 99%% %6i us\n" % (name,
+            _percentile(delays, 0.5), _percentile(delays, 0.99)))
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    opts = getopt(sys.argv)
+    main(opts)
@@ -0,0 +1,315 @@
+"""
+Output sinks for TimeCache.log:  an encoder turns each
+(symbol, timestamp, twa) record into bytes, and a Sink batches the
+encoded records and writes them out according to a flush policy.
+
+Encoders get the average as already formatted decimal text, so
+no format has to round-trip it through a float (except the binary
+one, which stores a float64).
+
+In compact mode a run of windows filled with the same average (a
+gap in the input) is written as one range record, and expand_gaps
+turns compact csv or json back into the dense form:
+
+python sinks.py -s 1000000 < compact.csv > dense.csv
+python sinks.py --format json < compact.json > dense.json
+"""
+
+import json
+import optparse
+import struct
+import sys
+import time
+
+
+# window length of time_weight output, in microseconds
+STEP = 1000000
+
+
+class CsvEncoder(object):
+    """ ts,twa lines (symbol,ts,twa with a symbol), as time_weight
+    has always written them.  Range records put start:end in the
+    ts field.
+    """
+
+    def encode(self, symbol, ts, twa):
+        if symbol is None:
+            return "%i,%s\n" % (ts, twa)
+        return "%s,%i,%s\n" % (symbol, ts, twa)
+
+
+    def encode_range(self, symbol, start, end, twa):
+        if symbol is None:
+            return "%i:%i,%s\n" % (start, end, twa)
+        return "%s,%i:%i,%s\n" % (symbol, start, end, twa)
+
+
+class JsonEncoder(object):
+    """ One JSON object per line, with ts and twa as numbers. """
+
+    def encode(self, symbol, ts, twa):
+        if symbol is None:
+            return '{"ts": %i, "twa": %s}\n' % (ts, twa)
+        return '{"symbol": %s, "ts": %i, "twa": %s}\n' % (
+            json.dumps(symbol), ts, twa)
+
+
+    def encode_range(self, symbol, start, end, twa):
+        if symbol is None:
+            return '{"ts": %i, "until": %i, "twa": %s}\n' % (start, end, twa)
+        return '{"symbol": %s, "ts": %i, "until": %i, "twa": %s}\n' % (
+            json.dumps(symbol), start, end, twa)
+
+
+class BinaryEncoder(object):
+    """ Packed little endian records:  int64 timestamp (microseconds)
+    and float64 twa, preceded by the symbol as 16 NUL padded bytes
+    when there is one.  Longer symbols are refused rather than cut
+    short, which could give two instruments the same name.
+    """
+
+    RECORD = struct.Struct("<qd")
+    SYMBOL_RECORD = struct.Struct("<16sqd")
+    SYMBOL_SIZE = 16
+
+    def encode(self, symbol, ts, twa):
+        if symbol is None:
+            return self.RECORD.pack(ts, float(twa))
+        if len(symbol) > self.SYMBOL_SIZE:
+            raise ValueError("symbol %r is longer than the %i bytes "
+                "binary output has for it" % (symbol, self.SYMBOL_SIZE))
+        return self.SYMBOL_RECORD.pack(symbol, ts, float(twa))
+
+
+ENCODERS = {
+    "csv": CsvEncoder,
+    "json": JsonEncoder,
+    "binary": BinaryEncoder,
+    }
+
+
+class Sink(object):
+    """ Batches encoded records for one output stream.
+
+    With no flush policy, records are written through to the
+    stream as they come (and the stream does its own buffering).
+    Otherwise they are held until one of the limits is reached, then
+    written in a single call and the stream is flushed.  The limits
+    are checked as records come in, and the interval also whenever
+    the caller polls (the live engines do, on their clock ticks):
+    without polls, records held on an idle stream wait for the next
+    one.
+    """
+
+    def __init__(self, out=None, encoder="csv", max_records=None,
+            max_bytes=None, interval=None, compact=False):
+        """
+        Inputs:
+            out: writable stream, otherwise stdout (looked up at
+                write time)
+            encoder: name in ENCODERS, or an encoder instance
+            max_records: (int) flush after this many records
+            max_bytes: (int) flush after this many bytes
+            interval: (float) flush when a record comes in, or on a
+                poll, at least this many seconds (wall clock) after
+                the last flush
+            compact: (bool) take range records for gaps (see
+                TimeCache.log), csv and json only
+        """
+        self.out = out
+        if isinstance(encoder, basestring):
+            try:
+                encoder = ENCODERS[encoder]()
+            except KeyError:
+                raise ValueError("unknown output format %s" % encoder)
+        self.encode = encoder.encode
+
+        self.compact = compact
+        if compact:
+            if not hasattr(encoder, "encode_range"):
+                raise ValueError("compact output needs csv or json format")
+            self.encode_range = encoder.encode_range
+
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.buffered = (max_records is not None or max_bytes is not None
+            or interval is not None)
+
+        self.buffer = []
+        self.n_bytes = 0
+        self.last_flush = time.time()
+
+
+    def _stream(self):
+        return self.out or sys.stdout
+
+
+    def record(self, symbol, ts, twa):
+        """ Add one output record.
+        Inputs:
+            symbol: (str) instrument name or None
+            ts: (int) timestamp in microseconds
+            twa: (str) average, formatted as decimal text
+        """
+        self._add(self.encode(symbol, ts, twa))
+
+
+    def record_range(self, symbol, start, end, twa):
+        """ Add one range record (compact mode only):  the same
+        average for every window starting from start up to, not
+        including, end.
+        """
+        self._add(self.encode_range(symbol, start, end, twa))
+
+
+    def _add(self, data):
+        """ Write or buffer one encoded record."""
+        if not self.buffered:
+            self._stream().write(data)
+            return
+
+        self.buffer.append(data)
+        self.n_bytes += len(data)
+        if (self.max_records is not None
+                and len(self.buffer) >= self.max_records):
+            self.flush()
+        elif self.max_bytes is not None and self.n_bytes >= self.max_bytes:
+            self.flush()
+        elif (self.interval is not None
+                and time.time() - self.last_flush >= self.interval):
+            self.flush()
+
+
+    def poll(self):
+        """ Flush on the clock, for callers with no record to add:
+        once the interval has passed since the last flush, or every
+        time if there is no interval.
+        """
+        if (self.interval is None
+                or time.time() - self.last_flush >= self.interval):
+            self.flush()
+
+
+    def flush(self):
+        """ Write out anything held, and flush the stream."""
+        out = self._stream()
+        if self.buffer:
+            out.write("".join(self.buffer))
+            self.buffer = []
+            self.n_bytes = 0
+        out.flush()
+        self.last_flush = time.time()
+
+
+    def close(self):
+        """ Flush, and close the stream unless it is stdout."""
+        self.flush()
+        if self.out is not None and self.out is not sys.stdout:
+            self.out.close()
+
+
+# write-through csv to whatever sys.stdout is at the time
+STDOUT = Sink()
+
+
+def expand_gaps(data, step=STEP, format="csv"):
+    """ Dense output from compact output:  each range record becomes
+    one record per window, byte for byte as written without compact
+    mode.  The expansion is vectorized (needs numpy), so long gaps
+    cost next to nothing.
+    Inputs:
+        data: (str) compact csv or json lines, with or without symbols
+        step: (int) window length in microseconds
+        format: 'csv' or 'json', as data was written
+    Returns:
+        (str) dense output
+    """
+    import numpy as np
+
+    try:
+        split = _RANGE_SPLITTERS[format]
+    except KeyError:
+        raise ValueError("can't expand %s output" % format)
+    heads, starts, ends, tails = [], [], [], []
+    for line in data.splitlines():
+        if not line:
+            continue
+        head, start, end, tail = split(line)
+        heads.append(head)
+        starts.append(start)
+        ends.append(end if end is not None else start + step)
+        tails.append(tail)
+    if not starts:
+        return ""
+
+    starts = np.array(starts, dtype=np.int64)
+    counts = (np.array(ends, dtype=np.int64) - starts) // step
+    run = np.repeat(np.arange(len(starts)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+        counts)
+    ts = (starts[run] + offset * step).astype("S20")
+
+    lines = np.char.add(np.char.add(np.array(heads)[run], ts),
+        np.array(tails)[run])
+    return "".join(lines.tolist())
+
+
+def _split_csv(line):
+    """ (text before ts, start, end or None, text after) of a csv
+    record or range record (see CsvEncoder).
+    """
+    head, _, twa = line.rpartition(",")
+    symbol, _, span = head.rpartition(",")
+    start, _, end = span.partition(":")
+    return (symbol + "," if symbol else "", int(start),
+        int(end) if end else None, "," + twa + "\n")
+
+
+def _split_json(line):
+    """ _split_csv for json records and range records (see
+    JsonEncoder).  The twa is kept as text, as written.
+    """
+    record = json.loads(line)
+    head = ""
+    if "symbol" in record:
+        head = '"symbol": %s, ' % json.dumps(record["symbol"])
+    twa = line[line.rindex('"twa": ') + len('"twa": '):line.rindex("}")]
+    return ("{" + head + '"ts": ', record["ts"], record.get("until"),
+        ', "twa": ' + twa + "}\n")
+
+
+_RANGE_SPLITTERS = {
+    "csv": _split_csv,
+    "json": _split_json,
+    }
+
+
+def getopt(argv):
+
+    parser = optparse.OptionParser()
+
+    parser.add_option(
+        "-s", "--step",
+        default=STEP, dest="step",
+        type="int",
+        help="window length in microseconds [default: %default]")
+    parser.add_option(
+        "--format",
+        default="csv", dest="format",
+        type="choice", choices=sorted(_RANGE_SPLITTERS),
+        help="csv or json, as the output was written [default: %default]")
+
+    options, _ = parser.parse_args()
+    return options
+
+
+def main(options):
+    sys.stdout.write(expand_gaps(sys.stdin.read(), options.step,
+        options.format))
+
+
+if __name__ == "__main__":
+
+    opts = getopt(sys.argv)
+    main(opts)
@@ -0,0 +1,480 @@
+"""
+Producer client for stream_server.py:  records go out in binary
+frames of many records each (see stream_server.encode_frame), over a
+pool of persistent connections.
+
+    client = ProducerClient("localhost", 9700)
+    client.send("EURUSD", ts, ":a", price)
+    ...
+    client.close()
+
+A batch goes out once it has batch_records records, or once its first
+record has waited max_delay seconds, whichever comes first.  Records
+of a symbol always go over the same connection, so they reach the
+server in the order they were sent.
+
+Frames ask the server for acks, which it sends once their records are
+through its engine.  Each connection keeps the frames the server
+hasn't acked, and when the connection breaks it reconnects and
+sends them again -- records are delivered at least once (a frame whose
+ack was lost in the break goes twice).  With max_unacked frames out,
+sending waits for acks, which passes the server's backpressure on to
+the producer.
+
+Send a csv file, or time the batch sizes over loopback:
+
+python stream_client.py -1 -f data.csv --symbol EURUSD
+python stream_client.py --bench
+"""
+
+import collections
+import logging
+import multiprocessing as mp
+import optparse
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+import sinks
+import stream_server
+import time_weight
+
+
+# records per frame
+BATCH_RECORDS = 1000
+
+# seconds a record waits for its batch to fill, at most
+MAX_DELAY = 0.05
+
+# connections in the pool
+CONNECTIONS = 2
+
+# frames out without an ack at which sending waits
+MAX_UNACKED = 64
+
+# connection attempts after a break, the first RETRY_DELAY seconds
+# later and each twice as long after the one before
+RETRIES = 5
+RETRY_DELAY = 0.1
+
+# seconds to wait for a send, or for an ack
+TIMEOUT = 30.0
+
+# benchmark
+BENCH_RECORDS = 100000
+BENCH_BATCHES = (1, 10, 100, 1000, 10000)
+BENCH_SYMBOLS = ("EURUSD", "GBPUSD", "USDJPY", "AUDUSD")
+
+
+class ClientError(Exception):
+    """ For servers that can't be reached, or don't keep up."""
+    pass
+
+
+class Connection(object):
+    """ One connection of the pool, with the frames sent over it that
+    the server hasn't acked.  Not thread safe:  ProducerClient holds
+    a lock per connection to use it.
+    """
+
+    def __init__(self, address, timeout=TIMEOUT):
+        """
+        Inputs:
+            address: (host, port) of the server
+            timeout: (float) seconds to wait for a send or an ack
+        """
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.unacked = collections.deque()
+        # frames acked over the current socket, and a partial ack
+        self.acked = 0
+        self.data = ""
+        # breaks since the server last acked something
+        self.failures = 0
+        self.connect()
+
+
+    def connect(self):
+        """ (Re)connect, and send the unacked frames again."""
+        delay = RETRY_DELAY
+        for attempt in xrange(RETRIES + 1):
+            self.close()
+            try:
+                self.sock = socket.create_connection(self.address,
+                    self.timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP,
+                    socket.TCP_NODELAY, 1)
+                self.acked = 0
+                self.data = ""
+                for frame in self.unacked:
+                    self.sock.sendall(frame)
+                return
+            except socket.timeout:
+                raise ClientError("server at %s:%i timed out" % self.address)
+            except socket.error as e:
+                if attempt == RETRIES:
+                    raise ClientError("can't connect to %s:%i: %s"
+                        % (self.address + (e,)))
+                time.sleep(delay)
+                delay *= 2
+
+
+    def _broken(self, error):
+        self.failures += 1
+        if self.failures > RETRIES:
+            raise ClientError("connection to %s:%i keeps breaking: %s"
+                % (self.address + (error,)))
+        logging.warning("connection to %s:%i broke (%s), resending %i "
+            "frames" % (self.address + (error, len(self.unacked))))
+        self.connect()
+
+
+    def send(self, frame):
+        """ Send a frame (from stream_server.pack_frame, asking for an
+        ack), and take in the acks that have come.
+        """
+        self.unacked.append(frame)
+        try:
+            self.sock.sendall(frame)
+            self.read_acks()
+        except socket.timeout:
+            raise ClientError("server at %s:%i timed out" % self.address)
+        except socket.error as e:
+            self._broken(e)
+
+
+    def wait(self, max_unacked=0):
+        """ Wait for acks until at most max_unacked frames are out."""
+        while len(self.unacked) > max_unacked:
+            try:
+                self.read_acks(self.timeout)
+            except socket.error as e:
+                self._broken(e)
+
+
+    def read_acks(self, timeout=0):
+        """ Take in the acks the server has sent, waiting up to timeout
+        seconds for the first one.
+        """
+        while True:
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if not readable:
+                if timeout:
+                    raise ClientError("no ack from %s:%i in %.1f seconds"
+                        % (self.address + (timeout,)))
+                return
+            data = self.sock.recv(stream_server.ACK.size * 1024)
+            if not data:
+                raise socket.error("connection closed by the server")
+            self.data += data
+
+            n = len(self.data) // stream_server.ACK.size
+            if not n:
+                continue
+            acked = stream_server.ACK.unpack_from(self.data,
+                (n - 1) * stream_server.ACK.size)[0]
+            self.data = self.data[n * stream_server.ACK.size:]
+            for _ in xrange(acked - self.acked):
+                self.unacked.popleft()
+            self.acked = acked
+            self.failures = 0
+            timeout = 0
+
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class ProducerClient(object):
+    """ Batches records, and sends them over a pool of connections to
+    an ingestion server.  Safe to call from several threads.
+    """
+
+    def __init__(self, host="localhost", port=stream_server.PORT,
+            connections=CONNECTIONS, batch_records=BATCH_RECORDS,
+            max_delay=MAX_DELAY, max_unacked=MAX_UNACKED, timeout=TIMEOUT):
+        """
+        Inputs:
+            host, port: address of the server
+            connections: (int) connections in the pool
+            batch_records: (int) records per frame
+            max_delay: (float) seconds a record waits for its batch to
+                fill, at most, or None to send batches only when full
+                (or on flush)
+            max_unacked: (int) frames out per connection at which
+                sending waits for acks
+            timeout: (float) seconds to wait for a send or an ack
+        """
+        self.connections = [Connection((host, port), timeout)
+            for _ in xrange(connections)]
+        self.batch_records = batch_records
+        self.max_delay = max_delay
+        self.max_unacked = max_unacked
+
+        self.batches = [[] for _ in self.connections]
+        # when the first record of each batch came
+        self.started = [None] * len(self.connections)
+        # full batches waiting for their connection, oldest first
+        self.outgoing = [collections.deque() for _ in self.connections]
+        # the lock guards the batches;  sends and ack waits happen
+        # outside it, under the lock of their connection, so a slow
+        # connection holds up only the records going over it
+        self.lock = threading.Lock()
+        self.sending = [threading.Lock() for _ in self.connections]
+        self.error = None
+        self.n_records = 0
+        self.n_frames = 0
+
+        self.closed = threading.Event()
+        self.flusher = None
+        if max_delay is not None:
+            self.flusher = threading.Thread(target=self._flush_late)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+
+    def send(self, symbol, ts, side, price):
+        """ Queue a record.
+        Inputs:
+            symbol: (str) instrument, or None for records without one
+            ts: (int) microseconds
+            side: ":a" or ":b"
+            price: (float)
+        """
+        if self.error is not None:
+            raise self.error
+        i = hash(symbol) % len(self.connections) if symbol is not None else 0
+        with self.lock:
+            batch = self.batches[i]
+            # a frame has symbols for all of its records, or none
+            if batch and (batch[0][0] is None) != (symbol is None):
+                self._take(i)
+                batch = self.batches[i]
+            if not batch:
+                self.started[i] = time.time()
+            batch.append((symbol, ts, side, price))
+            if len(batch) >= self.batch_records:
+                self._take(i)
+            full = bool(self.outgoing[i])
+        if full:
+            self._send(i)
+
+
+    def _take(self, i):
+        # with the lock held:  the batch goes out next on its
+        # connection, behind the ones taken before it
+        batch = self.batches[i]
+        if not batch:
+            return
+        self.batches[i] = []
+        self.started[i] = None
+        self.outgoing[i].append(batch)
+        self.n_records += len(batch)
+        self.n_frames += 1
+
+
+    def _send(self, i, wait=False):
+        # without the lock:  whichever thread has the connection sends
+        # every batch taken for it so far, in order
+        connection = self.connections[i]
+        outgoing = self.outgoing[i]
+        with self.sending[i]:
+            while outgoing:
+                batch = outgoing.popleft()
+                connection.send(stream_server.pack_frame(batch,
+                    stream_server.ACK_REQUEST))
+                connection.wait(self.max_unacked)
+            if wait:
+                connection.wait()
+
+
+    def _flush_late(self):
+        # checking every half max_delay for batches started over half
+        # max_delay ago keeps each record's wait under max_delay
+        half = self.max_delay / 2.0
+        while not self.closed.wait(half):
+            try:
+                with self.lock:
+                    now = time.time()
+                    late = [i for i, started in enumerate(self.started)
+                        if started is not None and now - started >= half]
+                    for i in late:
+                        self._take(i)
+                for i in late:
+                    self._send(i)
+            except ClientError as e:
+                logging.error("producer client: %s" % e)
+                self.error = e
+                return
+
+
+    def flush(self, wait=False):
+        """ Send the records queued so far.
+        Inputs:
+            wait: (bool) also wait until the server has acked them all
+        """
+        with self.lock:
+            for i in xrange(len(self.connections)):
+                self._take(i)
+        for i in xrange(len(self.connections)):
+            self._send(i, wait)
+
+
+    def close(self):
+        """ Send what is left, wait for the acks, and disconnect."""
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        try:
+            if self.error is None:
+                self.flush(wait=True)
+        finally:
+            for connection in self.connections:
+                connection.close()
+        if self.error is not None:
+            raise self.error
+
+
+def getopt(argv):
+
+    parser = optparse.OptionParser()
+
+    parser.add_option(
+        "-f", "--path",
+        default=None, dest="fname",
+        help="csv file to send, otherwise stdin")
+    parser.add_option(
+        "-d", "--delimiter",
+        default=",", dest="delimiter",
+        help="field delimiter for input stream")
+    parser.add_option(
+        "-1", "--header",
+        default=False, dest="header",
+        action="store_true",
+        help="source has header line - discard")
+    parser.add_option(
+        "--symbol",
+        default=None, dest="symbol",
+        help="instrument of the records [default: none]")
+    parser.add_option(
+        "--host",
+        default="localhost", dest="host",
+        help="address of the server [default: %default]")
+    parser.add_option(
+        "--port",
+        default=stream_server.PORT, dest="port",
+        type="int",
+        help="port of the server [default: %default]")
+    parser.add_option(
+        "--connections",
+        default=CONNECTIONS, dest="connections",
+        type="int",
+        help="connections in the pool [default: %default]")
+    parser.add_option(
+        "--batch",
+        default=BATCH_RECORDS, dest="batch",
+        type="int",
+        help="records per frame [default: %default]")
+    parser.add_option(
+        "--max-delay",
+        default=MAX_DELAY, dest="max_delay",
+        type="float",
+        help="seconds a record waits for its batch to fill "
+            "[default: %default]")
+    parser.add_option(
+        "--bench",
+        default=False, dest="bench",
+        action="store_true",
+        help="time records per second over loopback, as the batch "
+            "size varies, against a server of its own")
+    parser.add_option(
+        "--records",
+        default=BENCH_RECORDS, dest="records",
+        type="int",
+        help="records per benchmark run [default: %default]")
+
+    options, _ = parser.parse_args()
+    return options
+
+
+def _bench_server(queue):
+    logging.disable(logging.WARNING)
+    server = stream_server.IngestServer(port=0,
+        instruments=time_weight.Instruments(
+            out=sinks.Sink(open(os.devnull, "wb"))))
+    queue.put(server.address)
+    server.serve_until_stopped()
+
+
+def bench(n_records, batches=BENCH_BATCHES, connections=CONNECTIONS):
+    """ Records per second through a ProducerClient to a server in
+    another process, for each batch size.
+    Returns:
+        (list) (batch size, records per second)
+    """
+    queue = mp.Queue()
+    server = mp.Process(target=_bench_server, args=(queue,))
+    server.daemon = True
+    server.start()
+    address = queue.get()
+
+    ts = int(time.time()) * time_weight.MICROSEC
+    results = []
+    try:
+        for batch in batches:
+            client = ProducerClient(address[0], address[1], connections,
+                batch_records=batch)
+            start = time.time()
+            for i in xrange(n_records):
+                client.send(BENCH_SYMBOLS[i // 2 % len(BENCH_SYMBOLS)],
+                    ts + i, (":a", ":b")[i % 2], 1.1 + i % 7 * 1e-5)
+            client.close()
+            results.append((batch, n_records / (time.time() - start)))
+            ts += n_records
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+
+def main(options):
+
+    if options.bench:
+        sys.stdout.write("batch  records/s\n")
+        for batch, rate in bench(options.records,
+                connections=options.connections):
+            sys.stdout.write("%5i  %9.0f\n" % (batch, rate))
+        return
+
+    client = ProducerClient(options.host, options.port,
+        options.connections, options.batch, options.max_delay)
+    f = open(options.fname, "rb") if options.fname else sys.stdin
+    try:
+        if options.header:
+            f.readline()
+        for line in f:
+            try:
+                ts, side, price = line.strip().split(options.delimiter)
+                ts, price = int(ts), float(price)
+            except ValueError:
+                logging.warning("input error: %r" % line)
+                continue
+            client.send(options.symbol, ts, side, price)
+    finally:
+        client.close()
+        f.close()
+    logging.info("sent %i records in %i frames"
+        % (client.n_records, client.n_frames))
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    opts = getopt(sys.argv)
+    main(opts)
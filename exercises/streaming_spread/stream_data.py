@@ -1,37 +1,478 @@
+import Queue
+import bz2
+import io
 import logging
+import mmap
+import os
 import sys
+import threading
+import zlib
 
 
-def stream(f):
+# bytes requested per read call; large enough that the per-call
+# overhead disappears, small enough to stay cache friendly
+CHUNK_SIZE = 65536
+
+# blocks a background reader may get ahead of its consumer
+MAX_BLOCKS = 16
+
+# magic bytes of the compressed formats read transparently
+COMPRESSION_MAGIC = (
+    ("\x1f\x8b", "gzip"),
+    ("BZh", "bz2"),
+    ("\xfd7zXZ\x00", "xz"),
+    )
+
+
+class DecompressionError(Exception):
+    """ For compressed input that can't be read."""
+    pass
+
+
+def block_reader(f, chunk_size):
+    """ Pick the cheapest 'read up to n bytes' call for f.
+    Prefers calls that return whatever is available (partial
+    reads) so that pipes and sockets don't block waiting for
+    a full chunk while data is sitting in the buffer.
+
+    A buffered stream's read1 returns no more than its buffer
+    holds, so open f with a buffer of at least chunk_size bytes
+    (see open_binary) or the reads come in smaller blocks.
+    Inputs:
+        f: file, stream or socket
+        chunk_size: (int) max bytes per read
+    Returns:
+        function taking no arguments, returning '' at EOF
+    """
+    if hasattr(f, "read1"):
+        return lambda: f.read1(chunk_size)
+    if hasattr(f, "recv"):
+        return lambda: f.recv(chunk_size)
+    return lambda: f.read(chunk_size)
+
+
+def open_binary(file_, chunk_size=CHUNK_SIZE, closefd=True):
+    """ io.open(file_, 'rb'), buffered to match block_reader:  the
+    default buffer (io.DEFAULT_BUFFER_SIZE) would cap each read1
+    at a few kilobytes, whatever chunk_size asks for.
+    Inputs:
+        file_: path or file descriptor
+        chunk_size: (int) bytes per read
+        closefd: (bool) as for io.open, when file_ is a descriptor
+    Returns:
+        buffered binary stream
+    """
+    return io.open(file_, "rb", buffering=chunk_size, closefd=closefd)
+
+
+def stream(f, chunk_size=CHUNK_SIZE):
     """ Generic stream generator for files and streams.
-    Implements readline powers for byte streams.  
-    Follows iterator protocol, raising StopIteration 
+    Implements readline powers for byte streams.
+    Follows iterator protocol, raising StopIteration
     when exhausted, as at EOF for normal files.
+
+    Reads in blocks of up to chunk_size bytes and splits
+    them on newlines, carrying any partial line over into
+    the next block.
     Inputs:
-        f: object with 'read' method supporting 
-            nbytes argument.
+        f: object with 'read' method supporting
+            nbytes argument (or 'read1' / 'recv').
+        chunk_size: (int) max bytes to request per read
     Returns:
         lines from bytestream
     """
-    chunk = ""
+    for lines in line_blocks(f, chunk_size):
+        for line in lines:
+            yield line
+
+
+def line_blocks(f, chunk_size=CHUNK_SIZE):
+    """ stream, a block at a time:  yields the whole lines of each
+    block read as a list, for consumers that parse lines in bulk
+    (see quote_parser.py).
+    Inputs:
+        f: object with 'read' method (or 'read1' / 'recv')
+        chunk_size: (int) max bytes to request per read
+    Returns:
+        (list) lines from bytestream, per block
+    """
+    read = block_reader(f, chunk_size)
+    tail = ""
     while True:
-        c = f.read(1)
-        if c == "\n":
-            yield chunk
-            chunk = ""
-            continue
-        if c == "": # EOF
-            if len(chunk):
-                yield chunk
-            raise StopIteration()
-        chunk += c
+        block = read()
+        if not block: # EOF
+            if len(tail):
+                yield [tail]
+            return
+        lines = (tail + block).split("\n")
+        tail = lines.pop()
+        if lines:
+            yield lines
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
+def timed_stream(f, interval, chunk_size=CHUNK_SIZE):
+    """ stream, for live input:  reads happen on a background
+    thread, and the generator also yields None after each block and
+    whenever interval seconds pass with no input, so the consumer
+    gets to act on the clock while the input is idle.
+    Inputs:
+        f: object with 'read' method (or 'read1' / 'recv')
+        interval: (float) longest wait for input, in seconds
+        chunk_size: (int) max bytes to request per read
+    Returns:
+        lines from bytestream, and None
+    """
+    blocks = Queue.Queue(MAX_BLOCKS)
+
+    def reader():
+        read = block_reader(f, chunk_size)
+        try:
+            while True:
+                block = read()
+                blocks.put(block)
+                if not block:
+                    return
+        except Exception as e:
+            blocks.put(e)
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+
+    tail = ""
     while True:
         try:
-            logging.info(stream(sys.stdin).next())
-        except StopIteration:
-            break
+            block = blocks.get(timeout=interval)
+        except Queue.Empty:
+            yield None
+            continue
+        if isinstance(block, Exception):
+            raise block
+        if not block: # EOF
+            if len(tail):
+                yield tail
+            return
+        lines = (tail + block).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line
+        yield None
+
+
+def prefetch(items, max_items=MAX_BLOCKS):
+    """ Iterate over items on a background thread, which stays up
+    to max_items ahead:  a pipeline stage, so that blocking reads
+    (or whatever else producing the items takes) overlap with the
+    consumer's work.  Errors come through to the consumer.
+    Inputs:
+        items: iterable
+        max_items: (int) items to hold at most
+    Returns:
+        the items, in order
+    """
+    queue = Queue.Queue(max_items)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        # gives up once the consumer is gone
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def producer():
+        try:
+            for item in items:
+                put((item, None))
+        except Exception as e:
+            put((None, e))
+        else:
+            put((end, None))
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+class ThreadedWriter(object):
+    """ Writable stream handing what is written to a background
+    thread, which writes it to f:  output writes overlap with the
+    work producing them.  Writes are passed on in pieces of at
+    least chunk_size bytes (or on flush), with up to max_blocks of
+    them in flight, in order.  Closing it leaves f open.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE, max_blocks=MAX_BLOCKS):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.n_pending = 0
+        self.queue = Queue.Queue(max_blocks)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _drain(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                if data:
+                    self.f.write(data)
+                else:
+                    self.f.flush()
+            except Exception as e:
+                self.error = e
+
+
+    def _hand_off(self):
+        if self.error is not None:
+            raise self.error
+        if self.pending:
+            self.queue.put("".join(self.pending))
+            self.pending = []
+            self.n_pending = 0
+
+
+    def write(self, data):
+        self.pending.append(data)
+        self.n_pending += len(data)
+        if self.n_pending >= self.chunk_size:
+            self._hand_off()
+
+
+    def flush(self):
+        """ Pass on what is pending, and have f flushed after it."""
+        self._hand_off()
+        # an empty write asks for a flush
+        self.queue.put("")
+
+
+    def close(self):
+        """ Flush, and wait for everything to be written."""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def compression(f):
+    """ Check for the magic bytes of a compressed format, without
+    consuming input.
+    Inputs:
+        f: buffered stream with a 'peek' method (io.open)
+    Returns:
+        'gzip', 'bz2', 'xz', or None for uncompressed input
+    """
+    head = f.peek(8)
+    for magic, name in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _decompressor(name):
+    """ Factory of fresh decompressor objects for a format."""
+    if name == "gzip":
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if name == "bz2":
+        return bz2.BZ2Decompressor
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise DecompressionError("xz input needs the lzma module "
+                "(backports.lzma on python 2)")
+    return lzma.LZMADecompressor
+
+
+def decompress(read, new_decompressor):
+    """ Decompressed blocks of a compressed byte stream, going on
+    through concatenated streams (as from cat a.gz b.gz).
+    Inputs:
+        read: function returning the next block of input, '' at EOF
+            (see block_reader)
+        new_decompressor: factory of decompressor objects
+    Returns:
+        decompressed blocks, some possibly empty
+    """
+    decompressor = new_decompressor()
+    while True:
+        data = read()
+        if not data:
+            return
+        while data:
+            try:
+                yield decompressor.decompress(data)
+            except EOFError:
+                # bz2 / xz past the end of a stream:  the next one
+                # starts with this data
+                decompressor = new_decompressor()
+                continue
+            data = decompressor.unused_data
+            if data:
+                decompressor = new_decompressor()
+
+
+class DecompressedStream(object):
+    """ Read side of a compressed stream.  Reading and
+    decompression happen on a background thread (zlib and bz2
+    release the GIL while they work), which stays up to max_blocks
+    decompressed blocks ahead, so decompression overlaps with
+    parsing and the averages.
+
+    Offers the calls the line readers use (read1, read, readline
+    and peek); it can't seek.
+    """
 
+    def __init__(self, f, name, chunk_size=CHUNK_SIZE,
+            max_blocks=MAX_BLOCKS):
+        """
+        Inputs:
+            f: compressed stream
+            name: its format, as from compression
+            chunk_size: (int) compressed bytes per read from f
+            max_blocks: (int) decompressed blocks to hold at most
+        """
+        self.f = f
+        self.blocks = prefetch(decompress(block_reader(f, chunk_size),
+            _decompressor(name)), max_blocks)
+        self.buffer = ""
+        self.pos = 0
+        self.done = False
+
+
+    def _buffered(self):
+        """ Bytes left of the current block, waiting for the next
+        one if need be (0 at the end of input).
+        """
+        while self.pos == len(self.buffer) and not self.done:
+            try:
+                self.buffer = next(self.blocks)
+            except StopIteration:
+                self.done = True
+                self.buffer = ""
+            self.pos = 0
+        return len(self.buffer) - self.pos
+
+
+    def read1(self, n=-1):
+        """ Up to n bytes (all of a block if n < 0), '' at EOF."""
+        available = self._buffered()
+        if n < 0 or n > available:
+            n = available
+        data = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+
+    def read(self, n=-1):
+        """ n bytes (all the rest if n < 0), fewer only at EOF."""
+        parts = []
+        while n != 0:
+            data = self.read1(n)
+            if not data:
+                break
+            parts.append(data)
+            if n > 0:
+                n -= len(data)
+        return "".join(parts)
+
+
+    def readline(self):
+        parts = []
+        while self._buffered():
+            stop = self.buffer.find("\n", self.pos)
+            if stop >= 0:
+                parts.append(self.read1(stop + 1 - self.pos))
+                break
+            parts.append(self.read1())
+        return "".join(parts)
+
+
+    def peek(self, n=1):
+        """ The bytes buffered, without consuming them (at least n,
+        unless the block holds fewer).
+        """
+        self._buffered()
+        return self.buffer[self.pos:]
+
+
+    def seekable(self):
+        return False
+
+
+    def close(self):
+        self.blocks.close()
+        self.f.close()
+
+
+def open_input(f, chunk_size=CHUNK_SIZE):
+    """ f, or a DecompressedStream over it if it is compressed."""
+    name = compression(f)
+    if name is None:
+        return f
+    return DecompressedStream(f, name, chunk_size)
+
+
+def mmap_stream(fname, header=False, start=0, end=None):
+    """ Line generator over a memory-mapped file.  Lines are sliced
+    directly out of the mapped pages, so there are no read calls
+    and no intermediate block buffers -- meant for large historical
+    files given by path (not for pipes or sockets).
+    Inputs:
+        fname: path of a regular file
+        header: (bool) discard the first line
+        start: (int) byte offset of the first line to read
+        end: (int) byte offset to stop at, should be a line start
+    Returns:
+        lines from file, without trailing newlines
+    """
+    with open(fname, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        size = len(mm) if end is None else min(end, len(mm))
+        find = mm.find
+        if header and not start:
+            stop = find("\n")
+            start = size if stop < 0 else stop + 1
+        while start < size:
+            stop = find("\n", start, size)
+            if stop < 0:
+                yield mm[start:size]
+                return
+            yield mm[start:stop]
+            start = stop + 1
+    finally:
+        mm.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    for line in stream(sys.stdin):
+        logging.info(line)
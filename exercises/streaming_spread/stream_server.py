@@ -1,33 +1,298 @@
+"""
+Record servers:  producers connect over TCP and send length prefixed
+frames -- a 4 byte big endian length, then the payload -- of quote
+records.  A json payload is one record,
 
+    [ts, side, price]  or  [symbol, ts, side, price]
+
+(ts in integer microseconds), or a list of them.  A binary payload
+carries a batch of records as packed columns, behind a header:
+
+    "TWAF", version byte, flags byte, uint16 symbols, uint32 count
+    symbol table (with the SYMBOL_TABLE flag):  a length byte and the
+        name, per symbol
+    int64 timestamps, side bytes ('a' / 'b'), float64 prices, and
+        uint16 symbol indexes (with the table), count of each
+
+all little endian, so each column decodes in one struct call rather
+than a json parse per record (see encode_frame).  The two kinds of
+frame can be mixed on a connection.
+
+Binary frames with the ACK_REQUEST flag are acked:  the server sends
+back the number of frames over the connection whose records have been
+through the engine so far (ACK, a big endian uint64), which lets
+producers resend what a broken connection or a stopped server lost
+(see stream_client.py).  An ack means the records are in the TWA
+state, not that their averages have been written:  output still
+buffered in a sink is lost with the server.
+
+IngestServer feeds the records straight into per-symbol TWA state
+and writes the averages to stdout, as time_weight.py does:
+
+python stream_server.py --port 9700 > twa.csv
+
+It runs on a single thread, an asyncore event loop over poll, so
+thousands of producer connections cost a socket each rather than a
+thread each.
+
+The averages can also go out to subscribers, over TCP or a unix
+socket, so they are computed once for any number of services:
+
+python stream_server.py --publish 9701 --publish-unix /tmp/twa.sock
+
+Subscribers connect and read the output as it would go to stdout.
+A subscriber that falls behind by more than its buffer has output
+dropped, or is disconnected (--slow), without holding up the others.
+"""
+
+import asyncore
+import collections
 import json
-import multiprocess as mp
+import logging
+import multiprocessing as mp
+import optparse
+import os
 import SocketServer
 import select
+import socket
+import stat
 import struct
+import sys
+import time
 from threading import Thread
 
+import sinks
+import stream_data
+import tick_format
+import time_weight
+
+
+# default port of the ingestion server
+PORT = 9700
+
+# frame length prefix
+LENGTH = struct.Struct(">L")
+
+# largest frame accepted, in bytes
+MAX_FRAME = 1 << 24
+
+# records waiting for the engine at which the server stops reading
+# (it starts again once they are down to half)
+MAX_PENDING = 65536
+
+# records through the engine per turn of the event loop
+DRAIN_RECORDS = 4096
+
+# pending connections the listening socket queues
+BACKLOG = 1024
+
+# output bytes a subscriber can fall behind by
+SUBSCRIBER_BUFFER = 1 << 20
+
+# what happens to a subscriber that falls that far behind:  output is
+# dropped until it catches up, or it is disconnected
+SLOW_POLICIES = ("drop", "disconnect")
+
+# bytes per send to a subscriber
+SEND_SIZE = 1 << 16
+
+# seconds the server goes on sending buffered acks and output after
+# it is stopped
+FINISH_TIMEOUT = 1.0
+
+# binary frames
+FRAME_MAGIC = "TWAF"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sBBHI")
+
+# header flags:  the frame has a symbol table, and each record an index
+# into it;  the producer wants acks
+SYMBOL_TABLE = 1
+ACK_REQUEST = 2
+
+# ack of the frames taken in over a connection
+ACK = struct.Struct(">Q")
+
+# bytes per record in the columns, without and with a symbol index
+RECORD_SIZE = 8 + 1 + 8
+INDEX_SIZE = 2
+
+
+class FrameError(Exception):
+    """ For frames that can't be decoded."""
+    pass
+
+
+def encode_frame(records, flags=0):
+    """ Binary frame payload for a batch of records.
+    Inputs:
+        records: (list) (symbol, ts, side, price) tuples, as from
+            decode_frame -- all with a symbol, or all with None
+        flags: (int) header flags to set, ACK_REQUEST
+    Returns:
+        (str) payload, without the length prefix
+    """
+    return "".join(_frame_parts(records, flags))
+
+
+def pack_frame(records, flags=0):
+    """ encode_frame, with the length prefix:  a whole frame to write,
+    joined in one copy.
+    """
+    parts = _frame_parts(records, flags)
+    parts.insert(0, LENGTH.pack(sum(map(len, parts))))
+    return "".join(parts)
+
+
+def _frame_parts(records, flags):
+    n = len(records)
+    if n:
+        symbols, timestamps, sides, prices = zip(*records)
+    else:
+        symbols = timestamps = sides = prices = ()
+    try:
+        sides = "".join(map(tick_format.SIDE_BYTES.__getitem__, sides))
+    except KeyError as e:
+        raise FrameError("sides are :a or :b, not %r" % e.args[0])
+
+    named = n - symbols.count(None)
+    if named and named < n:
+        raise FrameError("records of a frame all have a symbol, or none do")
+    flags &= ~SYMBOL_TABLE
+    table = []
+    if named:
+        flags |= SYMBOL_TABLE
+        table = sorted(set(symbols))
+        if len(table) > 0xffff:
+            raise FrameError("frames hold up to 65535 symbols")
+        index = dict((symbol, i) for i, symbol in enumerate(table))
+        table = [str(symbol) for symbol in table]
+        if max(map(len, table)) > 0xff:
+            raise FrameError("symbols are up to 255 bytes")
+
+    try:
+        parts = [FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags,
+            len(table), n)]
+        parts.extend(chr(len(symbol)) + symbol for symbol in table)
+        parts.append(struct.pack("<%iq" % n, *timestamps))
+        parts.append(sides)
+        parts.append(struct.pack("<%id" % n, *prices))
+        if named:
+            parts.append(struct.pack("<%iH" % n, *map(index.__getitem__,
+                symbols)))
+    except struct.error as e:
+        raise FrameError("can't pack records: %s" % e)
+    return parts
+
+
+def _decode_binary(data):
+    """ Records of a binary frame payload (see decode_frame)."""
+    if len(data) < FRAME_HEADER.size:
+        raise FrameError("binary frame too short for its header")
+    _, version, flags, n_symbols, n = FRAME_HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        raise FrameError("unknown binary frame version %i" % version)
+    pos = FRAME_HEADER.size
+
+    table = None
+    if flags & SYMBOL_TABLE:
+        table = []
+        for _ in xrange(n_symbols):
+            if pos >= len(data):
+                raise FrameError("binary frame ends in its symbol table")
+            end = pos + 1 + ord(data[pos])
+            table.append(data[pos + 1:end])
+            pos = end
+    size = n * (RECORD_SIZE + (INDEX_SIZE if table is not None else 0))
+    if len(data) - pos != size:
+        raise FrameError("binary frame of %i records has %i bytes of "
+            "them, not %i" % (n, len(data) - pos, size))
+
+    timestamps = struct.unpack_from("<%iq" % n, data, pos)
+    pos += 8 * n
+    try:
+        sides = map(tick_format.SIDES.__getitem__, data[pos:pos + n])
+    except KeyError as e:
+        raise FrameError("bad side byte %r" % e.args[0])
+    pos += n
+    prices = struct.unpack_from("<%id" % n, data, pos)
+    pos += 8 * n
+    if table is None:
+        symbols = [None] * n
+    else:
+        try:
+            symbols = map(table.__getitem__,
+                struct.unpack_from("<%iH" % n, data, pos))
+        except IndexError:
+            raise FrameError("symbol index past the symbol table")
+    return zip(symbols, timestamps, sides, prices)
+
+
+def wants_ack(data):
+    """ Whether a frame payload asks for an ack."""
+    return (data[:len(FRAME_MAGIC)] == FRAME_MAGIC
+        and len(data) >= FRAME_HEADER.size
+        and bool(ord(data[len(FRAME_MAGIC) + 1]) & ACK_REQUEST))
+
+
+def decode_frame(data):
+    """ Records of a frame payload, json or binary.
+    Inputs:
+        data: (str) payload, without the length prefix
+    Returns:
+        (list) (symbol, ts, side, price) tuples, the symbol None
+            for records without one
+    """
+    if data[:len(FRAME_MAGIC)] == FRAME_MAGIC:
+        return _decode_binary(data)
+    try:
+        obj = json.loads(data)
+    except ValueError as e:
+        raise FrameError("bad json frame: %s" % e)
+    if not isinstance(obj, list):
+        raise FrameError("frames hold a record or a list of records")
+    if obj and not isinstance(obj[0], list):
+        obj = [obj]
+
+    records = []
+    for record in obj:
+        if not isinstance(record, list) or len(record) not in (3, 4):
+            raise FrameError("records hold 3 or 4 fields, not %r"
+                % (record,))
+        if len(record) == 3:
+            records.append((None,) + tuple(record))
+            continue
+        symbol = record[0]
+        try:
+            symbol = str(symbol) if symbol is not None else None
+        except UnicodeError:
+            raise FrameError("symbols must be ascii, not %r" % symbol)
+        records.append((symbol,) + tuple(record[1:]))
+    return records
 
 
 class RecordStreamer(SocketServer.StreamRequestHandler):
-    """ Implements a simple record streamer, with data
-    serialized as json."""
+    """ Implements a simple record streamer, with frames of json or
+    binary records (see decode_frame)."""
 
 
     def stream(self):
         
+        # reads go through the buffered rfile, so a run of small frames
+        # costs a recv per buffer rather than two per frame
         while True:
-            chunk = self.connection.recv(4)
-            if len(chunk) < 4:
+            chunk = self.rfile.read(LENGTH.size)
+            if len(chunk) < LENGTH.size:
+                break
+            slen = LENGTH.unpack(chunk)[0]
+            chunk = self.rfile.read(slen)
+            if len(chunk) < slen:
                 break
-            slen = struct.unpack(">L", chunk)[0]
-            chunk = self.connection.recv(slen)
-            while len(chunk) < slen:
-                chunk += self.connection.recv(slen - len(chunk))
             obj = self.unpack(chunk)
             yield obj
 
     def unpack(self, data):
-        return json.loads(data)
+        return decode_frame(data)
     
 
 
@@ -35,7 +300,7 @@ class RecordServer(SocketServer.ThreadingTCPServer):
     
     allow_reuse_address = 1
 
-    def __init__(self, host="localhost", port=22):
+    def __init__(self, host="localhost", port=22, handler=RecordStreamer):
         
         SocketServer.ThreadingTCPServer.__init__(self, (host, port), handler)
         self.abort = 0
@@ -62,6 +327,546 @@ def start_record_server():
 
 
 
+class IngestServer(asyncore.dispatcher):
+    """ Accepts producer connections, and feeds the records they
+    send into per-symbol TWA state (an Instruments registry), all on
+    one thread.
+
+    Records go through the engine as in live mode (see
+    time_weight.twa_live):  they should come in time order per
+    symbol, across connections too, and records for a second that
+    was already closed are dropped (counted in late).  With a
+    lateness, seconds are also closed on the wall clock.
+
+    Backpressure:  decoded records wait in a queue for the engine,
+    which takes up to DRAIN_RECORDS of them per turn of the loop.
+    Once max_pending are waiting the server stops reading from every
+    connection -- TCP flow control then holds the producers back --
+    until the queue is down to half.  A frame is acked once its
+    records are through the engine, so producers waiting for acks
+    are held back by the engine as well.
+    """
+
+    def __init__(self, host="localhost", port=PORT, instruments=None,
+            lateness=None, max_pending=MAX_PENDING, map=None):
+        """
+        Inputs:
+            host, port: address to listen on (port 0 picks one, see
+                the address attribute)
+            instruments: time_weight.Instruments to feed, which also
+                picks float or integer mode and the output
+            lateness: (float) close seconds on the wall clock this
+                many seconds past their end, if given
+            max_pending: (int) records waiting at which reading stops
+            map: (dict) asyncore socket map to share, with a
+                Publisher say
+        """
+        self.map = {} if map is None else map
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(BACKLOG)
+        self.address = self.socket.getsockname()
+
+        if instruments is None:
+            instruments = time_weight.Instruments()
+        self.instruments = instruments
+        self.lateness = lateness
+        self.max_pending = max_pending
+
+        self.pending = collections.deque()
+        self.n_pending = 0
+        self.paused = False
+        self.stopped = False
+        # records taken in, dropped as late, and rejected
+        self.n_records = 0
+        self.late = 0
+        self.errors = 0
+
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error as e:
+            # out of file descriptors, say:  keep serving the others
+            logging.warning("can't accept a connection: %s" % e)
+            return
+        if pair is not None:
+            IngestConnection(pair[0], self)
+
+
+    def feed(self, records, connection=None, frames=None):
+        """ Queue decoded records for the engine.
+        Inputs:
+            records: (list) [symbol, ts, side, price] records
+            connection: (IngestConnection) to ack once the records are
+                through the engine, if they came in frames asking for
+                an ack
+            frames: (int) frames taken in over the connection, up to
+                and including these records'
+        """
+        self.pending.append((records, connection, frames))
+        self.n_pending += len(records)
+        self.n_records += len(records)
+        if self.n_pending >= self.max_pending:
+            self.paused = True
+
+
+    def drain(self, max_records=DRAIN_RECORDS):
+        """ Put queued records through the engine, whole frames at a
+        time, until at least max_records are done (or all of them, if
+        None).
+        """
+        done = 0
+        while self.pending and (max_records is None or done < max_records):
+            records, connection, frames = self.pending.popleft()
+            self._add(records)
+            if connection is not None:
+                connection.ack(frames)
+            self.n_pending -= len(records)
+            done += len(records)
+        if self.paused and self.n_pending <= self.max_pending // 2:
+            self.paused = False
+
+
+    def _add(self, records):
+        instruments = self.instruments
+        integer = instruments.integer
+        for record in records:
+            symbol, ts, side, price = record
+            try:
+                if integer:
+                    price = time_weight.price_to_fixed(price)
+                else:
+                    ts = time_weight.microsec_to_sec(float(ts))
+                    price = float(price)
+
+                    ts *= time_weight.float_multiplier
+                    price *= time_weight.float_multiplier
+
+                self.late += time_weight.add_live_quote(instruments,
+                    symbol, ts, side, price,
+                    record if symbol is not None else record[1:])
+            except (time_weight.InputError, TypeError, ValueError) as e:
+                self.errors += 1
+                logging.warning("input error: %r, %s" % (record, e))
+
+
+    def tick(self):
+        """ Close seconds on the wall clock (with a lateness), and
+        poll the output sinks.
+        """
+        if self.lateness is not None:
+            time_weight.expire_instruments(self.instruments,
+                time.time() - self.lateness)
+            return
+        for out in [self.instruments.out or sinks.STDOUT] + [
+                sink for _, sink in self.instruments.rollups or ()]:
+            out.poll()
+
+
+    def serve_until_stopped(self, interval=time_weight.LIVE_INTERVAL):
+        """ Run the event loop until stop is called, then finish.
+        Inputs:
+            interval: (float) seconds between ticks
+        """
+        last_tick = time.time()
+        while not self.stopped:
+            asyncore.loop(0 if self.pending else interval, use_poll=True,
+                map=self.map, count=1)
+            self.drain()
+            if time.time() - last_tick >= interval:
+                self.tick()
+                last_tick = time.time()
+        self.finish()
+
+
+    def finish(self):
+        """ Put what is left through the engine, send what is still
+        buffered, and close the connections.
+        """
+        self.drain(None)
+        self.tick()
+        # send what is still buffered (acks, output for subscribers),
+        # reading nothing more from producers
+        self.paused = True
+        deadline = time.time() + FINISH_TIMEOUT
+        while time.time() < deadline and any(
+                not dispatcher.accepting and dispatcher.writable()
+                for dispatcher in self.map.values()):
+            asyncore.loop(max(deadline - time.time(), 0), use_poll=True,
+                map=self.map, count=1)
+        asyncore.close_all(self.map)
+
+
+    def stop(self):
+        """ Stop the loop (from any thread) within an interval."""
+        self.stopped = True
+
+
+class IngestConnection(asyncore.dispatcher):
+    """ One producer connection of an IngestServer:  splits what
+    comes in into frames, decodes them, and acks them if asked, once
+    the server has put them through the engine.
+    """
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.parts = []
+        self.size = 0
+        # bytes needed for the next whole frame
+        self.need = LENGTH.size
+        # frames taken in, and acks not sent yet (see ack)
+        self.frames = 0
+        self.acks = ""
+
+
+    def readable(self):
+        return not self.server.paused
+
+
+    def writable(self):
+        return bool(self.acks)
+
+
+    def handle_write(self):
+        sent = self.send(self.acks)
+        self.acks = self.acks[sent:]
+
+
+    def ack(self, frames):
+        """ Ack the frames up to the given count, which are through the
+        engine.
+        """
+        self.acks += ACK.pack(frames)
+
+
+    def handle_read(self):
+        data = self.recv(stream_data.CHUNK_SIZE)
+        if not data:
+            return
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size < self.need:
+            return
+
+        # whole frames, decoded together
+        buffer = "".join(self.parts)
+        pos = 0
+        records = []
+        ack = False
+        try:
+            while len(buffer) - pos >= LENGTH.size:
+                n = LENGTH.unpack_from(buffer, pos)[0]
+                if n > MAX_FRAME:
+                    raise FrameError("frame of %i bytes is too long" % n)
+                end = pos + LENGTH.size + n
+                if end > len(buffer):
+                    break
+                payload = buffer[pos + LENGTH.size:end]
+                records.extend(decode_frame(payload))
+                ack = ack or wants_ack(payload)
+                self.frames += 1
+                pos = end
+        except FrameError as e:
+            logging.warning("closing connection from %s: %s"
+                % (self.addr, e))
+            self.close()
+            return
+
+        rest = buffer[pos:]
+        self.parts = [rest] if rest else []
+        self.size = len(rest)
+        if self.size >= LENGTH.size:
+            self.need = LENGTH.size + LENGTH.unpack_from(rest)[0]
+        else:
+            self.need = LENGTH.size
+        if ack:
+            self.server.feed(records, self, self.frames)
+        elif records:
+            self.server.feed(records)
+
+
+    def handle_close(self):
+        if self.size:
+            logging.warning("connection from %s closed mid frame"
+                % (self.addr,))
+        self.close()
+
+
+class Publisher(object):
+    """ Fans output out to subscribers over TCP or unix sockets:  a
+    writable stream for a sinks.Sink, whose sockets run on an
+    IngestServer's event loop.
+
+        publisher = Publisher(server.map)
+        publisher.listen(("localhost", 9701))
+        instruments.out = sinks.Sink(publisher)
+
+    Subscribers get the output from when they connect on, a whole
+    write (so whole records) at a time.  Each has a buffer of
+    max_bytes:  one that falls that far behind has writes dropped
+    until it catches up, or is disconnected, by policy -- writes never
+    wait for a subscriber.
+    """
+
+    def __init__(self, map, out=None, max_bytes=SUBSCRIBER_BUFFER,
+            policy="drop"):
+        """
+        Inputs:
+            map: (dict) asyncore socket map of the event loop
+            out: writable stream to also write to, if given
+            max_bytes: (int) output a subscriber can fall behind by
+            policy: "drop" or "disconnect", for a subscriber that
+                falls further behind
+        """
+        if policy not in SLOW_POLICIES:
+            raise ValueError("unknown slow subscriber policy %s" % policy)
+        self.map = map
+        self.out = out
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.listeners = []
+        self.subscribers = set()
+
+
+    def listen(self, address):
+        """ Take subscribers on an address.
+        Inputs:
+            address: (host, port) for TCP (port 0 picks one), or the
+                path of a unix socket
+        Returns:
+            the address listened on
+        """
+        listener = SubscriberListener(self, address)
+        self.listeners.append(listener)
+        return listener.address
+
+
+    def write(self, data):
+        if self.out is not None:
+            self.out.write(data)
+        for subscriber in list(self.subscribers):
+            subscriber.push(data)
+
+
+    def flush(self):
+        if self.out is not None:
+            self.out.flush()
+
+
+    def close(self):
+        """ Disconnect the subscribers and stop listening, and close
+        out unless it is stdout.
+        """
+        for dispatcher in self.listeners + list(self.subscribers):
+            dispatcher.close()
+        if self.out is not None and self.out is not sys.stdout:
+            self.out.close()
+
+
+class SubscriberListener(asyncore.dispatcher):
+    """ Listening socket of a Publisher."""
+
+    def __init__(self, publisher, address):
+        asyncore.dispatcher.__init__(self, map=publisher.map)
+        self.publisher = publisher
+        self.path = None
+        if isinstance(address, basestring):
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # a socket left by an earlier run
+            if (os.path.exists(address)
+                    and stat.S_ISSOCK(os.stat(address).st_mode)):
+                os.unlink(address)
+            self.bind(address)
+            self.path = address
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(address)
+        self.listen(BACKLOG)
+        self.address = self.socket.getsockname()
+
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error as e:
+            logging.warning("can't accept a subscriber: %s" % e)
+            return
+        if pair is not None:
+            Subscriber(pair[0], self.publisher, self.path or pair[1])
+
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.path = None
+
+
+class Subscriber(asyncore.dispatcher):
+    """ One subscriber connection of a Publisher, and the output
+    buffered for it.
+    """
+
+    def __init__(self, sock, publisher, name):
+        asyncore.dispatcher.__init__(self, sock, map=publisher.map)
+        self.publisher = publisher
+        self.name = name
+        self.buffer = collections.deque()
+        self.size = 0
+        # writes dropped, and whether the last one was
+        self.dropped = 0
+        self.behind = False
+        publisher.subscribers.add(self)
+
+
+    def push(self, data):
+        """ Buffer a write, unless the subscriber is too far behind."""
+        if self.size + len(data) > self.publisher.max_bytes:
+            if self.publisher.policy == "disconnect":
+                logging.warning("disconnecting subscriber %s, %i bytes "
+                    "behind" % (self.name, self.size))
+                self.close()
+                return
+            if not self.behind:
+                logging.warning("subscriber %s is %i bytes behind, "
+                    "dropping its output" % (self.name, self.size))
+                self.behind = True
+            self.dropped += 1
+            return
+        self.behind = False
+        self.buffer.append(data)
+        self.size += len(data)
+
+
+    def readable(self):
+        # subscribers have nothing to say, but reading sees them close
+        return True
+
+
+    def handle_read(self):
+        self.recv(SEND_SIZE)
+
+
+    def writable(self):
+        return bool(self.buffer)
+
+
+    def handle_write(self):
+        parts = []
+        n = 0
+        while self.buffer and n < SEND_SIZE:
+            parts.append(self.buffer.popleft())
+            n += len(parts[-1])
+        data = "".join(parts)
+        sent = self.send(data)
+        if sent < len(data):
+            self.buffer.appendleft(data[sent:])
+        self.size -= sent
+
+
+    def handle_close(self):
+        self.close()
+
+
+    def close(self):
+        self.publisher.subscribers.discard(self)
+        asyncore.dispatcher.close(self)
+
+
+def getopt(argv):
+
+    parser = optparse.OptionParser()
+
+    parser.add_option(
+        "--host",
+        default="localhost", dest="host",
+        help="address to listen on [default: %default]")
+    parser.add_option(
+        "--port",
+        default=PORT, dest="port",
+        type="int",
+        help="port to listen on [default: %default]")
+    parser.add_option(
+        "-i", "--integer",
+        default=False, dest="integer",
+        action="store_true",
+        help="integer microsecond timestamps and fixed point prices")
+    parser.add_option(
+        "--lateness",
+        default=None, dest="lateness",
+        type="float",
+        help="also close seconds on the wall clock, this many seconds "
+            "past their end")
+    parser.add_option(
+        "--format",
+        default="csv", dest="format",
+        choices=sorted(sinks.ENCODERS),
+        help="output encoding: csv, json or binary [default: %default]")
+    parser.add_option(
+        "--publish",
+        default=None, dest="publish",
+        type="int",
+        help="also serve the output to subscribers on this port")
+    parser.add_option(
+        "--publish-unix",
+        default=None, dest="publish_unix",
+        help="also serve the output to subscribers on this unix socket")
+    parser.add_option(
+        "--subscriber-buffer",
+        default=SUBSCRIBER_BUFFER, dest="subscriber_buffer",
+        type="int",
+        help="output bytes a subscriber can fall behind by "
+            "[default: %default]")
+    parser.add_option(
+        "--slow",
+        default="drop", dest="slow",
+        choices=SLOW_POLICIES,
+        help="for a subscriber further behind:  drop its output, or "
+            "disconnect it [default: %default]")
+
+    options, _ = parser.parse_args()
+    return options
+
+
+def main(options):
+
+    sockets = {}
+    publisher = None
+    if options.publish is not None or options.publish_unix:
+        publisher = Publisher(sockets, sys.stdout,
+            options.subscriber_buffer, options.slow)
+        if options.publish is not None:
+            logging.info("subscribers on %s:%i" % publisher.listen(
+                (options.host, options.publish)))
+        if options.publish_unix:
+            logging.info("subscribers on %s" % publisher.listen(
+                options.publish_unix))
+
+    out = sinks.Sink(publisher, encoder=options.format)
+    server = IngestServer(options.host, options.port,
+        time_weight.Instruments(options.integer, out=out),
+        options.lateness, map=sockets)
+    logging.info("listening on %s:%i" % server.address)
+    try:
+        server.serve_until_stopped()
+    except KeyboardInterrupt:
+        server.finish()
+    finally:
+        for symbol, (_, time_cache) in server.instruments:
+            time_weight.close_caches(time_cache)
+        out.close()
+        if server.late:
+            logging.warning("input error: dropped %i records that came "
+                "in after their second was closed" % server.late)
+
+
 if __name__ == "__main__":
-    
-    start_record_server()
+
+    logging.basicConfig(level=logging.DEBUG)
+    opts = getopt(sys.argv)
+    main(opts)
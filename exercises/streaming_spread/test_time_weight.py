@@ -1,19 +1,57 @@
 
+import bz2
 import cStringIO
 import datetime
+import io
+import json
 import logging
 import pprint
+import os
+import shutil
+import socket
+import struct
 import sys
+import tempfile
+import threading
 import time
 import unittest
+import zlib
 from multiprocessing import Process
 
+try:
+    import numpy
+    import batch_weight
+except ImportError:
+    numpy = None
+
+import checkpoint
 import generate_inf_data
+import parallel_weight
+import quote_parser
+import second_index
+import shm_ring
+import sinks
+import stream_client
+import stream_server
+import tick_format
+import twa_store
 import stream_data
 import time_weight
 
 
 TEST_DATA_FNAME = "test_data.csv"
+DATA_FNAME = "data.csv"
+
+
+def capture_stdout(func, *args, **kwargs):
+    """ Run func, returning whatever it wrote to stdout."""
+    sys.stdout = cStringIO.StringIO()
+    try:
+        func(*args, **kwargs)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = sys.__stdout__
+
 
 class TestTimestamp(unittest.TestCase):
     """ Tests for working with microsecond timestamps."""
@@ -56,10 +94,10 @@ class TestQuotePair(unittest.TestCase):
         """ Ensure proper pairing of matched a/b records."""
 
         pair_cache = time_weight.QuotePair()
-        pair_cache._update_quote(":b", 42.)
+        pair_cache._update_quote(quote_parser.BID, 42.)
         self.assertTrue(pair_cache.bid == 42.)
         
-        pair_cache._update_quote(":a", 58.)
+        pair_cache._update_quote(quote_parser.ASK, 58.)
         self.assertTrue(pair_cache.ask == 58.)
 
         pair_cache._clear_prices()
@@ -111,7 +149,9 @@ class TestTimeCache(unittest.TestCase):
         tc = time_weight.TimeCache()
         self.assertTrue(tc.archive == [])
         self.assertTrue(tc.last_spread is None)
-        self.assertTrue(tc.tmp_cache == [])
+        self.assertTrue(tc.n_open == 0)
+        self.assertTrue(tc.weighted_sum == 0.0)
+        self.assertTrue(tc.time_sum == 0.0)
 
     def test_initial_conditions(self):
         """ Test cold cache."""
@@ -120,7 +160,10 @@ class TestTimeCache(unittest.TestCase):
         # first, see that it loads an initial archive state
         # correctly
         tc._cold_cache(1469404800.100000, 10.)
-        self.assertTrue(tc.tmp_cache == [(1469404800.100000, 10.)])
+        self.assertTrue(tc.n_open == 1)
+        self.assertTrue(tc.first_ts == tc.last_ts == 1469404800.100000)
+        self.assertTrue(tc.spread == 10.)
+        self.assertTrue(tc.time_sum == 0.0)
         self.assertTrue(tc.archive == [
             (1469404800.000000, None),
             ])
@@ -131,16 +174,15 @@ class TestTimeCache(unittest.TestCase):
 
         # First Case:  time weight of incomplete second
         tc = time_weight.TimeCache()
-        tc.archive = [(1469404800.000000, None)]
-        tc.tmp_cache = [
-            (1469404800.200000, 0.000010), # first record in data
-            (1469404800.600000, 0.000020), # second...
-            ]
-        tc.last_spread = None
+        tc.add(1469404800.200000, 0.000010) # first record in data
+        tc.add(1469404800.600000, 0.000020) # second...
+        self.assertTrue(tc.archive == [(1469404800.000000, None)])
+        self.assertTrue(tc.last_spread is None)
+        self.assertTrue(tc.n_open == 2)
 
-        spreads, times = tc._get_spreads_and_time_weights()
-        twa = tc._weight_time(spreads, times)
+        twa = tc._weight_time()
         self.assertTrue(round(twa, 8) == 0.000015)
+        self.assertAlmostEqual(tc.time_sum, 0.8, places=6)
 
 
     def test_add_and_log(self):
@@ -195,11 +237,1419 @@ class TestTimeCache(unittest.TestCase):
             "804000000,0.13500000\n")
 
 
+    def test_symbols(self):
+        """ Interleaved instruments give the same per-instrument
+        output as separate runs, prefixed by the symbol.
+        """
+        file_ = open(TEST_DATA_FNAME, "rb")
+        file_.readline()
+        lines = file_.read().splitlines()
+        file_.close()
+
+        single = capture_stdout(time_weight.compute_twa, iter(lines))
+
+        self.assertTrue(len(single))
+
+        for symbol_field in (0, -1):
+            mixed = []
+            for line in lines:
+                for symbol in ("EURUSD", "USDJPY"):
+                    fields = line.split(",")
+                    fields.insert(len(fields) if symbol_field else 0, symbol)
+                    mixed.append(",".join(fields))
+
+            s = capture_stdout(time_weight.compute_twa, iter(mixed),
+                symbol_field=symbol_field)
+            out = s.splitlines()
+            for symbol in ("EURUSD", "USDJPY"):
+                self.assertEqual(
+                    [l for l in out if l.startswith(symbol + ",")],
+                    [symbol + "," + l for l in single.splitlines()])
+
+
+    def test_fixed_add_and_log(self):
+        """ Integer mode gives the same seconds as test_add_and_log,
+        with exact integer arithmetic.
+        """
+        tc = time_weight.FixedTimeCache()
+        qc = time_weight.FixedQuotePair()
+
+        data = [
+            (800200000, ":b", "1.50"),
+            (800200000, ":a", "1.60"),
+            (800600000, ":b", "1.75"),
+            (800600000, ":a", "1.95"),
+            (801500000, ":b", "1.80"),
+            (801500000, ":a", "1.90"),
+            (803300000, ":b", "1.13"),
+            (803300000, ":a", "1.28"),
+            (804200000, ":b", "1.01"),
+            (804200000, ":a", "1.11"),
+            ]
+
+        # float timestamps are rejected in integer mode
+        self.assertRaises(time_weight.InputError,
+            qc.add, 800.2, ":b", 150000000)
+
+        for ts, side, price in data:
+            spread = qc.add(ts, side, time_weight.price_to_fixed(price))
+            if spread is not None:
+                tc.add(ts, spread)
+
+        self.assertEqual(tc.archive, [
+            (800000000, None),
+            (801000000, 15000000),
+            (803000000, 15000000),
+            (804000000, 13500000),
+            ])
+
+        s = capture_stdout(tc.log)
+        self.assertEqual(s,
+            "801000000,0.15000000\n"
+            "802000000,0.15000000\n"
+            "803000000,0.15000000\n"
+            "804000000,0.13500000\n")
+
+    def test_fixed_matches_float(self):
+        """ Integer mode agrees with float mode on the sample data,
+        and rounds like the builtin round.
+        """
+        file_ = open(DATA_FNAME, "rb")
+        file_.readline()
+        lines = file_.read().splitlines()
+        file_.close()
+
+        expected = capture_stdout(time_weight.compute_twa, iter(lines))
+        s = capture_stdout(time_weight.compute_twa, iter(lines),
+            integer=True)
+        self.assertEqual(s, expected)
+
+        for n, d in ((5, 2), (-5, 2), (7, 3), (-7, 3), (0, 4)):
+            self.assertEqual(time_weight.round_div(n, d), round(n / float(d)))
+
+
+    def test_rollups(self):
+        """ Coarser windows derived from finer ones match computing
+        them directly, in a single pass.
+        """
+        file_ = open(DATA_FNAME, "rb")
+        file_.readline()
+        lines = file_.read().splitlines()
+        file_.close()
+
+        windows = [time_weight.parse_window(w)
+            for w in ("100ms", "1s", "1m", "1h")]
+        self.assertEqual(windows, [100000, 1000000, 60000000, 3600000000])
+
+        outs = [cStringIO.StringIO() for _ in windows]
+        time_weight.compute_twa(iter(lines), rollups=zip(windows, outs))
+
+        expected = capture_stdout(time_weight.compute_twa, iter(lines))
+        self.assertEqual(outs[1].getvalue(), expected)
+
+        direct = cStringIO.StringIO()
+        time_weight.compute_twa(iter(lines), rollups=[(60000000, direct)])
+        self.assertEqual(outs[2].getvalue(), direct.getvalue())
+        self.assertEqual(len(outs[2].getvalue().splitlines()), 20)
+
+        self.assertRaises(time_weight.InputError,
+            time_weight.rollup_chain, [1000000, 1500000], [None, None])
+
+
+    def test_expire(self):
+        """ Seconds closed on the clock, with and without records."""
+        out = cStringIO.StringIO()
+        tc = time_weight.TimeCache(out=out)
+        self.assertEqual(tc.expire(5.0), 0)
+
+        tc.add(1.2, 1.0)
+        tc.add(1.5, 2.0)
+        self.assertEqual([tc.expire(t) for t in (1.9, 2.0, 2.5)], [0, 1, 0])
+        tc.log()
+        self.assertEqual(tc.expire(3.0), 1)
+        tc.log()
+        self.assertEqual(tc.n_open, 0)
+
+        tc.add(3.5, 3.0)
+        self.assertEqual(tc.expire(4.0), 1)
+        tc.log()
+        self.assertEqual(out.getvalue(), "2000000,1.62500000\n"
+            "3000000,2.00000000\n4000000,2.50000000\n")
+
+
+    def test_live(self):
+        """ Live mode gives a line for the same seconds, and keeps
+        closing seconds while the input is idle.
+        """
+        file_ = open(DATA_FNAME, "rb")
+        file_.readline()
+        lines = file_.read().splitlines()
+        file_.close()
+
+        expected = capture_stdout(time_weight.compute_twa, iter(lines))
+        out = cStringIO.StringIO()
+        _, late = time_weight.twa_live(iter(lines), ",",
+            instruments=time_weight.Instruments(out=sinks.Sink(out)))
+        live = out.getvalue().splitlines()
+        expected = expected.splitlines()
+        self.assertEqual(late, 0)
+
+        # idle seconds are filled with the spread in effect rather
+        # than with the average before, so only the seconds up to the
+        # first gap match
+        self.assertEqual([l.split(",")[0] for l in live],
+            [l.split(",")[0] for l in expected])
+        self.assertEqual(live[:5], expected[:5])
+        self.assertNotEqual(live, expected)
+
+        # on the clock:  a second closes once it is lateness past its
+        # end, whether or not records come in
+        now = [1000.3]
+        out = cStringIO.StringIO()
+        seen = []
+
+        def ticks():
+            yield "1000300000,:a,2"
+            yield "1000300000,:b,1"
+            for t in (1000.9, 1001.2, 1001.5, 1002.0, 1003.6):
+                now[0] = t
+                yield None
+                seen.append(out.getvalue().count("\n"))
+
+        _, late = time_weight.twa_live(ticks(), ",",
+            instruments=time_weight.Instruments(out=sinks.Sink(out)),
+            lateness=0.5, clock=lambda: now[0])
+        self.assertEqual(late, 0)
+        self.assertEqual(seen, [0, 0, 1, 1, 3])
+        self.assertEqual(out.getvalue(), "1001000000,1.00000000\n"
+            "1002000000,1.00000000\n1003000000,1.00000000\n")
+
+        # input far behind the wall clock (old data) closes its
+        # seconds on its own records only
+        now = [1e9]
+        out = cStringIO.StringIO()
+        lines = ["1000300000,:a,2", "1000300000,:b,1", None,
+            "1001500000,:a,2", "1001500000,:b,1", None]
+        _, late = time_weight.twa_live(iter(lines), ",",
+            instruments=time_weight.Instruments(out=sinks.Sink(out)),
+            clock=lambda: now[0])
+        self.assertEqual(late, 0)
+        self.assertEqual(out.getvalue(), "1001000000,1.00000000\n")
+
+        # the live reader hands on every line, and a clock tick after
+        # each block
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, "1,:a,2\n1,:b,1\n")
+        os.close(write_fd)
+        with io.open(read_fd, "rb") as f:
+            items = list(stream_data.timed_stream(f, 0.01))
+        self.assertEqual([item for item in items if item is not None],
+            ["1,:a,2", "1,:b,1"])
+        self.assertEqual(items[-1], None)
+
+
     #TODO Test for safety against other implementations -- what if 
     # records are not written at each new whole second?
 
 
 
+class TestCheckpoint(unittest.TestCase):
+    """ Tests for resuming the streaming engine from a snapshot."""
+
+    def setUp(self):
+        fd, self.data_fname = tempfile.mkstemp()
+        os.close(fd)
+        self.ckpt_fname = self.data_fname + ".ckpt"
+
+
+    def tearDown(self):
+        for fname in (self.data_fname, self.ckpt_fname):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+    def _run(self, **kwargs):
+        out = cStringIO.StringIO()
+        with io.open(self.data_fname, "rb") as f:
+            checkpoint.compute_twa_checkpointed(f, self.ckpt_fname,
+                header=True, out=sinks.Sink(out), **kwargs)
+        return out.getvalue()
+
+
+    def test_resume(self):
+        """ Output before and after a restart adds up to the output
+        of a run that never stopped, in float and integer mode.
+        """
+        data = open(DATA_FNAME, "rb").read()
+        cut = data.index("\n", len(data) // 3) + 1
+
+        for integer in (False, True):
+            expected = capture_stdout(time_weight.compute_twa,
+                iter(data.splitlines()[1:]), integer=integer)
+
+            open(self.data_fname, "wb").write(data[:cut])
+            first = self._run(integer=integer, interval=0.0)
+            open(self.data_fname, "wb").write(data)
+            second = self._run(integer=integer)
+
+            self.assertTrue(first and second)
+            self.assertEqual(first + second, expected)
+            self.assertEqual(self._run(integer=integer), "")
+            os.remove(self.ckpt_fname)
+
+
+    def test_live_input(self):
+        """ Input is processed, and snapshots taken, as it arrives on
+        a pipe that stays open -- not once some number of lines have
+        come in.
+        """
+        lines = open(DATA_FNAME, "rb").read().splitlines(True)[:40]
+        read_fd, write_fd = os.pipe()
+        saved = []
+
+        def writer():
+            with os.fdopen(write_fd, "wb") as f:
+                f.writelines(lines)
+                f.flush()
+                # hold the pipe open until the snapshot shows up
+                for _ in range(500):
+                    if os.path.exists(self.ckpt_fname):
+                        saved.append(checkpoint.load(self.ckpt_fname))
+                        break
+                    time.sleep(0.01)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        out = cStringIO.StringIO()
+        with stream_data.open_binary(read_fd) as f:
+            checkpoint.compute_twa_checkpointed(f, self.ckpt_fname,
+                header=True, out=sinks.Sink(out), interval=0.0)
+        thread.join()
+
+        self.assertEqual(len(saved), 1)
+        self.assertTrue(saved[0]["instruments"])
+        self.assertTrue(out.getvalue())
+
+
+    def test_mode_mismatch(self):
+
+        open(self.data_fname, "wb").write(open(DATA_FNAME, "rb").read())
+        self._run()
+        self.assertRaises(checkpoint.CheckpointError, self._run,
+            integer=True)
+
+
+class TestSecondIndex(unittest.TestCase):
+    """ Tests for range queries through the sidecar index."""
+
+    def setUp(self):
+        fd, self.data_fname = tempfile.mkstemp()
+        os.write(fd, open(DATA_FNAME, "rb").read())
+        os.close(fd)
+
+
+    def tearDown(self):
+        for fname in (self.data_fname,
+                second_index.index_path(self.data_fname)):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+    def test_build(self):
+
+        entries = second_index.build_index(self.data_fname, header=True)
+        resolution, keys, offsets = second_index.read_index(self.data_fname)
+        self.assertEqual(resolution, 1)
+        self.assertEqual(zip(keys, offsets), entries)
+        self.assertEqual(keys[0], 1469404799000000)
+
+        data = open(self.data_fname, "rb").read()
+        for key, offset in entries[:50]:
+            self.assertEqual(int(data[offset:].split(",", 1)[0]) // 1000000,
+                key // 1000000)
+            self.assertEqual(data[offset - 1], "\n")
+
+        entries = second_index.build_index(self.data_fname, 60, header=True)
+        self.assertEqual(len(entries), 21)
+
+        open(self.data_fname, "ab").write("1469406000000000,:a,1.0\n")
+        self.assertRaises(second_index.SecondIndexError,
+            second_index.read_index, self.data_fname)
+
+
+    def test_query(self):
+        """ Lines for a range match a run over the whole file."""
+        expected = capture_stdout(time_weight.compute_twa,
+            iter(open(DATA_FNAME, "rb").read().splitlines()[1:]))
+        expected = expected.splitlines(True)
+
+        start = 1469404800
+        for a, b in ((start, start + 10), (start + 443, start + 458),
+                (start + 449, start + 457), (start + 1195, start + 1300),
+                (start - 100, start + 2), (start + 30, start + 30)):
+            out = cStringIO.StringIO()
+            n = second_index.query(self.data_fname, a, b, header=True,
+                out=out)
+            lines = [line for line in expected
+                if a * 1000000 <= int(line.split(",")[0]) < b * 1000000]
+            self.assertEqual(out.getvalue(), "".join(lines))
+            self.assertEqual(n, len(lines))
+
+        self.assertEqual(second_index.parse_time("2016-07-25 00:00:00"),
+            start)
+
+
+class TestTwaStore(unittest.TestCase):
+    """ Tests for averages over any window from prefix sums."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        file_ = open(DATA_FNAME, "rb")
+        file_.readline()
+        self.lines = file_.read().splitlines()
+        file_.close()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+    def test_windows(self):
+
+        path = os.path.join(self.path, "float")
+        out = capture_stdout(time_weight.compute_twa, iter(self.lines),
+            store=path)
+        out = out.splitlines()
+        store = twa_store.PrefixStore(path)
+        self.assertEqual(store.rows, 1200)
+        self.assertEqual(store.start, 1469404799000000)
+
+        # a one second window is that second's output
+        for line in out[:5]:
+            ts, twa = line.split(",")
+            self.assertEqual(time_weight.VALUE_FORMAT
+                % store.twa(int(ts) - 1000000, int(ts)), twa)
+
+        # and longer ones weigh the seconds in them by time
+        a, b, c = (store.start + k * 1000000 for k in (1, 301, 1001))
+        self.assertAlmostEqual(store.twa(a, c),
+            (store.twa(a, b) * 300 + store.twa(b, c) * 700) / 1000, 12)
+        self.assertEqual(store.twa(c, c), None)
+
+        # integer mode stores the same sums, and running again over
+        # the same input appends nothing
+        path = os.path.join(self.path, "integer")
+        for _ in range(2):
+            capture_stdout(time_weight.compute_twa, iter(self.lines),
+                integer=True, store=path)
+        fixed = twa_store.PrefixStore(path)
+        self.assertEqual(fixed.rows, 1200)
+        self.assertAlmostEqual(fixed.twa(), store.twa(), 12)
+        self.assertAlmostEqual(fixed.twa(a, b), store.twa(a, b), 12)
+
+        self.assertRaises(twa_store.StoreError, twa_store.PrefixStore,
+            self.path)
+
+
+    def test_append_after_gap(self):
+        """ A run starting well after the end of the store appends to
+        it, and the seconds in between count for nothing.
+        """
+        first = self.lines[:1000]
+        last_ts = int(first[-1].split(",")[0])
+        skip = next(i for i, line in enumerate(self.lines)
+            if int(line.split(",")[0]) >= last_ts + 40 * 1000000)
+        second = self.lines[skip:]
+
+        capture_stdout(time_weight.compute_twa, iter(first),
+            store=self.path)
+        before = twa_store.PrefixStore(self.path)
+        gap_start = before.end
+        capture_stdout(time_weight.compute_twa, iter(second),
+            store=self.path)
+        store = twa_store.PrefixStore(self.path)
+
+        gap_end = (int(second[0].split(",")[0]) // 1000000) * 1000000
+        self.assertTrue(gap_end - gap_start >= 30 * 1000000)
+        self.assertEqual(store.twa(gap_start, gap_end), None)
+
+        # a window spanning the gap weighs the two runs by their time
+        a, c = store.start + 5 * 1000000, gap_end + 20 * 1000000
+        w1, t1 = (x - y for x, y in zip(
+            store.row((gap_start - store.start) // store.step - 1),
+            store.row((a - store.start) // store.step - 1)))
+        w2, t2 = (x - y for x, y in zip(
+            store.row((c - store.start) // store.step - 1),
+            store.row((gap_end - store.start) // store.step - 1)))
+        self.assertAlmostEqual(store.twa(a, c), (w1 + w2) / (t1 + t2), 12)
+        self.assertAlmostEqual(store.twa(a, c),
+            (store.twa(a, gap_start) * t1 + store.twa(gap_end, c) * t2)
+            / (t1 + t2), 12)
+
+
+class TestPipeline(unittest.TestCase):
+
+
+    def test_stages(self):
+        """ prefetch keeps order and passes errors on; a
+        ThreadedWriter writes everything, in order, by close.
+        """
+        self.assertEqual(list(stream_data.prefetch(iter(range(100)), 3)),
+            range(100))
+
+        def failing():
+            yield 1
+            raise ValueError("bad block")
+        items = stream_data.prefetch(failing())
+        self.assertEqual(next(items), 1)
+        self.assertRaises(ValueError, next, items)
+
+        out = cStringIO.StringIO()
+        writer = stream_data.ThreadedWriter(out, chunk_size=10,
+            max_blocks=2)
+        for i in range(1000):
+            writer.write("%i\n" % i)
+        writer.close()
+        self.assertEqual(out.getvalue(), "".join("%i\n" % i
+            for i in range(1000)))
+
+
+    def test_matches_serial(self):
+        """ Pipelined runs give the serial output, in both modes and
+        with symbols.
+        """
+        with open(DATA_FNAME, "rb") as f:
+            f.readline()
+            data = f.read()
+        symbols = "".join("%s,%s\n" % ("ab"[i // 2 % 3 == 0], line)
+            for i, line in enumerate(data.splitlines()))
+
+        for text, symbol_field in ((data, None), (symbols, 0)):
+            for integer in (False, True):
+                outs = []
+                for pipeline in (False, True):
+                    buf = cStringIO.StringIO()
+                    sink = sinks.Sink(stream_data.ThreadedWriter(buf)
+                        if pipeline else buf)
+                    time_weight.compute_twa(io.BytesIO(text),
+                        chunk_size=4096, symbol_field=symbol_field,
+                        integer=integer, out=sink, pipeline=pipeline)
+                    sink.flush()
+                    if pipeline:
+                        sink.out.close()
+                    outs.append(buf.getvalue())
+                self.assertTrue(outs[0].count("\n") > 1000)
+                self.assertEqual(outs[0], outs[1])
+
+
+
+class TestIngestServer(unittest.TestCase):
+
+
+    def setUp(self):
+        with open(DATA_FNAME, "rb") as f:
+            f.readline()
+            self.lines = f.read().splitlines()[:3000]
+        self.records = [[int(ts), side, float(price)]
+            for ts, side, price in (line.split(",") for line in self.lines)]
+
+
+    def test_backpressure(self):
+        """ Reading stops with too many records waiting, and starts
+        again once the engine has taken half of them.
+        """
+        server = stream_server.IngestServer(port=0,
+            instruments=time_weight.Instruments(
+                out=sinks.Sink(cStringIO.StringIO())),
+            max_pending=1000)
+        try:
+            records = [(None,) + tuple(r) for r in self.records]
+            server.feed(records[:600])
+            self.assertFalse(server.paused)
+            server.feed(records[600:1200])
+            self.assertTrue(server.paused)
+            server.drain(100)
+            self.assertTrue(server.paused)
+            self.assertEqual(server.n_pending, 600)
+            server.drain(100)
+            self.assertFalse(server.paused)
+        finally:
+            server.close()
+
+
+    def test_ack_after_engine(self):
+        """ Frames are acked once their records are through the engine,
+        not when they are read.
+        """
+        acked = []
+
+        class Connection(object):
+            ack = acked.append
+
+        server = stream_server.IngestServer(port=0,
+            instruments=time_weight.Instruments(
+                out=sinks.Sink(cStringIO.StringIO())))
+        try:
+            records = [(None,) + tuple(r) for r in self.records]
+            server.feed(records[:100], Connection(), 1)
+            server.feed(records[100:200])
+            server.feed(records[200:300], Connection(), 3)
+            self.assertEqual(acked, [])
+            server.drain(150)
+            self.assertEqual(acked, [1])
+            server.drain(None)
+            self.assertEqual(acked, [1, 3])
+        finally:
+            server.close()
+
+
+    def test_serve(self):
+        """ Records from several connections, in json frames of many
+        records and of one and in binary frames, give each symbol the
+        output of twa_live.
+        """
+        buf = cStringIO.StringIO()
+        server = stream_server.IngestServer(port=0,
+            instruments=time_weight.Instruments(out=sinks.Sink(buf)),
+            max_pending=500)
+        thread = threading.Thread(target=server.serve_until_stopped,
+            args=(0.01,))
+        thread.start()
+
+        def frame(obj):
+            data = json.dumps(obj)
+            return struct.pack(">L", len(data)) + data
+
+        try:
+            conns = []
+            conn = socket.create_connection(server.address)
+            for i in range(0, len(self.records), 64):
+                conn.sendall("".join(frame([["a"] + r
+                    for r in self.records[i:i + 64]])))
+            conns.append(conn)
+            conn = socket.create_connection(server.address)
+            for i in range(0, len(self.records), 256):
+                data = stream_server.encode_frame([("b",) + tuple(r)
+                    for r in self.records[i:i + 256]])
+                conn.sendall(struct.pack(">L", len(data)) + data)
+            conns.append(conn)
+            conn = socket.create_connection(server.address)
+            conn.sendall("".join(frame(r) for r in self.records))
+            conns.append(conn)
+            for conn in conns:
+                conn.close()
+
+            deadline = time.time() + 10
+            while (server.n_records < 3 * len(self.records)
+                    and time.time() < deadline):
+                time.sleep(0.01)
+        finally:
+            server.stop()
+            thread.join()
+
+        expected = cStringIO.StringIO()
+        time_weight.twa_live(iter(self.lines), ",",
+            instruments=time_weight.Instruments(out=sinks.Sink(expected)))
+        expected = expected.getvalue()
+        self.assertTrue(expected.count("\n") > 40)
+
+        lines = buf.getvalue().splitlines(True)
+        for symbol in ("a", "b"):
+            self.assertEqual("".join(line.split(",", 1)[1]
+                for line in lines if line.startswith(symbol + ",")),
+                expected)
+        self.assertEqual("".join(line for line in lines
+            if line[0].isdigit()), expected)
+
+
+
+class TestPublisher(unittest.TestCase):
+    """ Tests for fanning the server's output out to subscribers."""
+
+    def test_fan_out(self):
+        """ Subscribers over TCP and a unix socket each get the output
+        the server writes.
+        """
+        with open(DATA_FNAME, "rb") as f:
+            f.readline()
+            lines = f.read().splitlines()[:2000]
+        tmp = tempfile.mkdtemp()
+        buf = cStringIO.StringIO()
+        sockets = {}
+        publisher = stream_server.Publisher(sockets, buf)
+        address = publisher.listen(("localhost", 0))
+        path = publisher.listen(os.path.join(tmp, "twa.sock"))
+        server = stream_server.IngestServer(port=0,
+            instruments=time_weight.Instruments(
+                out=sinks.Sink(publisher)), map=sockets)
+        thread = threading.Thread(target=server.serve_until_stopped,
+            args=(0.01,))
+        thread.start()
+        try:
+            subscribers = [socket.create_connection(address),
+                socket.socket(socket.AF_UNIX)]
+            subscribers[1].connect(path)
+            deadline = time.time() + 10
+            while len(publisher.subscribers) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+
+            client = stream_client.ProducerClient(*server.address)
+            for line in lines:
+                ts, side, price = line.split(",")
+                client.send(None, int(ts), side, float(price))
+            client.close()
+        finally:
+            server.stop()
+            thread.join()
+            output = buf.getvalue()
+            publisher.close()
+        self.assertFalse(os.path.exists(path))
+        shutil.rmtree(tmp)
+
+        expected = cStringIO.StringIO()
+        time_weight.twa_live(iter(lines), ",",
+            instruments=time_weight.Instruments(out=sinks.Sink(expected)))
+        self.assertEqual(output, expected.getvalue())
+        for subscriber in subscribers:
+            data = []
+            while not data or data[-1]:
+                data.append(subscriber.recv(65536))
+            subscriber.close()
+            self.assertEqual("".join(data), expected.getvalue())
+
+
+    def test_slow_subscriber(self):
+        """ A subscriber too far behind has its output dropped, or is
+        disconnected, and the others go on getting theirs.
+        """
+        for policy in stream_server.SLOW_POLICIES:
+            publisher = stream_server.Publisher({}, max_bytes=100,
+                policy=policy)
+            address = publisher.listen(("localhost", 0))
+            peers = []
+            try:
+                subscribers = []
+                for _ in range(2):
+                    peers.append(socket.create_connection(address))
+                    publisher.listeners[0].handle_accept()
+                    subscribers.append(list(publisher.subscribers - set(
+                        subscribers))[0])
+                publisher.write("x" * 60)
+                # the first one is sent its output, the second isn't
+                subscribers[0].handle_write()
+                publisher.write("y" * 60)
+
+                self.assertEqual(subscribers[0].size, 60)
+                if policy == "drop":
+                    self.assertEqual(subscribers[1].size, 60)
+                    self.assertEqual(subscribers[1].dropped, 1)
+                    self.assertEqual(len(publisher.subscribers), 2)
+                else:
+                    self.assertEqual(publisher.subscribers,
+                        set(subscribers[:1]))
+            finally:
+                publisher.close()
+                for peer in peers:
+                    peer.close()
+
+
+
+class TestFrameCodec(unittest.TestCase):
+    """ Tests for binary record frames."""
+
+    def test_round_trip(self):
+
+        records = [("EURUSD", 1469404800000000, ":a", 1.1),
+            ("GBPUSD", 1469404800000001, ":b", 1.3),
+            ("EURUSD", 1469404800000002, ":b", 1.05)]
+        data = stream_server.encode_frame(records)
+        self.assertEqual(stream_server.decode_frame(data), records)
+        # a symbol table of two names, 3 records and their indexes
+        self.assertEqual(len(data), stream_server.FRAME_HEADER.size
+            + 14 + 3 * (stream_server.RECORD_SIZE + 2))
+
+        records = [(None,) + record[1:] for record in records]
+        self.assertEqual(stream_server.decode_frame(
+            stream_server.encode_frame(records)), records)
+        self.assertEqual(stream_server.decode_frame(
+            stream_server.encode_frame([])), [])
+        # json frames still decode the same
+        self.assertEqual(stream_server.decode_frame(
+            json.dumps([list(record[1:]) for record in records])), records)
+
+
+    def test_bad_frames(self):
+
+        records = [("EURUSD", 1469404800000000, ":a", 1.1)]
+        self.assertRaises(stream_server.FrameError,
+            stream_server.encode_frame, records + [(None, 0, ":b", 1.0)])
+        self.assertRaises(stream_server.FrameError,
+            stream_server.encode_frame, [(None, 0, "x", 1.0)])
+
+        data = stream_server.encode_frame(records)
+        side = stream_server.FRAME_HEADER.size + 7 + 8
+        self.assertEqual(data[side], "a")
+        for bad in (data[:-1], data + "\0", data[:8],
+                data[:4] + "\x02" + data[5:],
+                data[:side] + "c" + data[side + 1:]):
+            self.assertRaises(stream_server.FrameError,
+                stream_server.decode_frame, bad)
+
+
+
+class TestProducerClient(unittest.TestCase):
+    """ Tests for the producer client of the ingestion server."""
+
+    def test_send(self):
+        """ Records sent in batches by count and by time all reach the
+        engine, in order per symbol.
+        """
+        with open(DATA_FNAME, "rb") as f:
+            f.readline()
+            lines = f.read().splitlines()[:2000]
+        buf = cStringIO.StringIO()
+        server = stream_server.IngestServer(port=0,
+            instruments=time_weight.Instruments(out=sinks.Sink(buf)))
+        thread = threading.Thread(target=server.serve_until_stopped,
+            args=(0.01,))
+        thread.start()
+        try:
+            client = stream_client.ProducerClient(*server.address,
+                connections=3, batch_records=300, max_delay=0.01)
+            for line in lines:
+                ts, side, price = line.split(",")
+                for symbol in ("a", "b", "c"):
+                    client.send(symbol, int(ts), side, float(price))
+            time.sleep(0.05)
+            client.close()
+            self.assertEqual(client.n_records, 3 * len(lines))
+            self.assertTrue(client.n_frames > 3 * len(lines) // 300)
+        finally:
+            server.stop()
+            thread.join()
+        self.assertEqual(server.n_records, 3 * len(lines))
+
+        expected = cStringIO.StringIO()
+        time_weight.twa_live(iter(lines), ",",
+            instruments=time_weight.Instruments(out=sinks.Sink(expected)))
+        output = buf.getvalue().splitlines(True)
+        for symbol in ("a", "b", "c"):
+            self.assertEqual("".join(line.split(",", 1)[1]
+                for line in output if line.startswith(symbol + ",")),
+                expected.getvalue())
+
+
+    def test_send_outside_lock(self):
+        """ A send waiting for its ack holds only its connection, not
+        the client.
+        """
+        listener = socket.socket()
+        listener.bind(("localhost", 0))
+        listener.listen(5)
+        accepted = []
+        thread = threading.Thread(
+            target=lambda: accepted.append(listener.accept()[0]))
+        thread.start()
+        client = stream_client.ProducerClient(*listener.getsockname(),
+            connections=1, batch_records=1, max_delay=None, max_unacked=0,
+            timeout=5)
+        thread.join()
+        sender = threading.Thread(target=client.send,
+            args=("a", 1, ":a", 1.5))
+        try:
+            sender.start()
+            data = ""
+            while len(data) < 4:
+                data += accepted[0].recv(65536)
+            self.assertTrue(sender.is_alive())
+            self.assertTrue(client.lock.acquire(False))
+            client.lock.release()
+            accepted[0].sendall(stream_server.ACK.pack(1))
+            sender.join()
+            self.assertEqual(client.n_frames, 1)
+        finally:
+            client.close()
+            accepted[0].close()
+            listener.close()
+
+
+    def test_resend(self):
+        """ A frame the server didn't ack goes again over a new
+        connection.
+        """
+        listener = socket.socket()
+        listener.bind(("localhost", 0))
+        listener.listen(5)
+        frames = []
+
+        def read_frame(sock):
+            data = ""
+            while len(data) < 4 or len(data) < 4 + struct.unpack(
+                    ">L", data[:4])[0]:
+                data += sock.recv(65536)
+            return data
+
+        def serve():
+            first, _ = listener.accept()
+            read_frame(first)
+            first.close()
+            second, _ = listener.accept()
+            frames.append(read_frame(second))
+            second.sendall(stream_server.ACK.pack(1))
+            second.recv(1)
+            second.close()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        connection = stream_client.Connection(listener.getsockname(), 5)
+        try:
+            frame = stream_server.pack_frame([("a", 1, ":a", 1.5)],
+                stream_server.ACK_REQUEST)
+            connection.send(frame)
+            connection.wait()
+            self.assertEqual(len(connection.unacked), 0)
+        finally:
+            connection.close()
+            thread.join()
+            listener.close()
+        self.assertEqual(frames, [frame])
+        self.assertTrue(stream_server.wants_ack(frame[4:]))
+
+
+
+class TestReorderBuffer(unittest.TestCase):
+    """ Tests for putting slightly out of order input back in order."""
+
+    def test_push(self):
+
+        buf = time_weight.ReorderBuffer(10, lambda r: r[0])
+        self.assertEqual(buf.push((100, "a")), [])
+        self.assertEqual(buf.push((120, "b")), [(100, "a")])
+        self.assertEqual(buf.push((115, "c")), [])
+        self.assertEqual(buf.push((120, "d")), [])
+        self.assertEqual(buf.push((131, "e")), [(115, "c"), (120, "b"),
+            (120, "d")])
+
+        # older than what was released already
+        self.assertEqual(buf.push((119, "f")), [])
+        self.assertEqual(buf.late, 1)
+        self.assertEqual(buf.drain(), [(131, "e")])
+
+
+    def test_reorder_lines(self):
+        """ Output for shuffled input matches the ordered input."""
+        file_ = open(DATA_FNAME, "rb")
+        file_.readline()
+        lines = file_.read().splitlines()
+        file_.close()
+
+        groups = []
+        for line in lines:
+            if groups and groups[-1][0].split(",")[0] == line.split(",")[0]:
+                groups[-1].append(line)
+            else:
+                groups.append([line])
+        for i in range(0, len(groups) - 1, 5):
+            groups[i], groups[i + 1] = groups[i + 1], groups[i]
+        shuffled = sum(groups, [])
+        self.assertNotEqual(shuffled, lines)
+
+        expected = capture_stdout(time_weight.compute_twa, iter(lines))
+        buf = time_weight.line_reorder(100000)
+        s = capture_stdout(time_weight.compute_twa,
+            buf.reorder(iter(shuffled)))
+        self.assertEqual(s, expected)
+        self.assertEqual(buf.late, 0)
+
+        symbols = ["X," + line for line in shuffled]
+        buf = time_weight.line_reorder(100000, symbol_field=0)
+        self.assertEqual(list(buf.reorder(iter(symbols))),
+            ["X," + line for line in lines])
+
+
+class TestSinks(unittest.TestCase):
+    """ Tests for output encoders and flush policies."""
+
+    def test_encoders(self):
+
+        csv = sinks.CsvEncoder()
+        self.assertEqual(csv.encode(None, 1000000, "0.5"), "1000000,0.5\n")
+        self.assertEqual(csv.encode("X", 1000000, "0.5"), "X,1000000,0.5\n")
+
+        line = sinks.JsonEncoder().encode("X", 1000000, "-0.00001000")
+        self.assertEqual(json.loads(line),
+            {"symbol": "X", "ts": 1000000, "twa": -0.00001})
+
+        binary = sinks.BinaryEncoder()
+        self.assertEqual(
+            binary.RECORD.unpack(binary.encode(None, 7, "0.25")), (7, 0.25))
+        symbol, ts, twa = binary.SYMBOL_RECORD.unpack(
+            binary.encode("X", 7, "0.25"))
+        self.assertEqual((symbol.rstrip("\0"), ts, twa), ("X", 7, 0.25))
+        symbol, _, _ = binary.SYMBOL_RECORD.unpack(
+            binary.encode("X" * 16, 7, "0.25"))
+        self.assertEqual(symbol, "X" * 16)
+        self.assertRaises(ValueError, binary.encode, "X" * 17, 7, "0.25")
+
+
+    def test_flush_policy(self):
+
+        class Counting(object):
+            def __init__(self):
+                self.writes = []
+            def write(self, data):
+                self.writes.append(data)
+            def flush(self):
+                pass
+
+        out = Counting()
+        sink = sinks.Sink(out, max_records=3)
+        for i in range(7):
+            sink.record(None, i, "0.1")
+        self.assertEqual(len(out.writes), 2)
+        sink.flush()
+        self.assertEqual(len(out.writes), 3)
+        self.assertEqual("".join(out.writes),
+            "".join("%i,0.1\n" % i for i in range(7)))
+
+        out = Counting()
+        sink = sinks.Sink(out, max_bytes=20)
+        for i in range(4):
+            sink.record(None, i, "0.1")
+        self.assertEqual(out.writes, ["0,0.1\n1,0.1\n2,0.1\n3,0.1\n"])
+
+        out = Counting()
+        sink = sinks.Sink(out)
+        sink.record(None, 1, "0.1")
+        self.assertEqual(out.writes, ["1,0.1\n"])
+
+        # an interval is also checked on polls, with no new records
+        out = Counting()
+        sink = sinks.Sink(out, interval=60.0)
+        sink.record(None, 1, "0.1")
+        sink.poll()
+        self.assertEqual(out.writes, [])
+        sink.last_flush -= 60.0
+        sink.poll()
+        self.assertEqual(out.writes, ["1,0.1\n"])
+
+        self.assertRaises(ValueError, sinks.Sink, out, "xml")
+
+
+    GAP_LINES = [
+        "1000000,:a,2", "1000000,:b,1", "2500000,:a,3", "2500000,:b,1",
+        "3200000,:a,2", "3200000,:b,1", "9500000,:a,2", "9500000,:b,1",
+        "10500000,:a,4", "10500000,:b,1", "12500000,:a,2", "12500000,:b,1",
+        "13500000,:a,2", "13500000,:b,1"]
+
+    def test_compact_gaps(self):
+
+        dense = capture_stdout(time_weight.compute_twa, iter(self.GAP_LINES))
+        self.assertEqual(len(dense.splitlines()), 12)
+
+        out = cStringIO.StringIO()
+        time_weight.compute_twa(iter(self.GAP_LINES),
+            out=sinks.Sink(out, compact=True))
+        compact = out.getvalue()
+        self.assertEqual(len(compact.splitlines()), 8)
+        self.assertIn("4000000:9000000,1.50000000\n", compact)
+
+        out = cStringIO.StringIO()
+        time_weight.compute_twa(iter(self.GAP_LINES), integer=True,
+            out=sinks.Sink(out, compact=True))
+        self.assertEqual(out.getvalue(), compact)
+
+        self.assertRaises(ValueError, sinks.Sink, out, "binary",
+            compact=True)
+
+        if numpy is not None:
+            self.assertEqual(sinks.expand_gaps(compact), dense)
+            symbols = "".join("X," + line + "\n"
+                for line in compact.splitlines())
+            self.assertEqual(sinks.expand_gaps(symbols),
+                "".join("X," + line + "\n" for line in dense.splitlines()))
+
+
+    @unittest.skipIf(numpy is None, "expand_gaps needs numpy")
+    def test_compact_gaps_json(self):
+        """ expand_gaps(format="json") gives back the dense json."""
+        out = cStringIO.StringIO()
+        time_weight.compute_twa(iter(self.GAP_LINES),
+            out=sinks.Sink(out, "json"))
+        dense = out.getvalue()
+        out = cStringIO.StringIO()
+        time_weight.compute_twa(iter(self.GAP_LINES),
+            out=sinks.Sink(out, "json", compact=True))
+        compact = out.getvalue()
+        self.assertIn('"until": 9000000', compact)
+        self.assertEqual(sinks.expand_gaps(compact, format="json"), dense)
+
+        encoder = sinks.JsonEncoder()
+        compact = (encoder.encode("X,\"Y", 1000000, "1.5")
+            + encoder.encode_range("X,\"Y", 2000000, 4000000, "2.25"))
+        self.assertEqual(sinks.expand_gaps(compact, format="json"),
+            encoder.encode("X,\"Y", 1000000, "1.5")
+            + encoder.encode("X,\"Y", 2000000, "2.25")
+            + encoder.encode("X,\"Y", 3000000, "2.25"))
+        self.assertRaises(ValueError, sinks.expand_gaps, compact,
+            format="binary")
+
+
+    def test_buffered_matches(self):
+        """ Buffered output is the same bytes as write-through."""
+        file_ = open(DATA_FNAME, "rb")
+        file_.readline()
+        lines = file_.read().splitlines()
+        file_.close()
+
+        expected = capture_stdout(time_weight.compute_twa, iter(lines))
+        out = cStringIO.StringIO()
+        sink = sinks.Sink(out, max_records=64)
+        time_weight.compute_twa(iter(lines), out=sink)
+        sink.flush()
+        self.assertEqual(out.getvalue(), expected)
+
+
+@unittest.skipIf(numpy is None, "batch mode needs numpy")
+class TestBatchWeight(unittest.TestCase):
+
+    def test_matches_streaming(self):
+        """ Batch engine gives byte-identical output to the
+        streaming engine on the sample data.
+        """
+        for fname in (TEST_DATA_FNAME, DATA_FNAME):
+            file_ = open(fname, "rb")
+            file_.readline()
+            expected = capture_stdout(time_weight.compute_twa, file_)
+            file_.seek(0)
+            file_.readline()
+            s = capture_stdout(batch_weight.compute_twa_batch, file_)
+            file_.close()
+            self.assertTrue(len(expected))
+            self.assertEqual(s, expected)
+
+    def test_gaps_and_whole_seconds(self):
+        """ Gap seconds and quotes landing exactly on a whole
+        second are handled as TimeCache does.
+        """
+        data = (
+            "800200000,:b,1.50\n800200000,:a,1.60\n"
+            "800600000,:b,1.75\n800600000,:a,1.95\n"
+            "801000000,:b,1.75\n801000000,:a,1.85\n"
+            "801500000,:b,1.80\n801500000,:a,1.90\n"
+            "803300000,:b,1.13\n803300000,:a,1.28\n"
+            "804200000,:b,1.01\n804200000,:a,1.11\n"
+            "806000000,:b,1.01\n806000000,:a,1.12\n")
+        expected = capture_stdout(time_weight.compute_twa,
+            cStringIO.StringIO(data))
+        s = capture_stdout(batch_weight.compute_twa_batch,
+            cStringIO.StringIO(data))
+        self.assertEqual(s, expected)
+        self.assertEqual(len(s.splitlines()), 6)
+
+
+
+def mixed_symbol_lines(symbols, fname=DATA_FNAME):
+    """ Interleave the records in fname under several symbol names,
+    with the symbol as the first field.
+    """
+    file_ = open(fname, "rb")
+    file_.readline()
+    lines = file_.read().splitlines()
+    file_.close()
+    return lines, [s + "," + line for line in lines for s in symbols]
+
+
+class TestParallelWeight(unittest.TestCase):
+
+    SYMBOLS = ("EURUSD", "USDJPY", "GBPUSD", "AUDUSD", "USDCHF")
+
+    def test_partitioned(self):
+        """ Partitioned run gives every instrument the same output
+        as a serial run, merged in time order per batch.
+        """
+        lines, mixed = mixed_symbol_lines(self.SYMBOLS)
+        single = capture_stdout(time_weight.compute_twa, iter(lines))
+
+        s = capture_stdout(parallel_weight.compute_twa_partitioned,
+            iter(mixed), symbol_field=0, jobs=3, batch_size=1000)
+        out = s.splitlines()
+        self.assertEqual(len(out), len(self.SYMBOLS) * len(single.splitlines()))
+        for symbol in self.SYMBOLS:
+            self.assertEqual(
+                [l for l in out if l.startswith(symbol + ",")],
+                [symbol + "," + l for l in single.splitlines()])
+
+        # a single batch comes out fully sorted by time
+        s = capture_stdout(parallel_weight.compute_twa_partitioned,
+            iter(mixed), symbol_field=0, jobs=2, batch_size=len(mixed))
+        ts = [int(l.split(",")[1]) for l in s.splitlines()]
+        self.assertEqual(ts, sorted(ts))
+
+    def test_partitioned_order(self):
+        """ Output is in time order across blocks too, with a sparse
+        symbol whose gap is only filled in many blocks later, for
+        lines and for a stream read in blocks.
+        """
+        lines = []
+        for i in range(200):
+            ts = 1000000000 + i * 300000
+            lines += ["DENSE,%i,:a,1.%i" % (ts, 5 + i % 3),
+                "DENSE,%i,:b,1.1" % ts]
+            if i in (1, 5, 150):
+                lines += ["SPARSE,%i,:a,2.5" % ts, "SPARSE,%i,:b,2.0" % ts]
+        serial = capture_stdout(time_weight.compute_twa, iter(lines),
+            symbol_field=0).splitlines()
+
+        for f in (iter(lines),
+                cStringIO.StringIO("\n".join(lines) + "\n")):
+            s = capture_stdout(parallel_weight.compute_twa_partitioned,
+                f, symbol_field=0, jobs=2, chunk_size=200, batch_size=10)
+            out = s.splitlines()
+            ts = [int(l.split(",")[1]) for l in out]
+            self.assertEqual(ts, sorted(ts))
+            self.assertEqual(sorted(out), sorted(serial))
+        # the serial run writes the sparse gap late
+        ts = [int(l.split(",")[1]) for l in serial]
+        self.assertNotEqual(ts, sorted(ts))
+
+    def test_sharded(self):
+        """ Time-sharded replay is byte-identical to a serial run,
+        for any number of shards.
+        """
+        file_ = open(DATA_FNAME, "rb")
+        file_.readline()
+        expected = capture_stdout(time_weight.compute_twa, file_)
+        file_.close()
+
+        for n_shards in (1, 2, 7, 40):
+            s = capture_stdout(parallel_weight.compute_twa_sharded,
+                DATA_FNAME, header=True, jobs=2, n_shards=n_shards)
+            self.assertEqual(s, expected)
+
+
+
+class TestTickFormat(unittest.TestCase):
+
+    def setUp(self):
+        file_ = open(DATA_FNAME, "rb")
+        file_.readline()
+        self.lines = file_.read().splitlines()
+        file_.close()
+
+        self.ticks = cStringIO.StringIO()
+        n = tick_format.convert(iter(self.lines), self.ticks)
+        self.assertEqual(n, len(self.lines))
+
+        fd, self.tick_fname = tempfile.mkstemp(suffix=".ticks")
+        os.write(fd, self.ticks.getvalue())
+        os.close(fd)
+
+        self.expected = capture_stdout(time_weight.compute_twa,
+            iter(self.lines))
+
+    def tearDown(self):
+        os.remove(self.tick_fname)
+
+    def test_round_trip(self):
+        """ Records come back as the text parser would see them."""
+        self.assertEqual(len(self.ticks.getvalue()),
+            len(tick_format.MAGIC) + len(self.lines) * 17)
+
+        self.ticks.seek(0)
+        records = list(tick_format.stream_records(self.ticks))
+        self.assertEqual(records, list(
+            tick_format.mmap_records(self.tick_fname)))
+        for line, record in zip(self.lines, records):
+            ts, side, price = line.split(",")
+            self.assertEqual(record, (int(ts), side, float(price)))
+
+    def test_streaming(self):
+        """ Streaming engine gives the same output from tick files."""
+        self.ticks.seek(0)
+        s = capture_stdout(time_weight.twa_records,
+            tick_format.stream_records(self.ticks))
+        self.assertEqual(s, self.expected)
+
+    @unittest.skipIf(numpy is None, "batch mode needs numpy")
+    def test_batch(self):
+        """ Batch engine gives the same output from tick files."""
+        s = capture_stdout(batch_weight.compute_twa_batch_ticks,
+            None, self.tick_fname)
+        self.assertEqual(s, self.expected)
+
+    def test_truncated(self):
+        """ Partial trailing records are an error."""
+        data = self.ticks.getvalue()[:-3]
+        self.assertRaises(tick_format.TickFormatError, list,
+            tick_format.stream_records(cStringIO.StringIO(data)))
+
+    def test_bad_side(self):
+        """ A bad side byte is an error naming the record's offset,
+        from both readers.
+        """
+        data = self.ticks.getvalue()
+        offset = len(tick_format.MAGIC) + 5000 * 17
+        data = data[:offset + 8] + "x" + data[offset + 9:]
+        with open(self.tick_fname, "wb") as f:
+            f.write(data)
+        for records in (tick_format.stream_records(cStringIO.StringIO(data)),
+                tick_format.mmap_records(self.tick_fname)):
+            with self.assertRaises(tick_format.TickFormatError) as cm:
+                list(records)
+            self.assertIn("at byte %i" % offset, str(cm.exception))
+
+    def test_short_stream(self):
+        """ Records read in with the header are not lost."""
+        data = self.ticks.getvalue()[:len(tick_format.MAGIC) + 2 * 17]
+        self.assertEqual(len(list(
+            tick_format.stream_records(cStringIO.StringIO(data)))), 2)
+
+
+
+class TestShmRing(unittest.TestCase):
+    """ Tests for the shared memory ring transport."""
+
+    def setUp(self):
+        with open(DATA_FNAME, "rb") as f:
+            f.readline()
+            self.lines = f.read().splitlines()
+        self.records = [(int(ts), side, float(price))
+            for ts, side, price in (line.split(",") for line in self.lines)]
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "twa.ring")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _produce(self, sizes):
+        """ Write the records from a thread, in batches of sizes in
+        turn.
+        """
+        def produce():
+            ring = shm_ring.RingWriter(self.path)
+            i = 0
+            try:
+                while i < len(self.records):
+                    n = sizes[i % len(sizes)]
+                    ring.write(self.records[i:i + n])
+                    i += n
+            finally:
+                ring.close()
+        thread = threading.Thread(target=produce)
+        thread.start()
+        return thread
+
+    def test_round_trip(self):
+        """ Records come out in order through a ring much smaller than
+        the input, written a few or many at a time.
+        """
+        ring = shm_ring.RingReader(self.path, capacity=100)
+        thread = self._produce([1, 2, 7, 250])
+        try:
+            records = list(ring.records())
+        finally:
+            thread.join()
+            ring.close()
+        self.assertEqual(records, self.records)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_streaming(self):
+        """ Streaming engine gives the same output from a ring."""
+        expected = capture_stdout(time_weight.compute_twa, iter(self.lines))
+        ring = shm_ring.RingReader(self.path)
+        thread = self._produce([2])
+        try:
+            s = capture_stdout(time_weight.twa_records, ring.records())
+        finally:
+            thread.join()
+            ring.close()
+        self.assertEqual(s, expected)
+
+        # compute_twa creates the ring itself;  the producer waits for it
+        thread = self._produce([2])
+        try:
+            s = capture_stdout(time_weight.compute_twa, None,
+                ring=self.path)
+        finally:
+            thread.join()
+        self.assertEqual(s, expected)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_machine(self):
+        """ Rings refuse machines without x86 store ordering."""
+        machine = shm_ring.platform.machine
+        shm_ring.platform.machine = lambda: "aarch64"
+        try:
+            self.assertRaises(shm_ring.RingError, shm_ring.RingReader,
+                self.path)
+            self.assertRaises(shm_ring.RingError, shm_ring.RingWriter,
+                self.path, 0)
+        finally:
+            shm_ring.platform.machine = machine
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+
+class TestQuoteParser(unittest.TestCase):
+
+
+    def test_parse_lines(self):
+        """ Columns of a block, with any delimiter, and None for
+        blocks the line by line parser has to take.
+        """
+        lines = ["1469404799897461;:b;1.09684", "1469404799897461;:a;1.0969"]
+        timestamps, sides, prices = quote_parser.parse_lines(lines, ";")
+        self.assertEqual(timestamps, [1469404799897461] * 2)
+        self.assertEqual(sides, [quote_parser.BID, quote_parser.ASK])
+        self.assertEqual(prices, [1.09684, 1.0969])
+
+        _, _, prices = quote_parser.parse_lines(lines, ";",
+            time_weight.PRICE_SCALE)
+        self.assertEqual(prices, [109684000, 109690000])
+
+        for bad in (["1,:a,1.5", "1,:c,1.5"], ["1.5,:a,1.5"],
+                ["1,:a", "1.5,1,:b,1.6"], ["1,:a,1.5,2"]):
+            self.assertEqual(quote_parser.parse_lines(bad), None)
+
+        # blocks the single json read won't take go a column at a time
+        self.assertEqual(quote_parser.parse_lines(["1,:a,2", "1,:b,1.5"]),
+            ([1, 1], [quote_parser.ASK, quote_parser.BID], [2.0, 1.5]))
+        self.assertTrue(isinstance(
+            quote_parser.parse_lines(["1,:a,2"])[2][0], float))
+        for bad in (["1,:b5,1.5"], ["1,:a5,1.5"], ["1a,:b,1.5"],
+                ["1,:a,1.5", "1.5,:b,1.5"]):
+            self.assertEqual(quote_parser.parse_lines(bad), None)
+
+        # prices json won't read are left to float()
+        _, _, prices = quote_parser.parse_lines(["1,:a,1.", "1,:b,NaN"])
+        self.assertEqual(prices[0], 1.0)
+        self.assertTrue(prices[1] != prices[1])
+
+
+    def test_blocks_match_lines(self):
+        """ twa_blocks gives the output twa_single does, blocks the
+        bulk parser can't take included, in both modes.
+        """
+        with open(DATA_FNAME, "rb") as f:
+            f.readline()
+            lines = f.read().splitlines()[:3000]
+        lines[1500] = " " + lines[1500]
+        blocks = [lines[i:i + 700] for i in range(0, len(lines), 700)]
+
+        for integer in (False, True):
+            outs = []
+            for twa, stream in ((time_weight.twa_single, lines),
+                    (time_weight.twa_blocks, blocks)):
+                buf = cStringIO.StringIO()
+                twa(stream, ",", time_weight.new_caches(None, integer,
+                    out=sinks.Sink(buf)))
+                outs.append(buf.getvalue())
+            self.assertTrue(outs[0].count("\n") > 40)
+            self.assertEqual(outs[0], outs[1])
+
+
+
 class TestStreamData(unittest.TestCase):
 
     
@@ -213,6 +1663,82 @@ class TestStreamData(unittest.TestCase):
             line_ct += 1
         self.assertTrue(line_ct == 3)
 
+
+    def test_partial_reads(self):
+        """ Lines split across blocks and short reads (as from
+        a pipe or socket) are stitched back together.
+        """
+
+        class Trickle(object):
+            """ Returns at most 3 bytes per read."""
+            def __init__(self, data):
+                self.data = data
+            def read(self, n):
+                chunk, self.data = self.data[:3], self.data[3:]
+                return chunk
+
+        data = "1,:b,1.5\n1,:a,1.6\n\n2,:b,1.7"
+        lines = list(stream_data.stream(Trickle(data), chunk_size=4))
+        self.assertEqual(lines, ["1,:b,1.5", "1,:a,1.6", "", "2,:b,1.7"])
+
+        file_ = cStringIO.StringIO(data)
+        lines = list(stream_data.stream(file_, chunk_size=5))
+        self.assertEqual(lines, ["1,:b,1.5", "1,:a,1.6", "", "2,:b,1.7"])
+
+
+    def test_block_sizes(self):
+        """ Files opened with open_binary are read chunk_size bytes
+        at a time, not capped at the default buffer size.
+        """
+        chunk_size = 1 << 17
+        size = os.path.getsize(DATA_FNAME)
+        self.assertTrue(size > 2 * chunk_size)
+
+        with stream_data.open_binary(DATA_FNAME, chunk_size) as f:
+            read = stream_data.block_reader(f, chunk_size)
+            sizes = list(iter(lambda: len(read()), 0))
+        self.assertEqual(sum(sizes), size)
+        self.assertEqual(sizes[:-1], [chunk_size] * (len(sizes) - 1))
+
+
+    def test_compressed(self):
+        """ gzip and bz2 input (concatenated streams too) reads as
+        the plain text does, and plain input is left alone.
+        """
+        with open(TEST_DATA_FNAME, "rb") as f:
+            data = f.read()
+        half = len(data) // 2
+        gzip_ = lambda d: (lambda c: c.compress(d) + c.flush())(
+            zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS))
+
+        for compress in (gzip_, bz2.compress):
+            packed = compress(data[:half]) + compress(data[half:])
+            file_ = stream_data.open_input(
+                io.BufferedReader(io.BytesIO(packed)), chunk_size=7)
+            self.assertTrue(isinstance(file_,
+                stream_data.DecompressedStream))
+            self.assertEqual(file_.readline(), data.split("\n")[0] + "\n")
+            self.assertEqual(list(stream_data.stream(file_)),
+                list(stream_data.stream(io.BytesIO(data)))[1:])
+
+        file_ = io.BufferedReader(io.BytesIO(data))
+        self.assertTrue(stream_data.open_input(file_) is file_)
+
+
+    def test_mmap_stream(self):
+        """ Memory-mapped reader agrees with the block reader, and
+        honors the header flag.
+        """
+        file_ = open(TEST_DATA_FNAME, "rb")
+        expected = list(stream_data.stream(file_))
+        file_.close()
+
+        lines = list(stream_data.mmap_stream(TEST_DATA_FNAME))
+        self.assertEqual(lines, expected)
+
+        lines = list(stream_data.mmap_stream(TEST_DATA_FNAME, header=True))
+        self.assertEqual(lines, expected[1:])
+
     
     def test_generator(self):
         """ Run generator for a time period and count output.
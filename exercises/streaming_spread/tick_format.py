@@ -0,0 +1,259 @@
+"""
+Compact binary tick format:  an 8 byte magic header followed by
+fixed-width little endian records of
+
+    int64 timestamp (microseconds), side byte ('a' / 'b'),
+    float64 price
+
+with no padding (17 bytes per record).  Saves time_weight from
+parsing text on every record.
+
+Convert a csv file:
+
+python tick_format.py -1 -f data.csv -o data.ticks
+
+then use it anywhere a csv would go (the format is detected from
+the magic header):
+
+python time_weight.py -f data.ticks
+"""
+
+import io
+import mmap
+import optparse
+import os
+import struct
+import sys
+
+import stream_data
+
+
+MAGIC = "TWATICK\x01"
+
+RECORD = struct.Struct("<qcd")
+
+# records decoded per struct call
+BLOCK_RECORDS = 4096
+_BLOCK = struct.Struct("<" + "qcd" * BLOCK_RECORDS)
+
+# side byte <-> side field of the text format
+SIDES = {"a": ":a", "b": ":b"}
+SIDE_BYTES = {":a": "a", ":b": "b"}
+
+
+class TickFormatError(Exception):
+    """ For files that are not (or not entirely) tick records."""
+    pass
+
+
+def getopt(argv):
+
+    parser = optparse.OptionParser()
+
+    parser.add_option(
+        "-f", "--path",
+        default=None, dest="fname",
+        help="csv file to convert, otherwise stdin")
+    parser.add_option(
+        "-o", "--output",
+        default=None, dest="output",
+        help="tick file to write, otherwise stdout")
+    parser.add_option(
+        "-d", "--delimiter",
+        default=",", dest="delimiter",
+        help="field delimiter for input stream")
+    parser.add_option(
+        "-1", "--header",
+        default=False, dest="header",
+        action="store_true",
+        help="source has header line - discard")
+
+    options, _ = parser.parse_args()
+    return options
+
+
+def is_tick_file(f):
+    """ Check for the magic header without consuming input.
+    Inputs:
+        f: buffered stream with a 'peek' method (io.open)
+    Returns:
+        (bool) Yes if f holds tick records
+    """
+    return f.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+
+
+def _block_struct(n):
+    """ Struct for n records."""
+    if n == BLOCK_RECORDS:
+        return _BLOCK
+    return struct.Struct("<" + "qcd" * n)
+
+
+def _decode(data, offset):
+    """ Decode whole records into (ts, side, price) tuples, with
+    sides given as in the text format.
+    Inputs:
+        data: (str) whole records
+        offset: (int) byte offset of data in the file, for errors
+    """
+    flat = _block_struct(len(data) // RECORD.size).unpack(data)
+    return _records(flat, offset)
+
+
+def _records(flat, offset):
+    """ (ts, side, price) tuples from the flat fields of a block of
+    records starting at byte offset.
+    """
+    sides = flat[1::3]
+    try:
+        return zip(flat[0::3], [SIDES[s] for s in sides], flat[2::3])
+    except KeyError as e:
+        raise TickFormatError("bad side byte %r in the record at byte %i"
+            % (e.args[0], offset + sides.index(e.args[0]) * RECORD.size))
+
+
+def stream_records(f):
+    """ Record generator for tick files and streams, decoding a
+    block of records per struct call.
+    Inputs:
+        f: stream positioned at the magic header (works on
+            pipes, as stream_data.stream does)
+    Returns:
+        (ts microseconds, side, price) tuples
+    """
+    read = stream_data.block_reader(f, BLOCK_RECORDS * RECORD.size)
+
+    head = ""
+    while len(head) < len(MAGIC):
+        block = read()
+        if not block:
+            break
+        head += block
+    if head[:len(MAGIC)] != MAGIC:
+        raise TickFormatError("missing tick file header")
+
+    # records that came in with the header first
+    block = head[len(MAGIC):]
+    tail = ""
+    pos = len(MAGIC)
+    while block:
+        data = tail + block
+        whole = len(data) - len(data) % RECORD.size
+        for record in _decode(data[:whole], pos):
+            yield record
+        pos += whole
+        tail = data[whole:]
+        block = read()
+
+    if tail:
+        raise TickFormatError("truncated record at end of tick stream")
+
+
+def records_array_dtype():
+    """ numpy dtype of a tick record."""
+    import numpy as np
+    return np.dtype([("ts", "<i8"), ("side", "S1"), ("price", "<f8")])
+
+
+def records_array(fname):
+    """ Map a tick file as a read-only numpy structured array with
+    fields ts, side, price -- no copies, no parsing.
+    """
+    import numpy as np
+
+    dtype = records_array_dtype()
+    size = os.path.getsize(fname) - len(MAGIC)
+    if size % dtype.itemsize:
+        raise TickFormatError("%s is not a whole number of records"
+            % fname)
+    if not size:
+        return np.empty(0, dtype)
+    return np.memmap(fname, dtype=dtype, mode="r", offset=len(MAGIC))
+
+
+def mmap_records(fname):
+    """ Record generator over a memory-mapped tick file.  Records
+    are decoded straight out of the mapped pages with unpack_from,
+    a block at a time, without reading or slicing the file.
+    Inputs:
+        fname: path of a tick file
+    Returns:
+        (ts microseconds, side, price) tuples
+    """
+    with open(fname, "rb") as f:
+        if os.fstat(f.fileno()).st_size < len(MAGIC):
+            raise TickFormatError("missing tick file header in %s"
+                % fname)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mm[:len(MAGIC)] != MAGIC:
+            raise TickFormatError("missing tick file header in %s"
+                % fname)
+        if (len(mm) - len(MAGIC)) % RECORD.size:
+            raise TickFormatError("%s is not a whole number of records"
+                % fname)
+
+        pos = len(MAGIC)
+        while pos < len(mm):
+            n = min(BLOCK_RECORDS, (len(mm) - pos) // RECORD.size)
+            flat = _block_struct(n).unpack_from(mm, pos)
+            for record in _records(flat, pos):
+                yield record
+            pos += n * RECORD.size
+    finally:
+        mm.close()
+
+
+def convert(lines, out, delimiter=","):
+    """ Write csv ts,side,price records as tick records.
+    Inputs:
+        lines: iterator of csv lines, without header
+        out: writable binary stream
+        delimiter: field delimiter
+    Returns:
+        (int) number of records written
+    """
+    out.write(MAGIC)
+    n = 0
+    values = []
+    for line in lines:
+        if not line.strip():
+            continue
+        ts, side, price = line.strip().split(delimiter)
+        try:
+            side = SIDE_BYTES[side]
+        except KeyError:
+            raise TickFormatError("side must be :a or :b, not %s" % side)
+        values += (int(ts), side, float(price))
+        n += 1
+        if len(values) == 3 * BLOCK_RECORDS:
+            out.write(_BLOCK.pack(*values))
+            values = []
+    if values:
+        out.write(_block_struct(len(values) // 3).pack(*values))
+    return n
+
+
+def main(options):
+
+    if options.fname:
+        file_ = stream_data.open_binary(options.fname)
+    else:
+        file_ = stream_data.open_binary(sys.stdin.fileno(), closefd=False)
+
+    if options.header:
+        file_.readline()
+
+    if options.output:
+        out = io.open(options.output, "wb")
+    else:
+        out = io.open(sys.stdout.fileno(), "wb", closefd=False)
+
+    convert(stream_data.stream(file_), out, options.delimiter)
+    out.close()
+
+
+if __name__ == "__main__":
+
+    opts = getopt(sys.argv)
+    main(opts)
@@ -19,17 +19,23 @@ Brian Mack
 
 
 
-import io
+import heapq
 import logging
 import optparse
+import os
+import quote_parser
+import sinks
 import stream_data
 import sys
+import tick_format
+import time
 from math import floor
 
 
 # for floating point stability
 FLOAT_DIGITS = 8
-OUTPUT_FORMAT = "%i,%." + str(FLOAT_DIGITS) + "f\n"
+VALUE_FORMAT = "%." + str(FLOAT_DIGITS) + "f"
+OUTPUT_FORMAT = "%i," + VALUE_FORMAT + "\n"
 
 float_multiplier = 1
 
@@ -38,6 +44,33 @@ float_multiplier = 1
 microsec_to_sec = lambda x: x / 1000000.0
 sec_to_microsec = lambda x: x * 1000000.0
 
+# fixed point (integer mode):  timestamps stay in integer
+# microseconds, and prices are scaled to integers with as many
+# digits as the output has
+MICROSEC = 1000000
+PRICE_SCALE = 10 ** FLOAT_DIGITS
+FIXED_FORMAT = "%s%i.%0" + str(FLOAT_DIGITS) + "i"
+
+# quote sides as the bulk parser gives them, and their text
+ASK, BID = quote_parser.ASK, quote_parser.BID
+SIDE_CODES = quote_parser.SIDE_CODES
+
+
+def price_to_fixed(price):
+    """ Scale a price (str or float) to an integer number of
+    1 / PRICE_SCALE units.
+    """
+    return int(round(float(price) * PRICE_SCALE))
+
+
+def round_div(n, d):
+    """ Integer n / d (d > 0), rounded half away from zero like
+    the builtin round.
+    """
+    if n >= 0:
+        return (2 * n + d) // (2 * d)
+    return -((2 * -n + d) // (2 * d))
+
 
 
 def getopt(argv):
@@ -57,6 +90,122 @@ def getopt(argv):
         default=False, dest="header",
         action="store_true",
         help="source has header line - discard")
+    parser.add_option(
+        "-c", "--chunk-size",
+        default=stream_data.CHUNK_SIZE, dest="chunk_size",
+        type="int",
+        help="bytes per read from the input stream")
+    parser.add_option(
+        "-m", "--mmap",
+        default=False, dest="mmap",
+        action="store_true",
+        help="memory-map the file given by --path")
+    parser.add_option(
+        "-b", "--batch",
+        default=False, dest="batch",
+        action="store_true",
+        help="process the whole input at once (needs numpy)")
+    parser.add_option(
+        "-s", "--symbol-field",
+        default=None, dest="symbol_field",
+        type="int",
+        help="index of an instrument name field, for input "
+            "interleaving several instruments")
+    parser.add_option(
+        "-j", "--jobs",
+        default=1, dest="jobs",
+        type="int",
+        help="worker processes, partitioned by symbol if "
+            "--symbol-field is given, else by time (needs --path)")
+    parser.add_option(
+        "-i", "--integer",
+        default=False, dest="integer",
+        action="store_true",
+        help="integer microsecond timestamps and fixed point prices")
+    parser.add_option(
+        "-r", "--rollups",
+        default=None, dest="rollups",
+        help="comma separated window lengths to compute in one pass, "
+            "e.g. 100ms,1s,1m,1h (implies --integer)")
+    parser.add_option(
+        "--rollup-path",
+        default="twa_%s.csv", dest="rollup_path",
+        help="output file for each rollup window, %s is replaced by "
+            "the window length [default: %default]")
+    parser.add_option(
+        "--format",
+        default="csv", dest="format",
+        type="choice", choices=sorted(sinks.ENCODERS),
+        help="output encoding: csv, json (one object per line) or "
+            "binary (packed records) [default: %default]")
+    parser.add_option(
+        "--flush-records",
+        default=None, dest="flush_records",
+        type="int",
+        help="buffer output, writing every this many records")
+    parser.add_option(
+        "--flush-bytes",
+        default=None, dest="flush_bytes",
+        type="int",
+        help="buffer output, writing every this many bytes")
+    parser.add_option(
+        "--flush-interval",
+        default=None, dest="flush_interval",
+        type="float",
+        help="buffer output, writing every this many seconds (checked "
+            "as records come in, and on the clock with --live)")
+    parser.add_option(
+        "--compact-gaps",
+        default=False, dest="compact",
+        action="store_true",
+        help="write gaps of several seconds as one start:end range "
+            "record (csv / json; expand with sinks.py)")
+    parser.add_option(
+        "-l", "--live",
+        default=False, dest="live",
+        action="store_true",
+        help="close seconds on the wall clock too, so output keeps "
+            "coming while the input is idle")
+    parser.add_option(
+        "--lateness",
+        default=0.0, dest="lateness",
+        type="float",
+        help="with --live, seconds to wait past the end of a second "
+            "for its records [default: %default]")
+    parser.add_option(
+        "--store",
+        default=None, dest="store",
+        help="directory to keep prefix sums of the output in, for "
+            "averages over any window (see twa_store.py)")
+    parser.add_option(
+        "--checkpoint",
+        default=None, dest="checkpoint",
+        help="snapshot file to resume from, and to save state to as "
+            "the input is processed")
+    parser.add_option(
+        "--checkpoint-interval",
+        default=5.0, dest="checkpoint_interval",
+        type="float",
+        help="seconds between snapshots [default: %default]")
+    parser.add_option(
+        "--reorder-delay",
+        default=None, dest="reorder_delay",
+        type="float",
+        help="hold records this many seconds (of input time) to put "
+            "slightly out of order input back in order")
+    parser.add_option(
+        "-p", "--pipeline",
+        default=False, dest="pipeline",
+        action="store_true",
+        help="read, parse and write output on threads of their own, "
+            "overlapping with the averages")
+    parser.add_option(
+        "--ring",
+        default=None, dest="ring",
+        help="read tick records from a shared memory ring created at "
+            "this path, e.g. under /dev/shm (see shm_ring.py), rather "
+            "than a file or stdin;  x86 only, as the ring relies on its "
+            "memory ordering")
 
     options, _ = parser.parse_args()
     return options
@@ -91,6 +240,9 @@ class QuotePair(object):
     Functions like a very simple cache with only one method (add)
     """
 
+    # one instance per instrument, so keep them small
+    __slots__ = ("current_ts", "ask", "bid")
+
     def __init__(self):
         self.current_ts = None
         self.ask = None
@@ -100,16 +252,17 @@ class QuotePair(object):
     def _update_quote(self, side, price):
         """
         Inputs:
-            new: (bool) signals whether it's okay to overwrite a price
+            side: quote_parser.ASK or BID
+            price: quoted price
         """
         
-        if side == ":a":
+        if side == ASK:
             if self.ask is not None:
                 raise QuoteError("ask was already set at %.2f, "
                     "received %.2f" % (self.ask, price))
             self.ask = price
         
-        if side == ":b":
+        if side == BID:
             if self.bid is not None:
                 raise QuoteError("bid was already set at %.2f, "
                     "received %.2f" % (self.bid, price))
@@ -121,19 +274,41 @@ class QuotePair(object):
         self.bid = None
 
 
+    def get_state(self):
+        """ Open quote as a list, for checkpoints (see checkpoint.py)."""
+        return [self.current_ts, self.ask, self.bid]
+
+
+    def set_state(self, state):
+        self.current_ts, self.ask, self.bid = state
+
+
+    # accepted type of timestamps and prices
+    number = float
+
     def add(self, ts, side, price):
+        """ Take one quote, returning the spread once both sides of
+        a timestamp are in (None until then).
+        Inputs:
+            ts: timestamp
+            side: ':a' or ':b', or its code (quote_parser.ASK or BID)
+            price: quoted price
+        """
         
-        if not isinstance(ts, float):
-            raise InputError("QuotePair needs float value for timestamp, "
-                "not %s" % type(ts))
-
-        if side != ":a" and side != ":b":
-            raise InputError("QuotePair side must be :a or :b, not %s" 
-                % str(side))
+        if not isinstance(ts, self.number):
+            raise InputError("QuotePair needs %s value for timestamp, "
+                "not %s" % (self.number, type(ts)))
+
+        if side != ASK and side != BID:
+            try:
+                side = SIDE_CODES[side]
+            except (KeyError, TypeError):
+                raise InputError("QuotePair side must be :a or :b, not %s" 
+                    % str(side))
         
-        if not isinstance(price, float):
-            raise InputError("QuotePair needs float value for price, "
-                "not %s" % type(price))
+        if not isinstance(price, self.number):
+            raise InputError("QuotePair needs %s value for price, "
+                "not %s" % (self.number, type(price)))
 
         # first, is this a new timestamp? 
         if self.current_ts is None:
@@ -169,13 +344,39 @@ class QuotePair(object):
         return
 
 
+class FixedQuotePair(QuotePair):
+    """ QuotePair for integer mode:  integer microsecond timestamps
+    and fixed point prices (see price_to_fixed).
+    """
+
+    __slots__ = ()
+
+    number = (int, long)
+
+
 class TimeCache(object):
     """ This class handles time weighted averaging of quote pairs.
     It's job is to store data (sparsely) at 1-second intervals,
     as well as any partial data about the current second.
+
+    Partial data is kept as running sums (weighted spread and
+    elapsed time), so an open second takes constant memory no
+    matter how many records land in it.
     """
+
+    # one instance per instrument, so keep them small
+    __slots__ = ("archive", "last_spread", "n_open", "first_ts", "last_ts",
+        "spread", "weighted_sum", "time_sum", "symbol", "out", "store")
     
-    def __init__(self):
+    def __init__(self, symbol=None, out=None):
+        """
+        Inputs:
+            symbol: (str) instrument name, written as the first
+                column of each output line if given
+            out: sinks.Sink (or writable stream, wrapped in a
+                write-through csv Sink) for output, otherwise
+                sinks.STDOUT
+        """
         
         # will contain all whole-seconds in sorted order 
         # and weighted spreads
@@ -184,74 +385,113 @@ class TimeCache(object):
         # need to also store most recent given spread (not weighted)
         self.last_spread = None
         
-        # will contain partial data for leading edge of data stream
-        self.tmp_cache = []
+        # partial data for leading edge of data stream:  number of
+        # records, first / latest timestamp, latest spread, and the
+        # running sums of spread * duration and duration
+        self.n_open = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.spread = None
+        self.weighted_sum = 0.0
+        self.time_sum = 0.0
+
+        self.symbol = symbol
+        if out is None:
+            out = sinks.STDOUT
+        elif not isinstance(out, sinks.Sink):
+            out = sinks.Sink(out)
+        self.out = out
+
+        # twa_store.StoreWriter getting each closed second, if any
+        self.store = None
+
+    # accepted type of timestamps and spreads, its zero, and the
+    # length of a second in timestamp units
+    number = float
+    zero = 0.0
+    second = 1.0
+
+
+    def _floor(self, ts):
+        """ Start of the whole second containing ts."""
+        return floor(ts)
+
+
+    def _average(self):
+        """ Weighted spread over the closed second."""
+        return round(self.weighted_sum / self.time_sum, 8)
+
+
+    def _format(self, ts, spread):
+        """ Output record for one whole second:  timestamp in
+        microseconds, and the spread as decimal text.
+        """
+        return int(sec_to_microsec(ts)), VALUE_FORMAT % spread
+
+
+    def _on_close(self, next_start):
+        """ Called as a second closes, with running sums complete and
+        before the archive moves on to the second at next_start.
+        """
+        if self.store is not None:
+            self.store.merge(self.archive[-1][0] + self.second,
+                self.weighted_sum, self.time_sum, self.spread, next_start)
     
 
-    def _get_spreads_and_time_weights(self):
-        """ Collect spreads and their durations (in fractions of a 
-        second) for all elements in short term cache.  
-        
+    def _accumulate(self, spread, duration):
+        """ Add one segment (spread active for duration, in fractions
+        of a second) to the running sums for the open second.
+        """
+        self.weighted_sum += spread * duration
+        self.time_sum += duration
+
+
+    def _open_second(self, ts, spread):
+        """ Start the running sums for a new second with its first
+        record.
+
         For first data record (cold medium term cache),
         no spread is given for the partial second between record 1
         timestamp and floor(record 1 timestamp) ... (the nearest 
         previous whole second).  Excludes that from time weighting
-        of initial step.
-
-        For all records: weight spread by fraction of second 
-        during which spread was active.  A spread is 'active' 
-        from the time of the record to which it's attached
-        until the time of the next record.  If the next record is
-        in a new whole second, compute duration from the current
-        timestamp to the end of the current whole second.
+        of initial step.  Otherwise the previous spread is active
+        from the start of the second until this record.
         """
-
-        # initialize arrays
-        spreads = []
-        time_weights = []
-        
-        # don't use first segment in computation for this second
+        self.weighted_sum = self.time_sum = self.zero
         if self.last_spread is not None:
+            self._accumulate(self.last_spread, ts - self.archive[-1][0])
+
+        self.n_open = 1
+        self.first_ts = self.last_ts = ts
+        self.spread = spread
 
-            # if any time gap between last archive and first
-            # record in current cache, fill that in here
-            first_spread = self.last_spread
-            first_time = time_i = self.tmp_cache[0][0] - self.archive[-1][0]
-            spreads = [first_spread]
-            time_weights = [first_time]
-        i = 1
-
-        # fill out main part of arrays
-        while i < len(self.tmp_cache):
-            spread_i = self.tmp_cache[i-1][1]
-            time_i = (
-                self.tmp_cache[i][0] - 
-                self.tmp_cache[i-1][0])
-            spreads.append(spread_i)
-            time_weights.append(time_i)
-            i += 1
-        
-        # finally, handle any gaps between last record in cache
-        # and the next full second
-        spreads.append(self.tmp_cache[i-1][1])
-
-        time_weights.append(
-            self.archive[-1][0] + 
-            float_multiplier - 
-            self.tmp_cache[i-1][0])
-        
-        return spreads, time_weights
 
+    def _weight_time(self):
+        """ Close the open second:  the latest spread is active
+        until the end of the current whole second.  Returns the
+        time weighted spread, normalized for short seconds.
+        """
+        self._accumulate(self.spread,
+            self.archive[-1][0] + self.second * float_multiplier
+            - self.last_ts)
 
-    def _weight_time(self, spreads, time_weights):
+        return self._average()
 
-        twa = 0.0
-        time_sum = 0.0
-        for i in range(len(spreads)):
-            twa += spreads[i] * time_weights[i]
-            time_sum += time_weights[i]
 
-        return round(twa / time_sum, 8) # normalize for short seconds
+    def get_state(self):
+        """ Running state as lists and numbers, for checkpoints (see
+        checkpoint.py).  Taken between records, once log has run.
+        """
+        return [[list(record) for record in self.archive], self.last_spread,
+            self.n_open, self.first_ts, self.last_ts, self.spread,
+            self.weighted_sum, self.time_sum]
+
+
+    def set_state(self, state):
+        archive, self.last_spread, self.n_open, self.first_ts, \
+            self.last_ts, self.spread, self.weighted_sum, \
+            self.time_sum = state
+        self.archive = [tuple(record) for record in archive]
 
 
     def _get_last_archive_ts(self):
@@ -263,8 +503,8 @@ class TimeCache(object):
         """ Does special cache warming logic: We need one archive record
         containing the whole-second timestamp which is previous to the
         first record in our stream.  This will be used later in the 
-        time weighting step.  We also append the first record to the 
-        temporary store.
+        time weighting step.  We also open the current second with
+        the first record.
         Inputs:
             ts: (float) record timestamp
             spread: (float) spread at this timestamp
@@ -273,13 +513,13 @@ class TimeCache(object):
         """
         
         # fill if empty
-        if not len(self.tmp_cache):
-            self.tmp_cache.append((ts, spread))
+        if self.first_ts is None:
 
             # true for first ever record 
             if not len(self.archive):
-                self.archive = [(floor(ts), None)]
-                return 1
+                self.archive = [(self._floor(ts), None)]
+            self._open_second(ts, spread)
+            return 1
         else:
             return 0
    
@@ -296,15 +536,15 @@ class TimeCache(object):
             None -- updates archive and cache
         """
 
-        spreads, times = self._get_spreads_and_time_weights()
-        twa = self._weight_time(spreads, times)
-        archive_floor = floor(ts)
+        twa = self._weight_time()
+        archive_floor = self._floor(ts)
+        self._on_close(archive_floor)
         
         self.archive.append((archive_floor, twa))
-        self.last_spread = self.tmp_cache[-1][1]
+        self.last_spread = self.spread
 
         # start a new current time data section
-        self.tmp_cache = [(ts, spread)]
+        self._open_second(ts, spread)
 
     
     def add(self, ts, spread):
@@ -321,13 +561,13 @@ class TimeCache(object):
             that there are new, whole-second records to log.
         """
 
-        if not isinstance(ts, float):
-            raise InputError("TimeCache needs timestamps as float, "
-                "not %s" % type(ts))
+        if not isinstance(ts, self.number):
+            raise InputError("TimeCache needs timestamps as %s, "
+                "not %s" % (self.number, type(ts)))
         
-        if not isinstance(spread, float):
-            raise InputError("TimeCache needs spreads as float, "
-                "not %s" % type(spread))
+        if not isinstance(spread, self.number):
+            raise InputError("TimeCache needs spreads as %s, "
+                "not %s" % (self.number, type(spread)))
 
         if self._cold_cache(ts, spread) == 1:
             # first piece of data, load attributes only, 
@@ -335,105 +575,1076 @@ class TimeCache(object):
             return
 
         duration = ts - self._get_last_archive_ts()
-        if duration > 1.0:
+        if duration > self.second:
             self._update_archive(ts, spread)
             return 1
         
-        self.tmp_cache.append((ts, spread))
+        self._accumulate(self.spread, ts - self.last_ts)
+        self.n_open += 1
+        self.last_ts = ts
+        self.spread = spread
         return 0
+
+
+    def open_end(self):
+        """ End of the open second, in timestamp units, or None
+        before the first record.
+        """
+        if self.first_ts is None:
+            return None
+        return self._get_last_archive_ts() + self.second
+
+
+    def expire(self, now):
+        """ Close the open second if now is at or past its end, as if
+        a record had come in right at the end with the spread
+        unchanged -- so seconds without records still come out, with
+        the spread in effect.
+        Inputs:
+            now: current time, in timestamp units
+        Returns:
+            (bool) Yes if a second was closed, and there are new
+            records to log (call again until it returns 0).
+        """
+        end = self.open_end()
+        if end is None or now < end:
+            return 0
+
+        self._update_archive(end, self.spread)
+        # the boundary record is not a real one
+        self.n_open = 0
+        return 1
             
     
+    def next_log_ts(self):
+        """ Earliest timestamp (microseconds) of any record log may
+        write from now on, or None before the first record.
+        """
+        if not self.archive:
+            return None
+        return self._format(self.archive[0][0] + self.second, self.zero)[0]
+
+
     def log(self):
         """ Print a record for each whole-second between now and
         last logged record.  Make last second the new last logged
-        record.
+        record.  A compact sink gets gaps of more than one second as
+        a single range record instead.
         """
+        record = self.out.record
+        compact = self.out.compact
+        symbol = self.symbol
         
-        last_logged_ts = self.archive[0][0] + 1
+        last_logged_ts = self.archive[0][0] + self.second
         for i, data in enumerate(self.archive):
             if i == 0:
                 # this was logged last time
                 continue
             this_ts = self.archive[i][0]
             price = self.archive[i-1][1]
+            if (compact and price is not None
+                    and this_ts - last_logged_ts > self.second):
+                start, twa = self._format(last_logged_ts, price)
+                end, _ = self._format(this_ts, price)
+                self.out.record_range(symbol, start, end, twa)
+                last_logged_ts = this_ts
             while last_logged_ts < this_ts and price is not None:
-                sys.stdout.write(OUTPUT_FORMAT % (
-                    int(sec_to_microsec(last_logged_ts)), 
-                    price))
-                last_logged_ts += 1
+                record(symbol, *self._format(last_logged_ts, price))
+                last_logged_ts += self.second
             
-        sys.stdout.write(OUTPUT_FORMAT % (
-            int(sec_to_microsec(this_ts)), 
-            self.archive[i][1]))
+        record(symbol, *self._format(this_ts, self.archive[i][1]))
 
         self.archive = [self.archive[-1]]
 
 
-def compute_twa(f, delimiter=","):
+class FixedTimeCache(TimeCache):
+    """ TimeCache for integer mode:  timestamps are integer
+    microseconds and spreads fixed point integers, so second
+    boundaries, durations and the weighted sums are exact integer
+    arithmetic, and the output is formatted without going through
+    floats.
+    """
+
+    __slots__ = ()
+
+    number = (int, long)
+    zero = 0
+    second = MICROSEC
+
+
+    def _floor(self, ts):
+        return ts - ts % self.second
+
+
+    def _average(self):
+        return round_div(self.weighted_sum, self.time_sum)
+
+
+    def _format(self, ts, spread):
+        sign = "-" if spread < 0 else ""
+        units, frac = divmod(abs(spread), PRICE_SCALE)
+        return ts, FIXED_FORMAT % (sign, units, frac)
+
+
+def new_caches(symbol=None, integer=False, rollups=None, out=None,
+        store=None):
+    """ Fresh (QuotePair, TimeCache) for one instrument, in float
+    or integer (fixed point) mode, logging to out (see TimeCache).
+    rollups, a list of (window microseconds, out) pairs, gives a
+    rollup_chain instead (always in integer mode).  store, a
+    directory, gets the prefix sums of the closed seconds (see
+    twa_store.py), in a subdirectory per symbol.
+    """
+    if rollups:
+        windows, outs = zip(*rollups)
+        caches = FixedQuotePair(), rollup_chain(list(windows), outs, symbol)
+    elif integer:
+        caches = FixedQuotePair(), FixedTimeCache(symbol, out)
+    else:
+        caches = QuotePair(), TimeCache(symbol, out)
+
+    if store is not None:
+        import twa_store
+        time_cache = caches[1]
+        fixed = isinstance(time_cache, FixedTimeCache)
+        if symbol is not None:
+            store = os.path.join(store, symbol)
+        time_cache.store = twa_store.StoreWriter(store, fixed,
+            time_cache.second if fixed
+            else int(sec_to_microsec(time_cache.second)))
+    return caches
+
+
+class WindowCache(FixedTimeCache):
+    """ FixedTimeCache over windows of any whole number of
+    microseconds instead of seconds.  Each window it closes is also
+    merged into its rollups -- RollupCaches for coarser windows --
+    so several resolutions come out of a single pass over the ticks.
+    """
+
+    __slots__ = ("second", "rollups")
+
+    def __init__(self, symbol=None, out=None, window=MICROSEC):
+        """
+        Inputs:
+            symbol, out: as for TimeCache
+            window: (int) window length in microseconds
+        """
+        FixedTimeCache.__init__(self, symbol, out)
+        self.second = window
+        self.rollups = []
+
+
+    def _on_close(self, next_start):
+        """ Hand the closed window's sums to each rollup, which logs
+        whenever that closes one of its own windows.
+        """
+        FixedTimeCache._on_close(self, next_start)
+        end = self.archive[-1][0] + self.second
+        for rollup in self.rollups:
+            if rollup.merge(end, self.weighted_sum, self.time_sum,
+                    self.spread, next_start):
+                rollup.log()
+
+
+class RollupCache(WindowCache):
+    """ A coarser window built from the closed windows of a finer
+    WindowCache (window lengths must divide evenly) rather than from
+    ticks:  it sums their weighted spreads and durations, plus the
+    spread carried through any empty finer windows in between.  With
+    integer arithmetic that is exactly what a WindowCache of this
+    length would compute, except that a quote landing exactly on a
+    coarse boundary starts the new coarse window here.
+    """
+
+    __slots__ = ()
+
+    def merge(self, end, weighted_sum, time_sum, spread, next_start):
+        """ Merge one closed finer window.
+        Inputs:
+            end: (int) end of the finer window
+            weighted_sum, time_sum: (int) its running sums
+            spread: (int) spread in effect at its end
+            next_start: (int) start of the next finer window with data
+        Returns:
+            (bool) Yes if one of this cache's windows closed, and
+            there are new records to log.
+        """
+
+        if not self.archive:
+            self.archive = [(self._floor(end - 1), None)]
+
+        self.weighted_sum += weighted_sum
+        self.time_sum += time_sum
+        self.n_open += 1
+        self.spread = spread
+
+        window_end = self.archive[-1][0] + self.second
+        if next_start < window_end:
+            # carry the spread through empty finer windows
+            self._accumulate(spread, next_start - end)
+            return 0
+
+        self._accumulate(spread, window_end - end)
+        twa = self._average()
+        archive_floor = self._floor(next_start)
+        self._on_close(archive_floor)
+
+        self.archive.append((archive_floor, twa))
+        self.last_spread = spread
+
+        # the spread runs from the start of the new window until
+        # the next finer window with data
+        self.weighted_sum = self.time_sum = self.zero
+        self.n_open = 0
+        self._accumulate(spread, next_start - archive_floor)
+        return 1
+
+
+def parse_window(window):
+    """ Window length like '100ms', '1s', '5m', '1h' (or a number of
+    seconds) in microseconds.
+    """
+    units = (("us", 1), ("ms", 1000), ("s", MICROSEC), ("m", 60 * MICROSEC),
+        ("h", 3600 * MICROSEC))
+    for suffix, scale in units:
+        if window.endswith(suffix) and window[:-len(suffix)].isdigit():
+            return int(window[:-len(suffix)]) * scale
+    try:
+        return int(round(float(window) * MICROSEC))
+    except ValueError:
+        raise InputError("can't read window length %s" % window)
+
+
+def rollup_chain(windows, outs, symbol=None):
+    """ WindowCache for the finest window, feeding a chain of
+    RollupCaches for the coarser ones.
+    Inputs:
+        windows: (list) window lengths in microseconds, ascending,
+            each a multiple of the one before
+        outs: (list) sinks.Sink (or writable stream) for each window
+        symbol: instrument name, as for TimeCache
+    Returns:
+        (WindowCache) the finest level
+    """
+    for finer, coarser in zip(windows, windows[1:]):
+        if coarser % finer:
+            raise InputError("rollup windows must each be a multiple of "
+                "the one before, not %i and %i us" % (finer, coarser))
+
+    finest = level = WindowCache(symbol, outs[0], windows[0])
+    for window, out in zip(windows[1:], outs[1:]):
+        rollup = RollupCache(symbol, out, window)
+        level.rollups.append(rollup)
+        level = rollup
+    return finest
+
+
+class Instruments(object):
+    """ Keyed registry of per-symbol state:  one QuotePair and one
+    TimeCache per instrument, created on first sight of a symbol.
+    """
+
+    def __init__(self, integer=False, rollups=None, out=None, store=None):
+        self.state = {}
+        self.integer = integer or bool(rollups)
+        self.rollups = rollups
+        self.out = out
+        self.store = store
+        # symbols too far behind the wall clock, in live mode
+        self.lagging = set()
+
+
+    def get(self, symbol):
+        """ Return (QuotePair, TimeCache) for symbol."""
+        try:
+            return self.state[symbol]
+        except KeyError:
+            caches = self.state[symbol] = new_caches(symbol, self.integer,
+                self.rollups, self.out, self.store)
+            return caches
+
+
+    def __iter__(self):
+        return iter(sorted(self.state.items()))
+
+
+class ReorderBuffer(object):
+    """ Reorder stage for input that is slightly out of order:  records
+    are held in a heap until the watermark (latest timestamp seen,
+    less the delay) passes them, then released in timestamp order
+    (arrival order among equal timestamps).  Records older than one
+    already released are too late to be put back in order, and are
+    dropped and counted.  Only delay's worth of input is ever held.
+    """
+
+    def __init__(self, delay, key):
+        """
+        Inputs:
+            delay: (int) microseconds of input time to hold records
+            key: function giving a record's timestamp in microseconds
+        """
+        self.delay = delay
+        self.key = key
+        self.heap = []
+        self.seq = 0
+        self.max_ts = None
+        self.released_ts = None
+        self.late = 0
+
+
+    def push(self, record):
+        """ Add one record, returning the records it releases."""
+        ts = self.key(record)
+        if self.released_ts is not None and ts < self.released_ts:
+            self.late += 1
+            return []
+
+        heapq.heappush(self.heap, (ts, self.seq, record))
+        self.seq += 1
+        if self.max_ts is None or ts > self.max_ts:
+            self.max_ts = ts
+
+        watermark = self.max_ts - self.delay
+        released = []
+        while self.heap and self.heap[0][0] <= watermark:
+            self.released_ts, _, record = heapq.heappop(self.heap)
+            released.append(record)
+        return released
+
+
+    def drain(self):
+        """ Release everything held, at the end of the input."""
+        released = []
+        while self.heap:
+            self.released_ts, _, record = heapq.heappop(self.heap)
+            released.append(record)
+        return released
+
+
+    def reorder(self, records):
+        """ Generator of records in timestamp order, for a stream of
+        lines or tick records.
+        """
+        for record in records:
+            for ready in self.push(record):
+                yield ready
+        for ready in self.drain():
+            yield ready
+
+        if self.late:
+            logging.warning("input error: dropped %i records that came "
+                "in more than the reorder delay out of order" % self.late)
+
+
+def line_reorder(delay, delimiter=",", symbol_field=None):
+    """ ReorderBuffer for csv lines.
+    Inputs:
+        delay: (int) microseconds
+        delimiter: field delimiter
+        symbol_field: (int) index of an instrument name field, if any
+    """
+    index = 1 if symbol_field == 0 else 0
+    return ReorderBuffer(delay,
+        lambda line: int(line.split(delimiter, index + 1)[index]))
+
+
+def add_quote(pair_cache, time_cache, ts, side, price, line):
+    """ Push one parsed record through the pair and time caches,
+    logging any whole seconds it completes.
+    Inputs:
+        pair_cache: QuotePair for the record's instrument
+        time_cache: TimeCache for the record's instrument
+        ts: (float) record timestamp
+        side: ':a' or ':b', or its code (quote_parser.ASK or BID)
+        price: (float) quoted price
+        line: raw input line (or record tuple), for error messages
+    """
+    try:
+        spread = pair_cache.add(ts, side, price)
+    except QuoteError as e:
+        if not isinstance(line, str):
+            line = ",".join(map(str, line))
+        logging.warning("input error: %s, %s" 
+            % (line.strip(), str(e)))
+        return
+    
+    if spread is not None:
+        log_ready = time_cache.add(ts, spread)
+        if log_ready:
+            time_cache.log()        
+
+
+def close_caches(time_cache):
+    """ End of input for one instrument:  report the open second,
+    and close the store, if any.
+    """
+    log_dropped(time_cache)
+    if time_cache.store is not None:
+        time_cache.store.close()
+
+
+def log_dropped(time_cache):
+    """ Report the open second that was never closed."""
+    report = dropped_report(time_cache)
+    if report:
+        logging.info(report)
+
+
+def dropped_report(time_cache):
+    """ log_dropped's message, or None if there's nothing open."""
+    if time_cache.n_open:
+        return ("dropped %i records for incomplete "
+            "full-second at the end of the stream between "
+            "timestamps %.2f and %.2f." % (time_cache.n_open,
+            time_cache.first_ts / float(time_cache.second),
+            time_cache.last_ts / float(time_cache.second)
+        ))
+    return None
+
+
+def compute_twa(f, delimiter=",", chunk_size=stream_data.CHUNK_SIZE,
+        symbol_field=None, integer=False, rollups=None, out=None,
+        lateness=None, store=None, pipeline=False, ring=None):
     """ Read records from stream, and log outputs on the fly.
     Inputs:
         f: object with iterator protocol (next method and 
             StopIteration error when exhausted).  Contains
             one record per line of the form:
                 timestmap, quote side, price
+            Readable streams (with 'read' or 'recv') are read a
+            block at a time, and parsed in bulk for a single
+            instrument (see twa_blocks).
+        delimiter: field delimiter
+        chunk_size: (int) bytes per read from f
+        symbol_field: (int) index of an extra instrument name
+            field, if the stream interleaves several instruments
+        integer: (bool) use integer microseconds and fixed point
+            prices throughout (see FixedTimeCache)
+        rollups: (list) (window microseconds, out) pairs, to compute
+            several window lengths at once (see rollup_chain)
+        out: sinks.Sink for the output, otherwise stdout
+        lateness: (float) live mode (see twa_live) if given:  seconds
+            past the end of a second to wait for its records before
+            closing it on the wall clock.  f must be readable.
+        store: directory for prefix sums of the output (see
+            twa_store.py)
+        pipeline: (bool) read f on a thread of its own, and parse
+            on another one (single instrument), handing blocks on
+            through bounded queues.  f must be readable.
+        ring: path of a shared memory ring to create and read tick
+            records from, single instrument, instead of f (see
+            shm_ring.py;  x86 only)
     Returns:
         (stdout) one line for each whole second in input, with
-            time-weighted prices per whole second.
+            time-weighted prices per whole second (prefixed by
+            the symbol if symbol_field is given).
     """
+
+    if ring is not None:
+        if (symbol_field is not None or lateness is not None
+                or pipeline):
+            raise InputError("a ring carries a single instrument, "
+                "replayed serially by the streaming engine")
+        import shm_ring
+        reader = shm_ring.RingReader(ring)
+        try:
+            _, time_cache = twa_records(reader.records(),
+                new_caches(None, integer, rollups, out, store))
+        finally:
+            reader.close()
+        close_caches(time_cache)
+        return
+
+    if lateness is not None:
+        if not (hasattr(f, "read") or hasattr(f, "recv")):
+            raise InputError("live mode needs a readable stream")
+        stream = stream_data.timed_stream(f, LIVE_INTERVAL, chunk_size)
+        instruments, late = twa_live(stream, delimiter, symbol_field,
+            Instruments(integer, rollups, out, store), lateness)
+        if late:
+            logging.warning("input error: dropped %i records that came "
+                "in after their second was closed" % late)
+        for symbol, (_, time_cache) in instruments:
+            close_caches(time_cache)
+        return
     
-    pair_cache = QuotePair()
-    time_cache = TimeCache()
+    readable = hasattr(f, "read") or hasattr(f, "recv")
+    if pipeline and not readable:
+        raise InputError("pipelined mode needs a readable stream")
+
+    if readable and symbol_field is None:
+        caches = new_caches(None, integer, rollups, out, store)
+        blocks = stream_data.line_blocks(f, chunk_size)
+        if pipeline:
+            # reader -> parser -> this thread
+            batches = stream_data.prefetch(parse_blocks(
+                stream_data.prefetch(blocks), delimiter,
+                isinstance(caches[1], FixedTimeCache)))
+            _, time_cache = twa_parsed(batches, delimiter, caches)
+        else:
+            _, time_cache = twa_blocks(blocks, delimiter, caches)
+        close_caches(time_cache)
+        return
+
+    if pipeline:
+        stream = (line for lines in stream_data.prefetch(
+            stream_data.line_blocks(f, chunk_size)) for line in lines)
+    elif readable:
+        stream = stream_data.stream(f, chunk_size)
+    else:
+        stream = f
+
+    if symbol_field is not None:
+        instruments = twa_by_symbol(stream, delimiter, symbol_field,
+            Instruments(integer, rollups, out, store))
+        for symbol, (_, time_cache) in instruments:
+            close_caches(time_cache)
+        return
+
+    _, time_cache = twa_single(stream, delimiter,
+        new_caches(None, integer, rollups, out, store))
+    close_caches(time_cache)
     
-    stream = stream_data.stream(f)
+    #TODO we could have a concept of logging records at the end
+    # of a stream that are for a partial second.
+
+
+def twa_single(stream, delimiter, caches=None):
+    """ compute_twa for streams of a single instrument.
+    Inputs:
+        stream: iterator of lines
+        delimiter: field delimiter
+        caches: (QuotePair, TimeCache) to continue from, if any
+            (see new_caches), which also picks float or integer mode
+    Returns:
+        (QuotePair, TimeCache) state after the last line
+    """
+
+    if caches is None:
+        caches = new_caches()
+    pair_cache, time_cache = caches
+    integer = isinstance(time_cache, FixedTimeCache)
+
     for line in stream:
         ts, side, price = line.strip().split(delimiter)
         
-        ts = microsec_to_sec(float(ts))
-        price = float(price)
+        if integer:
+            ts = int(ts)
+            price = price_to_fixed(price)
+        else:
+            ts = microsec_to_sec(float(ts))
+            price = float(price)
 
-        ts *= float_multiplier
-        price *= float_multiplier
+            ts *= float_multiplier
+            price *= float_multiplier
         
-        try:
-            spread = pair_cache.add(ts, side, price)
-        except QuoteError as e:
-            logging.warning("input error: %s, %s" 
-                % (line.strip(), str(e)))
+        add_quote(pair_cache, time_cache, ts, side, price, line)
+
+    return caches
+
+
+def twa_blocks(blocks, delimiter, caches=None):
+    """ twa_single for lists of lines, each parsed in one go by
+    quote_parser (or line by line, if it can't take a block).
+    Inputs:
+        blocks: iterator of lists of lines (see stream_data.line_blocks)
+        delimiter: field delimiter
+        caches: (QuotePair, TimeCache) to continue from, if any
+            (see new_caches), which also picks float or integer mode
+    Returns:
+        (QuotePair, TimeCache) state after the last line
+    """
+
+    if caches is None:
+        caches = new_caches()
+    integer = isinstance(caches[1], FixedTimeCache)
+    return twa_parsed(parse_blocks(blocks, delimiter, integer), delimiter,
+        caches)
+
+
+def parse_blocks(blocks, delimiter, integer=False):
+    """ Parse lists of lines in bulk, for twa_parsed.
+    Inputs:
+        blocks: iterator of lists of lines (see stream_data.line_blocks)
+        delimiter: field delimiter
+        integer: (bool) integer mode, as for compute_twa
+    Returns:
+        (lines, columns) per block:  columns are the timestamps,
+        side codes and prices (see quote_parser.py) in the units the
+        engine takes them, or None if the lines have to be parsed
+        one by one
+    """
+    price_scale = PRICE_SCALE if integer else None
+    for lines in blocks:
+        columns = quote_parser.parse_lines(lines, delimiter, price_scale)
+        if columns is not None and not integer:
+            timestamps, codes, prices = columns
+            # as microsec_to_sec, with the loop in C
+            timestamps = map((1000000.0).__rdiv__, timestamps)
+            if float_multiplier != 1:
+                timestamps = [ts * float_multiplier for ts in timestamps]
+                prices = [price * float_multiplier for price in prices]
+            columns = timestamps, codes, prices
+        yield lines, columns
+
+
+def twa_parsed(batches, delimiter, caches=None):
+    """ twa_single for blocks parsed by parse_blocks.
+    Inputs:
+        batches: iterator of (lines, columns)
+        delimiter: field delimiter, for blocks left unparsed
+        caches: (QuotePair, TimeCache) to continue from, if any
+            (see new_caches), in the mode the blocks were parsed for
+    Returns:
+        (QuotePair, TimeCache) state after the last block
+    """
+
+    if caches is None:
+        caches = new_caches()
+    pair_cache, time_cache = caches
+
+    for lines, columns in batches:
+        if columns is None:
+            twa_single(lines, delimiter, caches)
             continue
+
+        timestamps, codes, prices = columns
+        for ts, code, price, line in zip(timestamps, codes, prices, lines):
+            add_quote(pair_cache, time_cache, ts, code, price, line)
+
+    return caches
+
+
+def twa_records(records, caches=None):
+    """ twa_single for pre-parsed records, e.g. from a binary
+    tick file (see tick_format.py).
+    Inputs:
+        records: iterator of (ts microseconds, side, price)
+        caches: (QuotePair, TimeCache) to continue from, if any
+            (see new_caches), which also picks float or integer mode
+    Returns:
+        (QuotePair, TimeCache) state after the last record
+    """
+
+    if caches is None:
+        caches = new_caches()
+    pair_cache, time_cache = caches
+    integer = isinstance(time_cache, FixedTimeCache)
+
+    for record in records:
+        ts, side, price = record
+
+        if integer:
+            price = price_to_fixed(price)
+        else:
+            ts = microsec_to_sec(float(ts))
+
+            ts *= float_multiplier
+            price *= float_multiplier
+
+        add_quote(pair_cache, time_cache, ts, side, price, record)
+
+    return caches
+
+
+def twa_by_symbol(stream, delimiter, symbol_field, instruments=None):
+    """ compute_twa for streams of interleaved instruments.
+    Inputs:
+        stream: iterator of lines
+        delimiter: field delimiter
+        symbol_field: (int) index of the instrument name field
+        instruments: Instruments registry to continue from, if any,
+            which also picks float or integer mode
+    Returns:
+        (Instruments) per-symbol state after the last line
+    """
+
+    if instruments is None:
+        instruments = Instruments()
+
+    for line in stream:
+        fields = line.strip().split(delimiter)
+        symbol = fields.pop(symbol_field)
+        ts, side, price = fields
         
-        if spread is not None:
-            log_ready = time_cache.add(ts, spread)
-            if log_ready:
-                time_cache.log()        
-    
-    if len(time_cache.tmp_cache):
-        logging.info("dropped %i records for incomplete "
-            "full-second at the end of the stream between "
-            "timestamps %.2f and %.2f." % (len(time_cache.tmp_cache),
-            time_cache.tmp_cache[0][0], time_cache.tmp_cache[-1][0]
-        )) 
-    
-    #TODO we could have a concept of logging records at the end
-    # of a stream that are for a partial second.
+        if instruments.integer:
+            ts = int(ts)
+            price = price_to_fixed(price)
+        else:
+            ts = microsec_to_sec(float(ts))
+            price = float(price)
+
+            ts *= float_multiplier
+            price *= float_multiplier
+
+        pair_cache, time_cache = instruments.get(symbol)
+        add_quote(pair_cache, time_cache, ts, side, price, line)
+
+    return instruments
+
+
+# live mode:  longest wait for input before checking the clock
+LIVE_INTERVAL = 0.1
+
+# live mode:  seconds an instrument's open second may end before the
+# wall clock and still be closed on it.  Further behind, the input
+# isn't live (a replay of old data, or a process that was stopped):
+# filling every second since would write lines without end, so its
+# seconds close on its own records only.
+LIVE_MAX_LAG = 60.0
+
+
+def twa_live(stream, delimiter, symbol_field=None, instruments=None,
+        lateness=0.0, clock=time.time):
+    """ compute_twa for live streams, where seconds are also closed
+    on the wall clock (see TimeCache.expire) once they are lateness
+    seconds past their end -- output keeps coming while the input is
+    idle, filled with the spread in effect.  Idle seconds between
+    records are filled the same way, and records for a second that
+    was already closed are dropped.
+    Inputs:
+        stream: iterator of lines, yielding None whenever it's time
+            to check the clock (see stream_data.timed_stream)
+        delimiter: field delimiter
+        symbol_field: (int) index of the instrument name field, if
+            any (otherwise the instrument is None)
+        instruments: Instruments registry to continue from, if any,
+            which also picks float or integer mode
+        lateness: (float) seconds
+        clock: function returning the wall clock time, in seconds
+            since the epoch
+    Returns:
+        (Instruments) per-symbol state after the last line
+        (int) number of late records dropped
+    """
+
+    if instruments is None:
+        instruments = Instruments()
+    integer = instruments.integer
+    late = 0
+
+    for line in stream:
+        if line is None:
+            expire_instruments(instruments, clock() - lateness)
+            continue
+
+        fields = line.strip().split(delimiter)
+        symbol = None
+        if symbol_field is not None:
+            symbol = fields.pop(symbol_field)
+        ts, side, price = fields
+
+        if integer:
+            ts = int(ts)
+            price = price_to_fixed(price)
+        else:
+            ts = microsec_to_sec(float(ts))
+            price = float(price)
+
+            ts *= float_multiplier
+            price *= float_multiplier
+
+        late += add_live_quote(instruments, symbol, ts, side, price, line)
+
+    return instruments, late
+
+
+def expire_instruments(instruments, now):
+    """ Close the seconds of every instrument that end by now, as
+    if records had come in (see TimeCache.expire), and poll the
+    output sinks (see sinks.Sink.poll).
+    Instruments more than LIVE_MAX_LAG behind now are left alone,
+    with a warning.
+    Inputs:
+        instruments: Instruments registry
+        now: (float) wall clock time, in seconds since the epoch
+    """
+    if instruments.integer:
+        max_lag = int(LIVE_MAX_LAG * MICROSEC)
+        now = int(now * MICROSEC)
+    else:
+        max_lag = LIVE_MAX_LAG * float_multiplier
+        now *= float_multiplier
+    for symbol, (_, time_cache) in instruments:
+        end = time_cache.open_end()
+        if end is not None and now - end > max_lag:
+            if symbol not in instruments.lagging:
+                instruments.lagging.add(symbol)
+                logging.warning("input error: %s is %.0f seconds behind "
+                    "the wall clock, not closing its seconds on the "
+                    "clock" % (symbol or "input",
+                    (now - end) / float(time_cache.second)))
+            continue
+        instruments.lagging.discard(symbol)
+        while time_cache.expire(now):
+            time_cache.log()
+
+    outs = [instruments.out or sinks.STDOUT] + [
+        sink for _, sink in instruments.rollups or ()]
+    for out in outs:
+        out.poll()
+
+
+def add_live_quote(instruments, symbol, ts, side, price, line):
+    """ add_quote for live input (see twa_live):  closes out the idle
+    seconds before the record first, and drops records for a second
+    that was already closed.
+    Inputs:
+        instruments: Instruments registry
+        symbol: instrument name, or None
+        ts, side, price, line: as for add_quote, in the registry's
+            mode
+    Returns:
+        (bool) Yes if the record was dropped as late
+    """
+    pair_cache, time_cache = instruments.get(symbol)
+    if time_cache.first_ts is not None:
+        if ts < time_cache.archive[-1][0]:
+            return 1
+        # close out whole idle seconds before this record, the
+        # second just before it closes as usual in add
+        while time_cache.expire(ts - time_cache.second):
+            time_cache.log()
+    add_quote(pair_cache, time_cache, ts, side, price, line)
+    return 0
+
+
+def _open_sink(options, out=None):
+    """ sinks.Sink with the --format, --flush-* and --compact-gaps
+    options, writing to out (stdout by default).
+    """
+    return sinks.Sink(out, options.format, options.flush_records,
+        options.flush_bytes, options.flush_interval, options.compact)
+
+
+def _open_rollups(options):
+    """ (window microseconds, sinks.Sink) pairs for --rollups, or
+    None.  Instruments share the sink for each window.
+    """
+    if not options.rollups:
+        return None
+    windows = [(parse_window(w), w) for w in options.rollups.split(",")]
+    return [(window, _open_sink(options, open(options.rollup_path % label,
+            "wb")))
+        for window, label in sorted(windows)]
+
+
+def _main_ticks(options, file_, out, rollups):
+    """ main, for input in the binary tick format."""
+
+    if options.symbol_field is not None or options.jobs > 1:
+        raise InputError("tick files hold a single instrument, "
+            "replayed serially")
+
+    if options.batch:
+        # numpy is only needed for batch mode
+        import batch_weight
+        fname = options.fname
+        if isinstance(file_, stream_data.DecompressedStream):
+            fname = None
+        batch_weight.compute_twa_batch_ticks(file_, fname)
+        return
+
+    if options.live or options.checkpoint:
+        raise InputError("--live and --checkpoint read csv input")
+
+    if options.mmap:
+        records = tick_format.mmap_records(options.fname)
+    else:
+        records = tick_format.stream_records(file_)
+    _replay_records(options, records, out, rollups)
+
+
+def _main_ring(options, out, rollups):
+    """ main, for tick records from a shared memory ring."""
+
+    if options.reorder_delay is None:
+        compute_twa(None, integer=options.integer, rollups=rollups,
+            out=out, store=options.store, ring=options.ring)
+        return
+
+    import shm_ring
+    ring = shm_ring.RingReader(options.ring)
+    try:
+        _replay_records(options, ring.records(), out, rollups)
+    finally:
+        ring.close()
+
+
+def _replay_records(options, records, out, rollups):
+    """ Put tick records through the streaming engine."""
+
+    if options.reorder_delay is not None:
+        records = ReorderBuffer(int(round(options.reorder_delay * MICROSEC)),
+            lambda record: record[0]).reorder(records)
+    _, time_cache = twa_records(records,
+        new_caches(None, options.integer, rollups, out, options.store))
+    close_caches(time_cache)
 
 
 def main(options):
-    
-    # open file if given else default to stdin
-    if options.fname:
-        file_ = open(options.fname)
+
+    symbol_field = options.symbol_field
+    sharded = options.jobs > 1 and symbol_field is None
+
+    if options.batch and symbol_field is not None:
+        raise InputError("--batch handles a single instrument only")
+
+    if options.batch and (options.integer or options.rollups):
+        raise InputError("--batch works in floating point, one second "
+            "windows only")
+
+    if options.jobs > 1 and options.rollups:
+        raise InputError("--rollups runs in a single process")
+
+    if options.live and (options.batch or options.mmap
+            or options.jobs > 1):
+        raise InputError("--live reads the input serially, as a stream")
+
+    if options.reorder_delay is not None and (options.batch or sharded
+            or options.live):
+        raise InputError("--reorder-delay needs the streaming engine, "
+            "without --live")
+
+    if options.checkpoint and (options.batch or options.mmap
+            or options.jobs > 1 or options.live or options.rollups
+            or options.reorder_delay is not None):
+        raise InputError("--checkpoint covers the plain streaming "
+            "engine only")
+
+    if options.store and (options.batch or options.jobs > 1
+            or options.checkpoint):
+        raise InputError("--store works with the single process "
+            "streaming engine, without --checkpoint")
+
+    if options.pipeline and (options.batch or options.mmap
+            or options.jobs > 1 or options.live or options.checkpoint
+            or options.reorder_delay is not None):
+        raise InputError("--pipeline runs the plain streaming engine")
+
+    if options.ring and (options.fname or options.batch or options.mmap
+            or options.jobs > 1 or options.live or options.checkpoint
+            or options.pipeline or options.symbol_field is not None):
+        raise InputError("--ring carries a single instrument, replayed "
+            "serially by the streaming engine")
+
+    if options.compact and options.format == "binary":
+        raise InputError("--compact-gaps needs csv or json output")
+
+    if (options.batch or options.jobs > 1) and (options.format != "csv"
+            or options.flush_records or options.flush_bytes
+            or options.flush_interval or options.compact):
+        raise InputError("--format, --flush-* and --compact-gaps apply "
+            "to the single process streaming engine only")
+
+    if (options.mmap or sharded) and not options.fname:
+        raise InputError("--mmap, and --jobs without --symbol-field, "
+            "need a file given by --path")
+
+    # open file if given else default to stdin -- both as
+    # buffered binary streams, which support partial reads
+    if options.ring:
+        # records come through shared memory instead
+        file_ = None
+    elif options.fname:
+        file_ = stream_data.open_binary(options.fname, options.chunk_size)
         
     else:
-        file_ = sys.stdin
-        
-    # burn one line
-    if options.header:
-        file_.readline()
+        file_ = stream_data.open_binary(sys.stdin.fileno(),
+            options.chunk_size, closefd=False)
+
+    # gzip, bz2 or xz input is decompressed as it is read
+    if file_ is not None:
+        file_ = stream_data.open_input(file_, options.chunk_size)
+    compressed = isinstance(file_, stream_data.DecompressedStream)
+    if compressed and (options.mmap or sharded or options.checkpoint):
+        raise InputError("--mmap, --checkpoint, and --jobs without "
+            "--symbol-field, need uncompressed input")
+
+    # a pipelined run writes its output on a thread too
+    out = _open_sink(options, stream_data.ThreadedWriter(sys.stdout)
+        if options.pipeline else None)
+    rollups = _open_rollups(options)
+    try:
+        _main_input(options, file_, out, rollups)
+    finally:
+        out.close()
+        for _, sink in rollups or ():
+            sink.close()
+
+
+def _main_input(options, file_, out, rollups):
+    """ main, once the input is open:  pick the engine."""
 
     # defaults to ,
     delimiter = options.delimiter
-    
-    compute_twa(file_, delimiter)
+    symbol_field = options.symbol_field
+    sharded = options.jobs > 1 and symbol_field is None
+
+    if options.ring:
+        _main_ring(options, out, rollups)
+        return
+
+    if tick_format.is_tick_file(file_):
+        _main_ticks(options, file_, out, rollups)
+        return
+
+    if options.batch:
+        if options.header:
+            file_.readline()
+        # numpy is only needed for batch mode
+        import batch_weight
+        batch_weight.compute_twa_batch(file_, delimiter)
+        return
+
+    if sharded:
+        import parallel_weight
+        parallel_weight.compute_twa_sharded(options.fname, delimiter,
+            options.header, options.jobs, integer=options.integer)
+        return
+
+    if options.checkpoint:
+        import checkpoint
+        checkpoint.compute_twa_checkpointed(file_, options.checkpoint,
+            delimiter, options.header, symbol_field, options.integer, out,
+            options.checkpoint_interval, options.chunk_size)
+        return
+
+    if options.live:
+        if options.header:
+            file_.readline()
+        compute_twa(file_, delimiter, options.chunk_size, symbol_field,
+            options.integer, rollups, out, lateness=options.lateness,
+            store=options.store)
+        return
+
+    if options.mmap:
+        stream = stream_data.mmap_stream(options.fname, options.header)
+    else:
+        # burn one line
+        if options.header:
+            file_.readline()
+        # compute_twa reads the file itself (in blocks, for the bulk
+        # parser) unless the lines are needed first
+        stream = file_
+        if options.reorder_delay is not None:
+            stream = stream_data.stream(file_, options.chunk_size)
+
+    if options.reorder_delay is not None:
+        stream = line_reorder(int(round(options.reorder_delay * MICROSEC)),
+            delimiter, symbol_field).reorder(stream)
+
+    if options.jobs > 1:
+        import parallel_weight
+        parallel_weight.compute_twa_partitioned(stream, delimiter,
+            symbol_field, options.jobs, options.chunk_size,
+            integer=options.integer)
+        return
+
+    compute_twa(stream, delimiter, options.chunk_size, symbol_field,
+        options.integer, rollups, out, store=options.store,
+        pipeline=options.pipeline)
 
 
 if __name__ == "__main__":
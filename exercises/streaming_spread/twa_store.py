@@ -0,0 +1,301 @@
+"""
+Append-only store of prefix sums, written alongside the output of
+time_weight.py, for time weighted averages over arbitrary windows:
+
+python time_weight.py -1f data.csv --store twa.store
+python twa_store.py -p twa.store --start 1469404800 --end 1469405100
+
+A store is a directory with a small json meta file and two columns
+of little endian float64, one row per second (window) from the
+first one closed:
+
+    weighted:  cumulative spread * seconds, up to the end of the row
+    time:  cumulative seconds with a spread in effect
+
+so the average over [t1, t2) is a difference of two rows in each
+column divided by the other -- constant time, whatever the window.
+Readers memory-map the columns, so any number of processes can
+share a store while it is being written.
+
+Rows hold the running sums each second had when the engine closed
+it (the first second only counts time after the first quote), and
+seconds without records hold the spread in effect through them.
+Seconds between runs appending to the store (as when a feed drops
+out for a while) get rows of zero time, carrying the totals on, so
+they add nothing to the averages over windows spanning them.
+"""
+
+import json
+import logging
+import mmap
+import optparse
+import os
+import struct
+import sys
+import time
+
+import time_weight
+
+
+VERSION = 1
+
+META = "meta.json"
+WEIGHTED = "weighted.f8"
+TIME = "time.f8"
+
+VALUE = struct.Struct("<d")
+
+# seconds between flushes of the columns while writing
+FLUSH_INTERVAL = 1.0
+
+
+class StoreError(Exception):
+    """ For stores that can't be read, or appended to as asked."""
+    pass
+
+
+def getopt(argv):
+
+    parser = optparse.OptionParser()
+
+    parser.add_option(
+        "-p", "--path",
+        default=None, dest="path",
+        help="store directory")
+    parser.add_option(
+        "--start",
+        default=None, dest="start",
+        help="start of the window:  UTC 'YYYY-MM-DD HH:MM:SS', or "
+            "seconds since the epoch [default: start of the store]")
+    parser.add_option(
+        "--end",
+        default=None, dest="end",
+        help="end of the window (not included), as --start "
+            "[default: end of the store]")
+
+    options, _ = parser.parse_args()
+    return options
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, META), "rb") as f:
+            meta = json.load(f)
+    except IOError:
+        return None
+    if meta.get("version") != VERSION:
+        raise StoreError("unknown store version in %s" % path)
+    return meta
+
+
+class StoreWriter(object):
+    """ Appends closed seconds to a store.  Attached to a TimeCache
+    (its store attribute), which hands over each second it closes.
+    """
+
+    def __init__(self, path, integer=False, step=time_weight.MICROSEC):
+        """
+        Inputs:
+            path: store directory, created if need be
+            integer: (bool) the TimeCache is in integer mode
+            step: (int) length of its seconds (windows), microseconds
+        """
+        self.path = path
+        self.step = step
+        # factors from the TimeCache's units to microseconds (for
+        # timestamps), and to prices and seconds (for the sums)
+        if integer:
+            self.ts_scale = 1
+            self.price_scale = 1.0 / time_weight.PRICE_SCALE
+            self.time_scale = 1.0 / time_weight.MICROSEC
+        else:
+            self.ts_scale = time_weight.MICROSEC
+            self.price_scale = self.time_scale = 1.0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.meta = _read_meta(path)
+        if self.meta is not None and self.meta["step"] != step:
+            raise StoreError("store %s has %i us rows, not %i"
+                % (path, self.meta["step"], step))
+
+        # drop a row left half written by a run that died
+        names = [os.path.join(path, name) for name in (WEIGHTED, TIME)]
+        rows = min(os.path.getsize(name) if os.path.exists(name) else 0
+            for name in names) // VALUE.size
+        for name in names:
+            if os.path.exists(name):
+                with open(name, "r+b") as f:
+                    f.truncate(rows * VALUE.size)
+        self.weighted = open(names[0], "ab")
+        self.time = open(names[1], "ab")
+        if rows:
+            last = PrefixStore(path)
+            self.next_start = last.start + rows * step
+            self.weighted_total, self.time_total = last.row(rows - 1)
+            last.close()
+        else:
+            self.next_start = None
+            self.weighted_total = self.time_total = 0.0
+        self.last_flush = time.time()
+
+
+    def _append(self, weighted, duration):
+        self.weighted_total += weighted
+        self.time_total += duration
+        self.weighted.write(VALUE.pack(self.weighted_total))
+        self.time.write(VALUE.pack(self.time_total))
+        self.next_start += self.step
+
+
+    def merge(self, end, weighted_sum, time_sum, spread, next_start):
+        """ Append one closed second, and any seconds without records
+        after it.  Arguments as for RollupCache.merge, in the
+        TimeCache's units.
+        """
+        end = int(round(end * self.ts_scale))
+        next_start = int(round(next_start * self.ts_scale))
+        start = end - self.step
+
+        if self.next_start is None:
+            self.meta = {"version": VERSION, "start": start,
+                "step": self.step}
+            tmp = os.path.join(self.path, META + ".tmp")
+            with open(tmp, "wb") as f:
+                json.dump(self.meta, f)
+            os.rename(tmp, os.path.join(self.path, META))
+            self.next_start = start
+        elif start < self.next_start:
+            # already stored, by an earlier run over the same input
+            return
+        elif start > self.next_start:
+            # the input stopped for a while:  no spread was in effect
+            logging.info("store %s ends at %i us, padding to the second "
+                "at %i" % (self.path, self.next_start, start))
+            for _ in range((start - self.next_start) // self.step):
+                self._append(0.0, 0.0)
+
+        self._append(weighted_sum * self.price_scale * self.time_scale,
+            time_sum * self.time_scale)
+        duration = float(self.step) / time_weight.MICROSEC
+        carried = spread * self.price_scale * duration
+        for _ in range((next_start - end) // self.step):
+            self._append(carried, duration)
+
+        if time.time() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+
+    def flush(self):
+        """ Make the rows written so far visible to readers."""
+        self.weighted.flush()
+        self.time.flush()
+        self.last_flush = time.time()
+
+
+    def close(self):
+        self.weighted.close()
+        self.time.close()
+
+
+class PrefixStore(object):
+    """ Read-only view of a store, memory-mapped. """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_meta(path)
+        if self.meta is None:
+            raise StoreError("no store at %s" % path)
+        self.start = self.meta["start"]
+        self.step = self.meta["step"]
+        self.maps = None
+        self.rows = 0
+        self.refresh()
+
+
+    def refresh(self):
+        """ Map the columns again, to see rows written since."""
+        self.close()
+        maps = []
+        for name in (WEIGHTED, TIME):
+            with open(os.path.join(self.path, name), "rb") as f:
+                if not os.fstat(f.fileno()).st_size:
+                    maps.append(None)
+                    continue
+                maps.append(mmap.mmap(f.fileno(), 0,
+                    access=mmap.ACCESS_READ))
+        self.maps = maps
+        self.rows = min(len(m) if m is not None else 0
+            for m in maps) // VALUE.size
+
+
+    def close(self):
+        for m in self.maps or ():
+            if m is not None:
+                m.close()
+        self.maps = None
+
+
+    @property
+    def end(self):
+        """ End of the last stored row, microseconds."""
+        return self.start + self.rows * self.step
+
+
+    def row(self, i):
+        """ (cumulative weighted spread, cumulative time) at the end of
+        row i, or zeros before the first row.
+        """
+        if i < 0:
+            return 0.0, 0.0
+        offset = i * VALUE.size
+        return (VALUE.unpack_from(self.maps[0], offset)[0],
+            VALUE.unpack_from(self.maps[1], offset)[0])
+
+
+    def twa(self, start=None, end=None):
+        """ Time weighted average spread over [start, end).
+        Inputs:
+            start, end: microseconds, rounded down to whole rows and
+                clipped to the store (default:  all of it)
+        Returns:
+            (float) average, or None if no spread was in effect then
+        """
+        first = 0 if start is None else (start - self.start) // self.step
+        last = self.rows if end is None else (end - self.start) // self.step
+        first = min(max(first, 0), self.rows)
+        last = min(max(last, first), self.rows)
+
+        weighted_1, time_1 = self.row(first - 1)
+        weighted_2, time_2 = self.row(last - 1)
+        if time_2 - time_1 <= 0:
+            return None
+        return (weighted_2 - weighted_1) / (time_2 - time_1)
+
+
+def main(options):
+
+    import second_index
+
+    if not options.path:
+        raise time_weight.InputError("give the store directory by --path")
+
+    store = PrefixStore(options.path)
+    start = end = None
+    if options.start is not None:
+        start = second_index.parse_time(options.start) * time_weight.MICROSEC
+    if options.end is not None:
+        end = second_index.parse_time(options.end) * time_weight.MICROSEC
+
+    twa = store.twa(start, end)
+    if twa is None:
+        logging.info("no data in that window")
+        return
+    sys.stdout.write((time_weight.VALUE_FORMAT + "\n") % twa)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    opts = getopt(sys.argv)
+    main(opts)